@@ -0,0 +1,100 @@
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import subprocess
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Run in a fresh interpreter per sample; prints the phases in milliseconds as JSON
+PROBES = {
+    # A worker being (re)spawned: import the app and answer the first dashboard request
+    'app': """
+import time
+started = time.perf_counter()
+import main
+app = main.create_app(serve=False)
+imported = time.perf_counter()
+response = app.test_client().get('/api/alerts')
+assert response.status_code == 200, response.status_code
+done = time.perf_counter()
+""",
+    # A short-lived Arduino Cloud sync: import the script and the app it writes through
+    'sync': """
+import time
+started = time.perf_counter()
+from utils import sync_arduino_data
+app = sync_arduino_data.get_app()
+imported = time.perf_counter()
+with app.app_context():
+    sync_arduino_data.SystemStatus.query.first()
+done = time.perf_counter()
+"""
+}
+
+REPORT = """
+import json, sys
+heavy = [name for name in ('pytz', 'requests', 'tenacity') if name in sys.modules]
+print(json.dumps({
+    "import_ms": (imported - started) * 1000, "first_request_ms": (done - imported) * 1000, "loaded": heavy
+}))
+"""
+
+
+def run_probe(probe, env, workdir):
+    """
+    One cold start: process wall time plus the in-process import and first-request times
+    """
+    started = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable, '-c', PROBES[probe] + REPORT], cwd=workdir, env=env, capture_output=True, text=True,
+        check=True
+    )
+    wall_ms = (time.perf_counter() - started) * 1000
+    sample = json.loads(result.stdout.strip().splitlines()[-1])
+    sample["process_ms"] = wall_ms
+    return sample
+
+
+def summarize(samples):
+    summary = {}
+    for key in ('import_ms', 'first_request_ms', 'process_ms'):
+        values = np.array([sample[key] for sample in samples])
+        summary[key] = {
+            "p50": round(float(np.percentile(values, 50)), 1), "p90": round(float(np.percentile(values, 90)), 1)
+        }
+    summary["loaded"] = sorted({name for sample in samples for name in sample["loaded"]})
+    return summary
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Cold-start time of the app and the Arduino Cloud sync")
+    parser.add_argument('--runs', type=int, default=10, help="Fresh processes per probe")
+    parser.add_argument('--only', nargs='*', choices=tuple(PROBES), help="Probes to run (default: all)")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='gas-coldstart-')
+    # Log files are written to the working directory
+    env = {
+        **os.environ,
+        'PYTHONPATH': ROOT,
+        'DATABASE_URI': f"sqlite:///{os.path.join(workdir, 'coldstart.db')}",
+        'ANOMALY_CHECKPOINT_PATH': os.path.join(workdir, 'anomaly_state.json')
+    }
+    subprocess.run(
+        [sys.executable, '-m', 'flask', '--app', 'main', 'migrate'], cwd=workdir, env=env, capture_output=True,
+        check=True
+    )
+
+    for probe in args.only or PROBES:
+        # The first run warms the OS page cache and bytecode caches
+        run_probe(probe, env, workdir)
+        stats = summarize([run_probe(probe, env, workdir) for _ in range(args.runs)])
+        print(probe)
+        for key in ('import_ms', 'first_request_ms', 'process_ms'):
+            print(f"  {key:<18} p50 {stats[key]['p50']:>8} ms  p90 {stats[key]['p90']:>8} ms")
+        print(f"  loaded: {', '.join(stats['loaded']) or 'none of pytz, requests, tenacity'}")
@@ -0,0 +1,380 @@
+import os
+import json
+import math
+import time
+import heapq
+import random
+import zlib
+import logging
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+import numpy as np
+import requests
+
+logger = logging.getLogger('loadgen')
+
+# Dashboard polling mix from templates/index.html: (path, seconds between requests)
+DASHBOARD_MIX = (
+    ('/api/current-reading', 5),
+    ('/api/gas_readings', 30),
+    ('/api/alerts', 10)
+)
+
+# ESP8266 firmware posts one reading per device every this many seconds
+DEVICE_INTERVAL = 10
+
+# Seconds of simulated time an unreported leak keeps rising before it plateaus
+LEAK_RAMP_SECONDS = 1800
+
+
+class PpmTrace:
+    """
+    Simulated MQ-6 output for one device: a noisy baseline with slow drift,
+    and optionally a leak that ramps up from leak_at seconds to leak_peak PPM.
+    """
+    def __init__(self, seed, baseline=None, leak_at=None, leak_peak=None, noise=0.8):
+        rng = random.Random(seed)
+        self.baseline = baseline if baseline is not None else rng.uniform(8, 20)
+        self.drift = rng.uniform(1, 3)
+        self.period = rng.uniform(1800, 7200)
+        self.phase = rng.uniform(0, 2 * math.pi)
+        self.leak_at = leak_at
+        self.leak_peak = leak_peak if leak_peak is not None else rng.uniform(40, 90)
+        self.noise = noise
+        self._rng = rng
+        self._lock = threading.Lock()
+
+    def value(self, t):
+        """
+        PPM at t seconds into the run
+        """
+        with self._lock:
+            noise = self._rng.gauss(0, self.noise)
+        level = self.baseline + self.drift * math.sin(2 * math.pi * t / self.period + self.phase) + noise
+        if self.leak_at is not None and t >= self.leak_at:
+            progress = min((t - self.leak_at) / LEAK_RAMP_SECONDS, 1.0)
+            level += (self.leak_peak - self.baseline) * progress
+        return round(max(level, 0.0), 2)
+
+
+def make_traces(device_ids, leak_fraction=0.1, leak_window=600, seed=42):
+    """
+    One trace per device; leak_fraction of them start leaking within the first leak_window seconds
+    """
+    rng = random.Random(seed)
+    leaking = set(rng.sample(list(device_ids), int(round(len(device_ids) * leak_fraction))))
+    return {
+        device_id: PpmTrace(
+            seed=zlib.crc32(f'{seed}:{device_id}'.encode()),
+            leak_at=rng.uniform(0, leak_window) if device_id in leaking else None
+        )
+        for device_id in device_ids
+    }
+
+
+class LatencyRecorder:
+    """
+    Request latencies and errors per operation name
+    """
+    def __init__(self):
+        self._latencies = {}
+        self._errors = {}
+        self._lock = threading.Lock()
+        self.started = time.perf_counter()
+
+    def record(self, op, seconds, ok=True):
+        with self._lock:
+            self._latencies.setdefault(op, []).append(seconds)
+            if not ok:
+                self._errors[op] = self._errors.get(op, 0) + 1
+
+    def total_seconds(self):
+        """
+        Sum of all recorded latencies, the wall time of calls made one after another
+        """
+        with self._lock:
+            return sum(sum(values) for values in self._latencies.values())
+
+    def summary(self, elapsed=None):
+        """
+        {op: {count, errors, throughput, p50_ms, p99_ms, max_ms}} over the elapsed wall time
+        """
+        elapsed = elapsed or (time.perf_counter() - self.started)
+        with self._lock:
+            latencies = {op: np.array(values) * 1000 for op, values in self._latencies.items()}
+            errors = dict(self._errors)
+        return {
+            op: {
+                "count": int(values.size),
+                "errors": errors.get(op, 0),
+                "throughput": round(values.size / elapsed, 1),
+                "p50_ms": round(float(np.percentile(values, 50)), 2),
+                "p99_ms": round(float(np.percentile(values, 99)), 2),
+                "max_ms": round(float(values.max()), 2)
+            }
+            for op, values in sorted(latencies.items())
+        }
+
+
+class ArduinoCloudStub:
+    """
+    Local stand-in for the Arduino Cloud API.
+
+    Issues tokens and answers property requests for any thing ID with a value
+    from that thing's trace, after an optional simulated round trip. Point the
+    server at it with ARDUINO_API_URL.
+    """
+    def __init__(self, host='127.0.0.1', port=0, latency_ms=0, leak_fraction=0.1, seed=42):
+        self.latency = latency_ms / 1000
+        self.leak_fraction = leak_fraction
+        self.seed = seed
+        self.requests = 0
+        self.started = time.monotonic()
+        self._traces = {}
+        self._lock = threading.Lock()
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, format, *args):
+                pass
+
+            def _reply(self, body, status=200):
+                payload = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def do_POST(self):
+                self.rfile.read(int(self.headers.get('Content-Length') or 0))
+                stub._hit()
+                if self.path.endswith('/clients/token'):
+                    self._reply({"access_token": "stub-token", "expires_in": 3600, "token_type": "Bearer"})
+                else:
+                    self._reply({"error": "not found"}, 404)
+
+            def do_GET(self):
+                stub._hit()
+                parts = urlparse(self.path).path.strip('/').split('/')
+                # iot/v1|v2/things/<thing_id>/properties[/<property_id>[/timeseries]]
+                if len(parts) < 5 or parts[2] != 'things' or parts[4] != 'properties':
+                    self._reply({"error": "not found"}, 404)
+                elif parts[-1] == 'timeseries':
+                    self._reply({"data": []})
+                else:
+                    properties = stub.properties(parts[3])
+                    self._reply(properties if len(parts) == 5 else properties[0])
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def _hit(self):
+        with self._lock:
+            self.requests += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def properties(self, thing_id):
+        with self._lock:
+            trace = self._traces.get(thing_id)
+            if trace is None:
+                seed = zlib.crc32(f'{self.seed}:{thing_id}'.encode())
+                leaking = random.Random(seed).random() < self.leak_fraction
+                trace = self._traces[thing_id] = PpmTrace(seed, leak_at=60 if leaking else None)
+        return [
+            {"id": "gaslevel-id", "name": "gaslevel", "last_value": trace.value(time.monotonic() - self.started)},
+            {"id": "battery-id", "name": "battery_level", "last_value": 87},
+            {"id": "status-id", "name": "device_status", "last_value": "online"}
+        ]
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever, name='arduino-stub', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def run_schedule(tasks, duration, workers, stop=None):
+    """
+    Run (interval, fn) tasks on a pool of worker threads until duration elapses.
+
+    Each task is first due at a random point within its interval and then
+    every interval seconds after it was due; a worker that falls behind runs
+    late tasks immediately instead of skipping them.
+    """
+    deadline = time.monotonic() + duration
+    stop = stop or threading.Event()
+    shards = [[] for _ in range(max(min(workers, len(tasks)), 1))]
+    now = time.monotonic()
+    for i, (interval, fn) in enumerate(tasks):
+        heapq.heappush(shards[i % len(shards)], (now + random.uniform(0, interval), i, interval, fn))
+
+    def work(heap):
+        session = requests.Session()
+        while heap and not stop.is_set():
+            due, i, interval, fn = heapq.heappop(heap)
+            if due >= deadline:
+                return
+            if stop.wait(max(due - time.monotonic(), 0)):
+                return
+            fn(session)
+            heapq.heappush(heap, (due + interval, i, interval, fn))
+
+    threads = [threading.Thread(target=work, args=(heap,), daemon=True) for heap in shards]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def timed_request(recorder, op, session, method, url, **kwargs):
+    started = time.perf_counter()
+    try:
+        response = session.request(method, url, timeout=30, **kwargs)
+        ok = response.status_code < 400
+    except requests.RequestException:
+        response, ok = None, False
+    recorder.record(op, time.perf_counter() - started, ok)
+    return response
+
+
+def device_tasks(base_url, recorder, traces, interval=DEVICE_INTERVAL, speedup=1.0, started=None,
+                 ingest_path='/api/sensor-data'):
+    """
+    One task per device posting its next reading the way the ESP8266 firmware does
+    """
+    started = started or time.monotonic()
+
+    def task(device_id, trace):
+        def post(session):
+            elapsed = (time.monotonic() - started) * speedup
+            timed_request(recorder, 'sensor_data', session, 'POST', base_url + ingest_path, json={
+                "device_id": device_id,
+                "ppm": trace.value(elapsed),
+                "battery_level": 90,
+                "wifi_strength": -60,
+                "firmware_version": "loadgen"
+            })
+        return interval / speedup, post
+
+    return [task(device_id, trace) for device_id, trace in traces.items()]
+
+
+def dashboard_tasks(base_url, recorder, clients, speedup=1.0, mix=DASHBOARD_MIX):
+    """
+    Tasks for `clients` dashboard tabs, each polling the endpoints of the mix at its intervals
+    """
+    def task(path, interval):
+        op = path.rsplit('/', 1)[-1].replace('-', '_')
+        return interval / speedup, lambda session: timed_request(recorder, op, session, 'GET', base_url + path)
+
+    return [task(path, interval) for _ in range(clients) for path, interval in mix]
+
+
+def database_size(path):
+    """
+    Bytes used by a SQLite database, including its WAL file
+    """
+    if not path:
+        return None
+    return sum(os.path.getsize(p) for p in (path, path + '-wal') if os.path.exists(p))
+
+
+def run_load(base_url, devices=100, clients=10, duration=60, speedup=1.0, leak_fraction=0.1, workers=32,
+             db_path=None, ingest_path='/api/sensor-data', seed=42):
+    """
+    Run a device fleet and dashboard clients against a server and report
+    per-endpoint throughput and p50/p99 latency, plus database growth
+    """
+    recorder = LatencyRecorder()
+    traces = make_traces([f'loadgen-{i:05d}' for i in range(devices)], leak_fraction, seed=seed)
+    random.seed(seed)
+    size_before = database_size(db_path)
+    tasks = device_tasks(base_url, recorder, traces, speedup=speedup, ingest_path=ingest_path)
+    tasks += dashboard_tasks(base_url, recorder, clients, speedup=speedup)
+
+    started = time.perf_counter()
+    run_schedule(tasks, duration, workers)
+    elapsed = time.perf_counter() - started
+
+    summary = recorder.summary(elapsed)
+    report = {
+        "devices": devices,
+        "clients": clients,
+        "duration_seconds": round(elapsed, 1),
+        "requests_per_second": round(sum(op["count"] for op in summary.values()) / elapsed, 1),
+        "endpoints": summary
+    }
+    if size_before is not None:
+        growth = database_size(db_path) - size_before
+        ingested = summary.get('sensor_data', {}).get('count', 0)
+        report["db_growth_bytes"] = growth
+        report["db_bytes_per_reading"] = round(growth / ingested, 1) if ingested else None
+    return report
+
+
+def format_report(report):
+    lines = [
+        f"{report['devices']} devices, {report['clients']} dashboard clients, {report['duration_seconds']}s: "
+        f"{report['requests_per_second']} req/s"
+    ]
+    for op, stats in report["endpoints"].items():
+        lines.append(
+            f"  {op:<16} {stats['count']:>7} req {stats['throughput']:>8} req/s  p50 {stats['p50_ms']:>8} ms  "
+            f"p99 {stats['p99_ms']:>8} ms  errors {stats['errors']}"
+        )
+    if "db_growth_bytes" in report:
+        lines.append(
+            f"  database grew {report['db_growth_bytes']} bytes ({report['db_bytes_per_reading']} per reading)"
+        )
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    parser = argparse.ArgumentParser(description="Simulate ESP8266 devices and dashboard clients against a server")
+    parser.add_argument('--url', default='http://127.0.0.1:5000', help="Server base URL")
+    parser.add_argument('--devices', type=int, default=100, help="Simulated devices posting readings")
+    parser.add_argument('--clients', type=int, default=10, help="Simulated dashboard tabs")
+    parser.add_argument('--duration', type=float, default=60, help="Seconds to run")
+    parser.add_argument('--speedup', type=float, default=1.0, help="Divide every device and poll interval by this")
+    parser.add_argument('--leak-fraction', type=float, default=0.1, help="Fraction of devices that develop a leak")
+    parser.add_argument('--workers', type=int, default=32, help="Client threads")
+    parser.add_argument('--ingest-path', default='/api/sensor-data', help="Device ingest route")
+    parser.add_argument('--db', help="SQLite file to measure growth of")
+    parser.add_argument('--stub-port', type=int, help="Also serve an Arduino Cloud stub on this port")
+    parser.add_argument('--stub-latency-ms', type=float, default=50, help="Simulated Arduino Cloud round trip")
+    parser.add_argument('--json', help="Write the report to this file")
+    args = parser.parse_args()
+
+    stub = None
+    if args.stub_port is not None:
+        stub = ArduinoCloudStub(port=args.stub_port, latency_ms=args.stub_latency_ms).start()
+        logger.info(f"Arduino Cloud stub at {stub.url}; start the server with ARDUINO_API_URL={stub.url}")
+
+    report = run_load(
+        args.url, args.devices, args.clients, args.duration, args.speedup, args.leak_fraction, args.workers,
+        args.db, args.ingest_path
+    )
+    print(format_report(report))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+    if stub is not None:
+        stub.stop()
@@ -0,0 +1,565 @@
+import os
+import sys
+import json
+import time
+import random
+import logging
+import argparse
+import tempfile
+import threading
+from datetime import datetime, timedelta
+
+import numpy as np
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.loadgen import (
+    ArduinoCloudStub, LatencyRecorder, dashboard_tasks, database_size, make_traces, run_schedule
+)
+
+logger = logging.getLogger('benchmarks')
+
+# Relative slowdown (p50/p99) or throughput drop against the baseline reported as a regression
+DEFAULT_TOLERANCE = 0.25
+
+HISTORY_QUERIES = (
+    ('history_raw', '/api/gas_readings?hours=24'),
+    ('history_columns', '/api/gas_readings?hours=24&format=columns'),
+    ('history_5m', '/api/gas_readings?hours=24&resolution=5m'),
+    ('history_lttb', '/api/gas_readings?hours=24&max_points=500&method=lttb'),
+    ('history_page', '/api/gas_readings?hours=24&limit=500')
+)
+
+ALERT_QUERIES = (
+    ('alerts', '/api/alerts'),
+    ('alerts_columns', '/api/alerts?format=columns'),
+    ('alerts_page', '/api/alerts?limit=50')
+)
+
+# Scenarios run by default, in order
+SCENARIOS = (
+    'ingest', 'history', 'alerts', 'dashboard', 'contention', 'token', 'batch', 'thresholds', 'rollups', 'indexes'
+)
+
+
+def start_server(workdir, stub_url):
+    """
+    Import the application against a fresh SQLite database in workdir and
+    serve it on an ephemeral port. Returns (app module, base URL, database path).
+    """
+    db_path = os.path.join(workdir, 'bench.db')
+    os.environ.update({
+        'DATABASE_URI': f'sqlite:///{db_path}',
+        'ARDUINO_API_URL': stub_url,
+        'ARDUINO_CLIENT_ID': 'bench',
+        'ARDUINO_CLIENT_SECRET': 'bench',
+        'ARDUINO_THING_ID': 'bench-thing',
+        'ARDUINO_THING_IDS': '',
+        'BACKFILL_ON_STARTUP': 'False',
+        'RETENTION_INTERVAL_HOURS': '0',
+        'ARCHIVE_DIR': os.path.join(workdir, 'archive'),
+        'EXPORT_DIR': os.path.join(workdir, 'exports'),
+        'ANOMALY_CHECKPOINT_PATH': os.path.join(workdir, 'anomaly_state.json'),
+        'WEBHOOK_URLS': '',
+        'EMAIL_RECIPIENTS': ''
+    })
+    # Log files are written to the working directory
+    os.chdir(workdir)
+
+    import main
+    from werkzeug.serving import make_server
+
+    # Background services (collector, notifications) would add load of their own
+    app = main.create_app(serve=False)
+    with app.app_context():
+        main.migrate()
+
+    # One access log line per request would dominate the measurements
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, name='bench-server', daemon=True).start()
+    return main, f'http://127.0.0.1:{server.server_port}', db_path
+
+
+def seed_history(main, device_id, count, hours=24, alerts=500, seed=42):
+    """
+    Insert `count` readings spread over the last `hours` and `alerts` alert
+    episodes, then build the rollups the history endpoints read
+    """
+    rng = random.Random(seed)
+    traces = make_traces([device_id], leak_fraction=1.0, leak_window=hours * 3600 * 0.8, seed=seed)
+    trace = traces[device_id]
+    now = datetime.utcnow()
+    start = now - timedelta(hours=hours)
+    step = hours * 3600 / count
+
+    with main.app.app_context():
+        for offset in range(0, count, 50000):
+            rows = []
+            for i in range(offset, min(offset + 50000, count)):
+                gas_level = trace.value(i * step)
+                rows.append({
+                    "device_id": device_id,
+                    "timestamp": start + timedelta(seconds=i * step),
+                    "gas_level": gas_level,
+                    "status": main.determine_status(gas_level, device_id)
+                })
+            main.db.session.bulk_insert_mappings(main.GasReading, rows)
+            main.db.session.commit()
+        main.rebuild_device_rollups(device_id)
+
+        main.db.session.bulk_insert_mappings(main.Alert, [{
+            "device_id": device_id,
+            "timestamp": start + timedelta(seconds=rng.uniform(0, hours * 3600)),
+            "message": "Gas levels above normal (seeded)",
+            "level": rng.choice(("Warning", "Danger")),
+            "is_acknowledged": rng.random() < 0.5,
+            "peak_value": rng.uniform(30, 90),
+            "sample_count": 1
+        } for _ in range(alerts)])
+        main.db.session.commit()
+
+
+def bench_rollup_scaling(main, sizes, repeat, days=30):
+    """
+    A 30-day hourly history query aggregated from raw readings and served from
+    the rollups, for devices with each of `sizes` readings. The rollup query
+    should stay flat while the raw aggregate grows with the table.
+    """
+    from utils.downsample import query_buckets
+    from utils.rollups import query_rollup_buckets
+
+    GasReading, ReadingRollup, db = main.GasReading, main.ReadingRollup, main.db
+    results = {}
+    for size in sizes:
+        device_id = f'scale-{size}'
+        seed_history(main, device_id, size, hours=days * 24, alerts=0)
+        end = datetime.utcnow()
+        start = end - timedelta(days=days)
+        filters = [GasReading.device_id == device_id, GasReading.timestamp >= start, GasReading.timestamp <= end]
+
+        def raw():
+            with main.app.app_context():
+                query_buckets(db.session, GasReading.timestamp, GasReading.gas_level, GasReading.id, filters, 3600)
+
+        def rollup():
+            with main.app.app_context():
+                if query_rollup_buckets(db.session, ReadingRollup, device_id, start, end, 3600) is None:
+                    raise ValueError("No rollups for the window")
+
+        for op, query in ((f'raw_{size}', raw), (f'rollup_{size}', rollup)):
+            # Throughput over the query time only, not the seeding
+            recorder = LatencyRecorder()
+            elapsed = timed_loop(recorder, op, query, repeat, 1)
+            results.update(recorder.summary(elapsed))
+    return results
+
+
+def bench_indexes(main, device_id, repeat):
+    """
+    The reading and alert lookups the composite indexes serve, timed with the
+    indexes and again after dropping them; they are recreated afterwards. Seed
+    a million readings (--seed-readings 1000000) for production-sized numbers.
+    """
+    from utils.pagination import keyset_page
+
+    GasReading, Alert, db = main.GasReading, main.Alert, main.db
+    since = datetime.utcnow() - timedelta(hours=24)
+    queries = (
+        ('latest_reading', lambda: GasReading.query.filter_by(device_id=device_id).order_by(
+            GasReading.timestamp.desc()
+        ).first()),
+        ('readings_24h', lambda: db.session.query(GasReading.timestamp, GasReading.gas_level).filter(
+            GasReading.device_id == device_id, GasReading.timestamp >= since
+        ).order_by(GasReading.timestamp.desc()).all()),
+        ('readings_page', lambda: keyset_page(
+            GasReading.query.filter(GasReading.device_id == device_id, GasReading.timestamp >= since),
+            GasReading.timestamp, GasReading.id, limit=500
+        )),
+        ('unacknowledged_alerts', lambda: Alert.query.filter(Alert.is_acknowledged == False).order_by(
+            Alert.timestamp.desc()
+        ).limit(50).all())
+    )
+    indexes = [index for model in (GasReading, Alert) for index in model.__table__.indexes]
+
+    results = {}
+    with main.app.app_context():
+        engine = db.engine
+        try:
+            for phase in ('indexed', 'unindexed'):
+                if phase == 'unindexed':
+                    for index in indexes:
+                        index.drop(bind=engine, checkfirst=True)
+                for name, query in queries:
+                    recorder = LatencyRecorder()
+                    for _ in range(repeat):
+                        started = time.perf_counter()
+                        query()
+                        recorder.record(f'{name}_{phase}', time.perf_counter() - started)
+                    # Throughput over this query's own time
+                    results.update(recorder.summary(recorder.total_seconds()))
+                    # The index drops need the write lock
+                    db.session.close()
+        finally:
+            for index in indexes:
+                index.create(bind=engine, checkfirst=True)
+    return results
+
+
+def bench_thresholds(main, count, repeat, seed=42):
+    """
+    Classifying `count` readings of a leaking sensor's trace, 5 seconds apart,
+    one at a time and in one array pass, each both stateless and with
+    hysteresis and dwell, with readings/s for each path
+    """
+    epochs = np.arange(count) * 5.0
+    trace = make_traces(['thresholds'], leak_fraction=1.0, leak_window=count * 5 * 0.8, seed=seed)['thresholds']
+    values = np.array([trace.value(epoch) for epoch in epochs.tolist()])
+    engine = main.threshold_engine
+    paths = (
+        ('scalar_stateless', lambda: [main.determine_status(value) for value in values.tolist()]),
+        ('scalar_classify', lambda: [
+            engine.classify_reading('bench-thresholds', value, epoch)
+            for value, epoch in zip(values.tolist(), epochs.tolist())
+        ]),
+        ('array_stateless', lambda: engine.statuses(values)),
+        ('array_classify', lambda: engine.classify(values, epochs))
+    )
+
+    results = {}
+    for op, classify in paths:
+        recorder = LatencyRecorder()
+        for _ in range(repeat):
+            started = time.perf_counter()
+            classify()
+            recorder.record(op, time.perf_counter() - started)
+        results.update(recorder.summary(recorder.total_seconds()))
+    results["readings_per_second"] = {op: round(count * 1000 / results[op]["p50_ms"]) for op, _ in paths}
+    return results
+
+
+def closed_loop(base_url, recorder, calls, concurrency):
+    """
+    Issue (op, method, path, json) calls back to back from `concurrency` threads
+    """
+    pending = list(reversed(calls))
+    lock = threading.Lock()
+
+    def work():
+        session = requests.Session()
+        while True:
+            with lock:
+                if not pending:
+                    return
+                op, method, path, body = pending.pop()
+            started = time.perf_counter()
+            try:
+                ok = session.request(method, base_url + path, json=body, timeout=60).status_code < 400
+            except requests.RequestException:
+                ok = False
+            recorder.record(op, time.perf_counter() - started, ok)
+
+    threads = [threading.Thread(target=work, daemon=True) for _ in range(concurrency)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return recorder.summary(time.perf_counter() - started)
+
+
+def timed_loop(recorder, op, fn, count, concurrency):
+    """
+    Call fn() `count` times from `concurrency` threads, recording each call under op. Returns the wall time.
+    """
+    remaining = [count]
+    lock = threading.Lock()
+
+    def work():
+        while True:
+            with lock:
+                if remaining[0] <= 0:
+                    return
+                remaining[0] -= 1
+            started = time.perf_counter()
+            try:
+                fn()
+                ok = True
+            except Exception as e:
+                logger.debug(f"{op} failed: {e}")
+                ok = False
+            recorder.record(op, time.perf_counter() - started, ok)
+
+    threads = [threading.Thread(target=work, daemon=True) for _ in range(concurrency)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.perf_counter() - started
+
+
+def bench_token_refresh(main, stub, polls, concurrency):
+    """
+    Arduino Cloud polls through main.fetch_gas_reading (shared token manager and
+    keep-alive pool) against the old pattern of a new session and a
+    client-credentials exchange per poll, with the upstream requests per poll
+    """
+    thing_id = os.environ['ARDUINO_THING_ID']
+
+    def uncached_poll():
+        with requests.Session() as session:
+            token = session.post(f'{stub.url}/iot/v1/clients/token', data={
+                'grant_type': 'client_credentials', 'client_id': 'bench', 'client_secret': 'bench'
+            }, timeout=10).json()['access_token']
+            session.get(
+                f'{stub.url}/iot/v2/things/{thing_id}/properties',
+                headers={'Authorization': f'Bearer {token}'}, timeout=10
+            ).raise_for_status()
+
+    results = {}
+    upstream = {}
+    for op, poll in (('uncached_poll', uncached_poll), ('cached_poll', main.fetch_gas_reading)):
+        recorder = LatencyRecorder()
+        before = stub.requests
+        elapsed = timed_loop(recorder, op, poll, polls, concurrency)
+        upstream[op] = round((stub.requests - before) / polls, 2)
+        results.update(recorder.summary(elapsed))
+    results["upstream_requests_per_poll"] = upstream
+    return results
+
+
+def bench_ingest(base_url, db_path, devices, readings, concurrency):
+    """
+    Devices posting readings to /api/sensor-data as fast as the server accepts them
+    """
+    probe = requests.post(base_url + '/api/sensor-data', json={"device_id": "probe", "ppm": 10})
+    if probe.status_code == 404:
+        return {"skipped": "POST /api/sensor-data is not served by this app"}
+
+    traces = make_traces([f'bench-{i:04d}' for i in range(devices)], leak_fraction=0.1)
+    calls = [
+        ('sensor_data', 'POST', '/api/sensor-data', {"device_id": device_id, "ppm": trace.value(n * 10)})
+        for n in range(readings) for device_id, trace in traces.items()
+    ]
+    size_before = database_size(db_path)
+    results = closed_loop(base_url, LatencyRecorder(), calls, concurrency)
+    growth = database_size(db_path) - size_before
+    results["db_growth"] = {"bytes": growth, "bytes_per_reading": round(growth / len(calls), 1)}
+    return results
+
+
+def bench_batch_ingest(base_url, devices, readings, batch_size, concurrency):
+    """
+    The same readings posted one per request to /api/sensor-data and in
+    batches of batch_size to /api/sensor-data/batch, with readings/s for each
+    """
+    probe = requests.post(base_url + '/api/sensor-data/batch', json={"readings": [{"device_id": "probe", "ppm": 10}]})
+    if probe.status_code == 404:
+        return {"skipped": "POST /api/sensor-data/batch is not served by this app"}
+
+    traces = make_traces([f'{i:04d}' for i in range(devices)], leak_fraction=0.1)
+    now = datetime.utcnow()
+
+    def device_readings(prefix):
+        # Separate devices per path, so neither continues the other's alert episodes
+        return [{
+            "device_id": f'{prefix}-{device}',
+            "ppm": trace.value(n * 10),
+            "timestamp": (now - timedelta(seconds=(readings - n) * 10)).isoformat()
+        } for n in range(readings) for device, trace in traces.items()]
+
+    single = device_readings('single')
+    batched = device_readings('batch')
+    results = closed_loop(
+        base_url, LatencyRecorder(), [('single', 'POST', '/api/sensor-data', item) for item in single], concurrency
+    )
+    results.update(closed_loop(base_url, LatencyRecorder(), [
+        ('batch', 'POST', '/api/sensor-data/batch', {"readings": batched[i:i + batch_size]})
+        for i in range(0, len(batched), batch_size)
+    ], concurrency))
+    results["readings_per_second"] = {
+        op: round(len(single) * results[op]["throughput"] / results[op]["count"], 1) for op in ('single', 'batch')
+    }
+    return results
+
+
+def bench_queries(base_url, queries, repeat, concurrency):
+    calls = [(op, 'GET', path, None) for _ in range(repeat) for op, path in queries]
+    random.Random(42).shuffle(calls)
+    return closed_loop(base_url, LatencyRecorder(), calls, concurrency)
+
+
+def bench_dashboard(base_url, clients, duration, speedup):
+    """
+    Dashboard tabs replaying the index.html polling mix, time-compressed by speedup
+    """
+    recorder = LatencyRecorder()
+    run_schedule(dashboard_tasks(base_url, recorder, clients, speedup=speedup), duration, workers=clients)
+    return recorder.summary(duration)
+
+
+def bench_contention(main, base_url, writers, readers, duration, devices=20):
+    """
+    Writers storing readings through main.store_gas_reading (the path Arduino
+    Cloud polling and current-reading refreshes take) while dashboard clients
+    query history and alerts, all at once for `duration` seconds. Compare runs
+    with DB_PROFILE=off and on to see the effect of the engine profile.
+    """
+    recorder = LatencyRecorder()
+    traces = make_traces([f'contention-{i:03d}' for i in range(devices)], leak_fraction=0.2)
+    device_ids = sorted(traces)
+    deadline = time.perf_counter() + duration
+
+    def write(worker):
+        n = 0
+        while time.perf_counter() < deadline:
+            device_id = device_ids[(worker + n * writers) % devices]
+            gas_level = traces[device_id].value(n * 10)
+            started = time.perf_counter()
+            try:
+                with main.app.app_context():
+                    main.store_gas_reading({
+                        "device_id": device_id,
+                        "gas_level": gas_level,
+                        "status": main.determine_status(gas_level, device_id)
+                    })
+                ok = True
+            except Exception as e:
+                logger.debug(f"Contended write failed: {e}")
+                ok = False
+            recorder.record('write', time.perf_counter() - started, ok)
+            n += 1
+
+    def read(worker):
+        session = requests.Session()
+        queries = HISTORY_QUERIES + ALERT_QUERIES
+        n = worker
+        while time.perf_counter() < deadline:
+            op, path = queries[n % len(queries)]
+            started = time.perf_counter()
+            try:
+                ok = session.get(base_url + path, timeout=60).status_code < 400
+            except requests.RequestException:
+                ok = False
+            recorder.record('read_' + op.split('_')[0], time.perf_counter() - started, ok)
+            n += 1
+
+    threads = [threading.Thread(target=write, args=(i,), daemon=True) for i in range(writers)]
+    threads += [threading.Thread(target=read, args=(i,), daemon=True) for i in range(readers)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return recorder.summary(time.perf_counter() - started)
+
+
+def compare(results, baseline, tolerance):
+    """
+    Lines describing every operation that got slower or lost throughput beyond tolerance
+    """
+    regressions = []
+    for scenario, ops in results.items():
+        for op, stats in ops.items():
+            before = baseline.get(scenario, {}).get(op)
+            if not isinstance(stats, dict) or not isinstance(before, dict) or 'p50_ms' not in before:
+                continue
+            for key in ('p50_ms', 'p99_ms'):
+                if stats[key] > before[key] * (1 + tolerance):
+                    regressions.append(f"{scenario}/{op} {key}: {before[key]} -> {stats[key]}")
+            if stats['throughput'] < before['throughput'] * (1 - tolerance):
+                regressions.append(f"{scenario}/{op} throughput: {before['throughput']} -> {stats['throughput']}")
+    return regressions
+
+
+def print_results(results):
+    for scenario, ops in results.items():
+        print(scenario)
+        for op, stats in ops.items():
+            if op == 'skipped':
+                print(f"  skipped: {stats}")
+            elif op == 'db_growth':
+                print(f"  database grew {stats['bytes']} bytes ({stats['bytes_per_reading']} per reading)")
+            elif 'p50_ms' not in stats:
+                print(f"  {op}: " + ", ".join(f"{key} {value}" for key, value in stats.items()))
+            else:
+                print(
+                    f"  {op:<32} {stats['count']:>6} req {stats['throughput']:>8} req/s  "
+                    f"p50 {stats['p50_ms']:>8} ms  p99 {stats['p99_ms']:>8} ms  errors {stats['errors']}"
+                )
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    parser = argparse.ArgumentParser(description="Ingest, history and alert benchmarks against a throwaway database")
+    parser.add_argument('--seed-readings', type=int, default=100000, help="Readings of history to seed")
+    parser.add_argument('--devices', type=int, default=50, help="Devices in the ingest scenario")
+    parser.add_argument('--readings', type=int, default=20, help="Readings per device in the ingest scenario")
+    parser.add_argument('--concurrency', type=int, default=8, help="Client threads for closed-loop scenarios")
+    parser.add_argument('--repeat', type=int, default=20, help="Repetitions of each history and alert query")
+    parser.add_argument('--clients', type=int, default=20, help="Dashboard tabs in the dashboard scenario")
+    parser.add_argument('--dashboard-seconds', type=float, default=10, help="Length of the dashboard scenario")
+    parser.add_argument('--speedup', type=float, default=50, help="Time compression of the dashboard polling mix")
+    parser.add_argument('--writers', type=int, default=4, help="Writer threads in the contention scenario")
+    parser.add_argument('--readers', type=int, default=8, help="Reader threads in the contention scenario")
+    parser.add_argument('--contention-seconds', type=float, default=10, help="Length of the contention scenario")
+    parser.add_argument('--batch-size', type=int, default=100, help="Readings per request in the batch scenario")
+    parser.add_argument('--scaling-sizes', type=int, nargs='+', default=[10000, 100000, 1000000],
+                        help="Readings per device in the rollup scaling scenario")
+    parser.add_argument('--threshold-readings', type=int, default=1000000,
+                        help="Readings classified per pass in the thresholds scenario")
+    parser.add_argument('--polls', type=int, default=200, help="Arduino Cloud polls per mode in the token scenario")
+    parser.add_argument('--only', nargs='*', choices=SCENARIOS, help="Scenarios to run (default: all)")
+    parser.add_argument('--baseline', help="Compare against results saved earlier; exits 1 on a regression")
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE)
+    parser.add_argument('--save', help="Write results to this JSON file")
+    args = parser.parse_args()
+
+    scenarios = set(args.only or SCENARIOS)
+    save_path = os.path.abspath(args.save) if args.save else None
+    baseline_path = os.path.abspath(args.baseline) if args.baseline else None
+
+    workdir = tempfile.mkdtemp(prefix='gas-bench-')
+    stub = ArduinoCloudStub(latency_ms=20).start()
+    main, base_url, db_path = start_server(workdir, stub.url)
+    seed_history(main, main.DEFAULT_DEVICE_ID, args.seed_readings)
+
+    results = {}
+    if 'history' in scenarios:
+        results['history'] = bench_queries(base_url, HISTORY_QUERIES, args.repeat, args.concurrency)
+    if 'alerts' in scenarios:
+        results['alerts'] = bench_queries(base_url, ALERT_QUERIES, args.repeat, args.concurrency)
+    if 'ingest' in scenarios:
+        results['ingest'] = bench_ingest(base_url, db_path, args.devices, args.readings, args.concurrency)
+    if 'dashboard' in scenarios:
+        results['dashboard'] = bench_dashboard(base_url, args.clients, args.dashboard_seconds, args.speedup)
+    if 'contention' in scenarios:
+        results['contention'] = bench_contention(
+            main, base_url, args.writers, args.readers, args.contention_seconds
+        )
+    if 'token' in scenarios:
+        results['token'] = bench_token_refresh(main, stub, args.polls, args.concurrency)
+    if 'batch' in scenarios:
+        results['batch'] = bench_batch_ingest(base_url, args.devices, args.readings, args.batch_size, args.concurrency)
+    if 'thresholds' in scenarios:
+        results['thresholds'] = bench_thresholds(main, args.threshold_readings, 3)
+    if 'rollups' in scenarios:
+        results['rollups'] = bench_rollup_scaling(main, args.scaling_sizes, args.repeat)
+    if 'indexes' in scenarios:
+        # Last, as it drops and recreates indexes
+        results['indexes'] = bench_indexes(main, main.DEFAULT_DEVICE_ID, args.repeat)
+    stub.stop()
+
+    print_results(results)
+    if save_path:
+        with open(save_path, 'w') as f:
+            json.dump(results, f, indent=2)
+    if baseline_path:
+        with open(baseline_path) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for line in regressions:
+            print(f"REGRESSION {line}")
+        sys.exit(1 if regressions else 0)
@@ -1,7 +1,8 @@
 import os
 from dotenv import load_dotenv
 
-# Load environment variables from .env file
+# Load environment variables from .env file. This is the only place they are loaded:
+# import config before any module that reads its settings from the environment.
 load_dotenv()
 
 # Database configuration
@@ -19,4 +20,15 @@ ESP_SECRET_KEY = os.getenv('ESP_SECRET_KEY')
 # Web server configuration
 PORT = int(os.getenv('PORT', 5000))
 HOST = os.getenv('HOST', '0.0.0.0')
-DEBUG = os.getenv('FLASK_DEBUG', 'False').lower() in ('true', '1', 't')
\ No newline at end of file
+DEBUG = os.getenv('FLASK_DEBUG', 'False').lower() in ('true', '1', 't')
+
+
+def load_config():
+    """
+    Flask settings for the application
+    """
+    return {
+        "SQLALCHEMY_DATABASE_URI": DATABASE_URI,
+        "SQLALCHEMY_TRACK_MODIFICATIONS": False,
+        "SECRET_KEY": os.getenv('SECRET_KEY')
+    }
@@ -0,0 +1,30 @@
+import os
+import shutil
+import multiprocessing
+
+bind = f"{os.getenv('HOST', '0.0.0.0')}:{os.getenv('PORT', 5000)}"
+
+# One worker process per core by default; each serves requests on a thread pool
+workers = int(os.getenv('WEB_CONCURRENCY', multiprocessing.cpu_count()))
+worker_class = 'gthread'
+threads = int(os.getenv('WEB_THREADS', 8))
+timeout = 60
+graceful_timeout = 30
+
+# Workers import the app themselves, so no threads or database connections are shared across the fork.
+# The schema is not created here; run `flask --app main migrate` when installing or upgrading.
+preload_app = False
+
+# Tells the app that state held in one process is not seen by the others (see utils/leader.py)
+os.environ['MULTI_WORKER'] = 'true' if workers > 1 else 'false'
+
+
+# Each worker publishes its metrics here so /metrics reports the whole server (see utils/metrics.py)
+if workers > 1:
+    os.environ.setdefault('METRICS_DIR', os.path.join('data', 'metrics'))
+
+
+def on_starting(server):
+    # Snapshots left by a previous run would be added to this run's counters
+    if os.getenv('METRICS_DIR'):
+        shutil.rmtree(os.environ['METRICS_DIR'], ignore_errors=True)
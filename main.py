@@ -1,124 +1,126 @@
 import os
-import sys
 import logging
 import threading
 import time
-from datetime import datetime, timedelta
-import pytz  # Add pytz for timezone support
-import requests
-from dotenv import load_dotenv
+from contextlib import nullcontext
+from datetime import datetime, timedelta, timezone
+import numpy as np
 
-from flask import Flask, request, jsonify, render_template
-from flask_sqlalchemy import SQLAlchemy
+from dateutil import parser as date_parser
+from flask import (
+    Flask, Response, has_app_context, request, jsonify, render_template, send_file, stream_with_context
+)
 from flask_cors import CORS
-from tenacity import retry, stop_after_attempt, wait_exponential
-
-# Load environment variables
-load_dotenv()
-
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - [%(filename)s:%(lineno)d] - %(message)s',
-    handlers=[
-        logging.FileHandler('gas_detection.log', encoding='utf-8'),
-        logging.StreamHandler(sys.stdout)
-    ]
+
+# Loads .env; imported before the modules that read their settings from the environment
+from config import load_config
+from models.gas_readings import (
+    DEFAULT_DEVICE_ID, Alert, BackfillWatermark, GasReading, NotificationOutbox, ReadingRollup, db, eat_offset,
+    format_eat, migrate
 )
+from routes.api import api_bp
+from utils.alert_episodes import alert_episodes
+from utils.anomaly import ANOMALY_FEED_SECONDS, AnomalyDetector, AnomalyFeed, anomaly_detector
+from utils.arduino_cloud import ARDUINO_API_URL, ArduinoCloudAPI, get_session, get_token_manager, with_retries
+from utils.backfill import HistoryBackfill
+from utils.collector import AsyncCollector, configured_thing_ids
+from utils.database import begin_write, configure_app, init_engines, read_only
+from utils.downsample import choose_resolution, parse_resolution, query_buckets, query_lttb
+from utils.event_hub import hub
+from utils.export import EXPORT_FORMATS, ReadingExport, export_spool, text_chunks
+from utils.ingest import alert_message, detect_anomalies, publish_alerts, record_detector_events
+from utils.latest_state import conditional_response, latest_state, to_epoch
+from utils.leader import MULTI_WORKER, LeaderElection, leader_lock
+from utils.metrics import CONTENT_TYPE, INGEST_SECONDS, configure_logging, metrics, observe_commits
+from utils.notification_service import COALESCED, FAILED, SENT, NotificationDispatcher
+from utils.pagination import keyset_page, page_size
+from utils.scheduler import AdaptiveScheduler, TokenBucket
+from utils.serialization import columnar_response, list_format
+from utils.retention import (
+    ALERT_RETENTION_DAYS, OUTBOX_RETENTION_DAYS, archive_expired_readings, delete_in_batches, reading_archive,
+    retention_cutoff
+)
+from utils.rollups import EPOCH, rebuild_rollups, rollup_tracker, query_rollup_buckets, to_epochs
+from utils.single_flight import SingleFlight
+from utils.thresholds import STATUS_LABELS, ClassifierState, threshold_engine
+from utils.write_behind import WRITE_BEHIND_ENABLED, WriteBehindQueue
+
+# Configure logging; records are written by a background thread
+configure_logging('gas_detection.log', '%(asctime)s - %(levelname)s - [%(filename)s:%(lineno)d] - %(message)s')
 logger = logging.getLogger(__name__)
 
 # Initialize Flask app
 app = Flask(__name__)
 CORS(app)
 
-# Configure database - use DATABASE_URI from environment
-app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv('DATABASE_URI')
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-app.config['SECRET_KEY'] = os.getenv('SECRET_KEY')
-db = SQLAlchemy(app)
-
-# Define EAT timezone (UTC+3)
-EAT = pytz.timezone('Africa/Nairobi')
-
-# Models
-class GasReading(db.Model):
-    __tablename__ = 'gas_readings'
-    
-    id = db.Column(db.Integer, primary_key=True)
-    timestamp = db.Column(db.DateTime, default=datetime.utcnow)
-    gas_level = db.Column(db.Float, nullable=False)
-    status = db.Column(db.String(50), nullable=False)
-    
-    def to_dict(self):
-        # Convert UTC time to EAT
-        eat_time = pytz.utc.localize(self.timestamp).astimezone(EAT)
-        return {
-            "id": self.id,
-            "timestamp": eat_time.strftime('%Y-%m-%d %H:%M:%S'),
-            "gas_level": self.gas_level,
-            "status": self.status
-        }
+# Configure database - DATABASE_URI and the other settings come from config.py,
+# the pool and SQLite settings from utils/database.py
+app.config.update(load_config())
+configure_app(app, app.config['SQLALCHEMY_DATABASE_URI'])
+db.init_app(app)
+init_engines(db, app)
+observe_commits(db.session)
 
-class Alert(db.Model):
-    __tablename__ = 'alerts'
-    
-    id = db.Column(db.Integer, primary_key=True)
-    timestamp = db.Column(db.DateTime, default=datetime.utcnow)
-    message = db.Column(db.String(255), nullable=False)
-    level = db.Column(db.String(50), nullable=False)  # "Warning" or "Danger"
-    is_acknowledged = db.Column(db.Boolean, default=False)
-    
-    def to_dict(self):
-        # Convert UTC time to EAT
-        eat_time = pytz.utc.localize(self.timestamp).astimezone(EAT)
-        return {
-            "id": self.id,
-            "timestamp": eat_time.strftime('%Y-%m-%d %H:%M:%S'),
-            "message": self.message,
-            "level": self.level,
-            "is_acknowledged": self.is_acknowledged
-        }
+# Readings are refreshed from Arduino Cloud on /api/current-reading once the collector is this many
+# seconds past their thing's poll interval (including jitter)
+READING_MAX_AGE_GRACE = float(os.getenv('READING_MAX_AGE_GRACE', 15))
+# How long requests wait for an in-flight refresh before serving the cached reading
+REFRESH_WAIT_TIMEOUT = float(os.getenv('REFRESH_WAIT_TIMEOUT', 5))
+
+# Hours between retention runs in the background (0 disables them)
+RETENTION_INTERVAL_HOURS = float(os.getenv('RETENTION_INTERVAL_HOURS', 6))
+
+# Rows per chunk when reclassifying stored readings
+RECLASSIFY_CHUNK_SIZE = 100000
+
+# Adapt each thing's poll interval to its status and rate of change
+COLLECTOR_ADAPTIVE = os.getenv('COLLECTOR_ADAPTIVE', 'True').lower() == 'true'
+
+# Fill the gap since the last stored reading from Arduino Cloud history on startup
+BACKFILL_ON_STARTUP = os.getenv('BACKFILL_ON_STARTUP', 'True').lower() == 'true'
+# Arduino Cloud property holding the gas level
+GAS_LEVEL_PROPERTY = 'gaslevel'
+
+# Coalesces concurrent cache-miss refreshes into a single upstream fetch
+refresh_flight = SingleFlight()
 
 class ArduinoCloudIntegration:
     """
     Class for integrating with Arduino Cloud IoT
     """
-    def __init__(self):
+    def __init__(self, thing_id=None):
         self.client_id = os.getenv('ARDUINO_CLIENT_ID')
         self.client_secret = os.getenv('ARDUINO_CLIENT_SECRET')
-        self.thing_id = os.getenv('ARDUINO_THING_ID')
+        self.thing_id = thing_id or os.getenv('ARDUINO_THING_ID')
+        # The primary thing keeps the default device; additional things are stored under their own ID
+        self.device_id = thing_device_id(self.thing_id)
         
         # Check if Arduino Cloud credentials are available
         self.is_configured = all([self.client_id, self.client_secret, self.thing_id])
         if not self.is_configured:
             logger.error("Arduino Cloud integration not configured. Please set credentials in .env file.")
+            self.token_manager = None
+        else:
+            # Token and connection pool are shared by every instance in the process
+            self.token_manager = get_token_manager(self.client_id, self.client_secret)
+        self.session = get_session()
 
-    @retry(stop=stop_after_attempt(3), wait=wait_exponential(multiplier=1, min=2, max=10))
+    @with_retries('token')
     def get_access_token(self):
         """
-        Get Arduino Cloud access token
+        Get Arduino Cloud access token, reusing the cached one until it nears expiry
         """
         if not self.is_configured:
             raise ValueError("Arduino Cloud credentials not configured")
-            
-        token_url = "https://api2.arduino.cc/iot/v1/clients/token"
-        
-        payload = {
-            'grant_type': 'client_credentials',
-            'client_id': self.client_id,
-            'client_secret': self.client_secret,
-            'audience': 'https://api2.arduino.cc/iot'
-        }
         
+        import requests
         try:
-            response = requests.post(token_url, data=payload, timeout=10)
-            response.raise_for_status()
-            return response.json().get('access_token')
+            return self.token_manager.get_token()
         except requests.RequestException as e:
             logger.error(f"Error obtaining Arduino Cloud token: {e}")
             raise
 
-    @retry(stop=stop_after_attempt(3), wait=wait_exponential(multiplier=1, min=2, max=10))
+    @with_retries('properties')
     def get_latest_reading(self):
         """"
         Get the latest gas reading from Arduino Cloud
@@ -132,14 +134,17 @@ class ArduinoCloudIntegration:
             raise ValueError("Failed to obtain access token")
                 
         # Fetch properties
-        properties_url = f"https://api2.arduino.cc/iot/v1/things/{self.thing_id}/properties"
+        properties_url = f"{ARDUINO_API_URL}/iot/v1/things/{self.thing_id}/properties"
         
         headers = {
             'Authorization': f'Bearer {access_token}',
             'Accept': 'application/json'
         }
         
-        response = requests.get(properties_url, headers=headers, timeout=10)
+        response = self.session.get(properties_url, headers=headers, timeout=10)
+        if response.status_code == 401:
+            # Token was revoked early; force a refresh on the next attempt
+            self.token_manager.invalidate()
         response.raise_for_status()
         
         # Process response
@@ -148,15 +153,16 @@ class ArduinoCloudIntegration:
         
         # Extract the gas level property (adjust based on your Arduino property name)
         for prop in properties:
-            if prop.get('name', '').lower() == 'gaslevel':
+            if prop.get('name', '').lower() == GAS_LEVEL_PROPERTY:
                 gas_level = prop.get('last_value')
                 break
         
         if gas_level is not None:
-            # Determine status based on gas level
-            status = determine_status(float(gas_level))
+            # Determine status based on gas level, with hysteresis across polls
+            status = threshold_engine.classify_reading(self.device_id, float(gas_level), time.time())
             
             return {
+                'device_id': self.device_id,
                 'gas_level': float(gas_level),
                 'status': status
             }
@@ -164,168 +170,952 @@ class ArduinoCloudIntegration:
             logger.warning("No gas level property found in Arduino response")
             raise ValueError("Gas level property not found in Arduino response")
 
+def thing_device_id(thing_id):
+    """
+    Device ID that readings from an Arduino Cloud thing are stored under
+    """
+    if not thing_id or thing_id == os.getenv('ARDUINO_THING_ID'):
+        return DEFAULT_DEVICE_ID
+    return thing_id
 
-def determine_status(gas_level):
+def determine_status(gas_level, device_id=DEFAULT_DEVICE_ID):
     """
     Determine status based on gas level
     """
-    if gas_level > 100:
-        return "Danger"
-    elif gas_level > 75:
-        return "Warning"
-    else:
-        return "Safe"
+    return threshold_engine.status(gas_level, device_id)
 
-def create_alert_if_needed(gas_level, status):
+def create_alert_if_needed(gas_level, status, device_id=DEFAULT_DEVICE_ID, timestamp=None):
     """
-    Create an alert if the gas level is in the warning or danger zone
+    Open an alert episode if the gas level entered the warning or danger zone,
+    update the open one in place, or close it once the level is Safe again.
+    The caller commits with the reading and its queued notifications, then
+    wakes the dispatcher. Returns the newly opened alert, if any.
     """
-    if status == "Warning" or status == "Danger":
-        message = "Critical gas concentration detected" if status == "Danger" else "Gas levels above normal"
-        
-        alert = Alert(
-            message=f"{message} ({gas_level:.1f} PPM)",
-            level=status
+    alert = alert_episodes.observe(
+        db.session, Alert, device_id, status, gas_level, timestamp or datetime.utcnow(),
+        alert_message(device_id)
+    )
+    if alert:
+        logger.info(f"Alert opened for {device_id}: {alert.message}")
+        notifications.enqueue(
+            db.session, alert.id, alert.level, alert.message, {"ppm": gas_level, "device_id": device_id}
         )
-        
-        db.session.add(alert)
-        db.session.commit()
-        logger.info(f"Alert created: {message} - {gas_level:.1f} PPM")
+    return alert
 
+@INGEST_SECONDS.time(route='store_gas_reading')
 def store_gas_reading(data):
     """
     Store a gas reading in the database
     """
     gas_level = data['gas_level']
     status = data['status']
+    device_id = data.get('device_id', DEFAULT_DEVICE_ID)
+    timestamp = datetime.utcnow()
+    anomalies = detect_anomalies(device_id, gas_level, to_epoch(timestamp))
+    
+    # In write-behind mode, hand non-danger readings to the writer thread.
+    # Danger readings are always written synchronously so their alert is durable.
+    if ingest_queue is not None and status != "Danger":
+        item = {'device_id': device_id, 'gas_level': gas_level, 'status': status, 'timestamp': timestamp}
+        if ingest_queue.put(item):
+            if anomalies:
+                # Anomaly alerts are not deferred with the reading
+                db.session.commit()
+                publish_alerts(anomalies)
+            reading = GasReading(**item).to_dict()
+            latest_state.put(device_id, 'reading', reading, timestamp)
+            hub.publish('reading', reading)
+            return reading
     
     # Create a new reading
     new_reading = GasReading(
+        device_id=device_id,
+        timestamp=timestamp,
         gas_level=gas_level,
         status=status
     )
     
     db.session.add(new_reading)
+    rollup_tracker.record(
+        db.session, ReadingRollup, device_id, [new_reading.timestamp], [gas_level], [status]
+    )
+    
+    # Open, update or close the device's alert episode
+    alert = create_alert_if_needed(gas_level, status, device_id, new_reading.timestamp)
+    
+    db.session.commit()
+    logger.info(
+        f"Gas reading stored for {device_id}: {gas_level:.1f} PPM, Status: {status}", extra={'sample': 'reading'}
+    )
     
-    # Create alert if needed
-    create_alert_if_needed(gas_level, status)
+    reading = new_reading.to_dict()
+    latest_state.put(device_id, 'reading', reading, new_reading.timestamp)
+    hub.publish('reading', reading)
+    publish_alerts(([alert] if alert else []) + anomalies)
+    return reading
+
+def flush_gas_readings(items, before_commit=None):
+    """
+    Write a batch of queued readings and their alerts in a single commit.
+    before_commit() is called just before the commit, so a caller can add
+    its own changes to the same transaction.
+    """
+    alerts = []
+    items_by_device = {}
+    latest_by_device = {}
+    for item in items:
+        reading = GasReading(**item)
+        db.session.add(reading)
+        latest = latest_by_device.get(reading.device_id)
+        if latest is None or reading.timestamp >= latest.timestamp:
+            latest_by_device[reading.device_id] = reading
+        items_by_device.setdefault(item.get('device_id', DEFAULT_DEVICE_ID), []).append(item)
+        alert = create_alert_if_needed(
+            item['gas_level'], item['status'], item.get('device_id', DEFAULT_DEVICE_ID), item['timestamp']
+        )
+        if alert:
+            alerts.append(alert)
     
+    for device_id, device_items in items_by_device.items():
+        rollup_tracker.record(
+            db.session, ReadingRollup, device_id,
+            [item['timestamp'] for item in device_items],
+            [item['gas_level'] for item in device_items],
+            [item['status'] for item in device_items]
+        )
+    if before_commit is not None:
+        before_commit()
     db.session.commit()
-    logger.info(f"Gas reading stored: {gas_level:.1f} PPM, Status: {status}")
+    logger.info(f"Flushed {len(items)} queued gas readings", extra={'sample': 'flush'})
+    
+    for device_id, reading in latest_by_device.items():
+        latest_state.put(device_id, 'reading', reading.to_dict(), reading.timestamp)
+    publish_alerts(alerts)
+
+def store_collected_readings(readings, before_commit=None):
+    """
+    Store a batch of readings from the collector in a single commit; see
+    flush_gas_readings() for before_commit. Runs in the caller's app
+    context if there is one, so its session and objects stay usable.
+    """
+    timestamp = datetime.utcnow()
+    items = [{
+        'device_id': reading.get('device_id', DEFAULT_DEVICE_ID),
+        'gas_level': reading['gas_level'],
+        'status': reading['status'],
+        'timestamp': timestamp
+    } for reading in readings]
+    
+    with nullcontext() if has_app_context() else app.app_context():
+        anomalies = [
+            alert for item in items
+            for alert in detect_anomalies(item['device_id'], item['gas_level'], to_epoch(item['timestamp']))
+        ]
+        # Committed with the readings
+        flush_gas_readings(items, before_commit)
+        publish_alerts(anomalies)
     
-    return new_reading.to_dict()
+    for item in items:
+        hub.publish('reading', GasReading(**item).to_dict())
+
+# Shared notification dispatcher for the application process; the device API blueprint enqueues through it too
+notifications = NotificationDispatcher(app, NotificationOutbox)
+app.extensions['notifications'] = notifications
+
+# Optional write-behind ingest queue with group commits; the device API blueprint queues through it too
+ingest_queue = WriteBehindQueue(flush_gas_readings, app=app).start() if WRITE_BEHIND_ENABLED else None
+app.extensions['ingest_queue'] = ingest_queue
+
+_arduino_integrations = {}
+_arduino_lock = threading.Lock()
 
-def fetch_gas_reading():
+def get_arduino_integration(thing_id=None):
+    """
+    Return the shared Arduino Cloud integration instance for a thing
+    """
+    thing_id = thing_id or os.getenv('ARDUINO_THING_ID')
+    with _arduino_lock:
+        if thing_id not in _arduino_integrations:
+            _arduino_integrations[thing_id] = ArduinoCloudIntegration(thing_id)
+        return _arduino_integrations[thing_id]
+
+def fetch_gas_reading(thing_id=None):
     """
     Fetch gas reading from Arduino Cloud
     """
-    arduino = ArduinoCloudIntegration()
+    arduino = get_arduino_integration(thing_id)
     
     # Get data from Arduino Cloud
     arduino_data = arduino.get_latest_reading()
-    logger.info("Successfully retrieved data from Arduino Cloud")
+    logger.info("Successfully retrieved data from Arduino Cloud", extra={'sample': 'fetch'})
     return arduino_data
 
-# Routes
+# Routes; the devices' endpoints (/api/sensor-data, /api/system-status, ...) are in routes/api.py
+app.register_blueprint(api_bp, url_prefix='/api')
+
 @app.route('/')
 def index():
     return render_template('index.html')
 
 @app.route('/api/gas_readings', methods=['GET'])
+@read_only
 def get_gas_readings():
     try:
-        # Get readings from the last 24 hours
-        readings = GasReading.query.filter(
-            GasReading.timestamp >= datetime.utcnow() - timedelta(hours=24)
-        ).order_by(GasReading.timestamp.desc()).all()
+        hours = request.args.get('hours', 24, type=int)
+        device_id = request.args.get('device_id', DEFAULT_DEVICE_ID)
+        end_time = datetime.utcnow()
+        start_time = end_time - timedelta(hours=hours)
+        filters = [GasReading.device_id == device_id, GasReading.timestamp >= start_time]
+        
+        try:
+            output = list_format()
+            resolution = parse_resolution(request.args.get('resolution'))
+            max_points = request.args.get('max_points', type=int)
+            resolution = choose_resolution(start_time, end_time, resolution, max_points)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        
+        # format=columns returns parallel arrays of epoch seconds and values, newest first like the rows
+        meta = {"device_id": device_id, "utc_offset_seconds": int(eat_offset().total_seconds())}
+        
+        # Largest-Triangle-Three-Buckets keeps the shape of the raw series
+        # Ranges older than the raw retention window are served from the archive
+        archived = []
+        if start_time < retention_cutoff(device_id):
+            ids, timestamps, values = reading_archive.read(device_id, start_time, end_time)
+            archived = list(zip(ids.tolist(), timestamps.tolist(), values.tolist()))
+        
+        if max_points and request.args.get('method') == 'lttb':
+            points = query_lttb(
+                db.session, GasReading.timestamp, GasReading.gas_level, filters, max_points,
+                prefix=[(timestamp, gas_level) for _, timestamp, gas_level in archived]
+            )
+            points.reverse()
+            if output == 'columns':
+                return columnar_response({
+                    "timestamp": to_epochs([timestamp for timestamp, _ in points]),
+                    "gas_level": [gas_level for _, gas_level in points],
+                    "status": [determine_status(gas_level, device_id) for _, gas_level in points]
+                }, meta)
+            return jsonify([{
+                "timestamp": format_eat(timestamp),
+                "gas_level": gas_level,
+                "status": determine_status(gas_level, device_id)
+            } for timestamp, gas_level in points])
+        
+        # Fixed-size buckets from the coarsest fitting rollup, else aggregated from raw rows in SQL
+        if resolution:
+            def raw_buckets(lo, hi):
+                return query_buckets(
+                    db.session, GasReading.timestamp, GasReading.gas_level, GasReading.id,
+                    [GasReading.device_id == device_id, GasReading.timestamp >= lo, GasReading.timestamp < hi],
+                    resolution
+                )
+            
+            buckets = query_rollup_buckets(
+                db.session, ReadingRollup, device_id, start_time, end_time, resolution, raw_buckets
+            ) or query_buckets(
+                db.session, GasReading.timestamp, GasReading.gas_level, GasReading.id, filters, resolution
+            )
+            buckets.reverse()
+            if output == 'columns':
+                return columnar_response({
+                    "timestamp": to_epochs([bucket["start"] for bucket in buckets]),
+                    **{key: [bucket[key] for bucket in buckets] for key in ("avg", "min", "max", "last", "count")},
+                    "status": [determine_status(bucket["max"], device_id) for bucket in buckets]
+                }, meta)
+            return jsonify([{
+                "timestamp": format_eat(bucket["start"]),
+                "gas_level": bucket["avg"],
+                "min": bucket["min"],
+                "max": bucket["max"],
+                "last": bucket["last"],
+                "count": bucket["count"],
+                "status": determine_status(bucket["max"], device_id)
+            } for bucket in buckets])
+        
+        # Keyset pagination when a page is requested
+        if 'limit' in request.args or 'cursor' in request.args:
+            try:
+                readings, next_cursor = keyset_page(
+                    GasReading.query.filter(*filters), GasReading.timestamp, GasReading.id,
+                    cursor=request.args.get('cursor'), limit=page_size(request.args.get('limit', type=int)),
+                    extra=[GasReading(
+                        id=reading_id, device_id=device_id, timestamp=timestamp, gas_level=gas_level,
+                        status=determine_status(gas_level, device_id)
+                    ) for reading_id, timestamp, gas_level in archived]
+                )
+            except ValueError as e:
+                return jsonify({"error": str(e)}), 400
+            if output == 'columns':
+                return columnar_response({
+                    "id": [reading.id for reading in readings],
+                    "timestamp": to_epochs([reading.timestamp for reading in readings]),
+                    "gas_level": [reading.gas_level for reading in readings],
+                    "status": [reading.status for reading in readings]
+                }, {**meta, "next_cursor": next_cursor})
+            return jsonify({"items": [reading.to_dict() for reading in readings], "next_cursor": next_cursor})
         
-        return jsonify([reading.to_dict() for reading in readings])
+        # Get raw readings for the window as plain tuples; building ORM objects costs more than the query
+        rows = db.session.query(
+            GasReading.id, GasReading.timestamp, GasReading.gas_level, GasReading.status
+        ).filter(*filters).order_by(GasReading.timestamp.desc()).all()
+        archived.reverse()
+        
+        if output == 'columns':
+            return columnar_response({
+                "id": [reading_id for reading_id, _, _, _ in rows] + [reading_id for reading_id, _, _ in archived],
+                "timestamp": to_epochs(
+                    [timestamp for _, timestamp, _, _ in rows] + [timestamp for _, timestamp, _ in archived]
+                ),
+                "gas_level": [gas_level for _, _, gas_level, _ in rows] + [gas_level for _, _, gas_level in archived],
+                "status": [status for _, _, _, status in rows] + [
+                    determine_status(gas_level, device_id) for _, _, gas_level in archived
+                ]
+            }, meta)
+        
+        return jsonify([{
+            "id": reading_id,
+            "device_id": device_id,
+            "timestamp": format_eat(timestamp),
+            "gas_level": gas_level,
+            "status": status
+        } for reading_id, timestamp, gas_level, status in rows] + [{
+            "id": reading_id,
+            "device_id": device_id,
+            "timestamp": format_eat(timestamp),
+            "gas_level": gas_level,
+            "status": determine_status(gas_level, device_id)
+        } for reading_id, timestamp, gas_level in archived])
     except Exception as e:
         logger.error(f"Error retrieving gas readings: {e}")
         return jsonify({"error": "Failed to retrieve gas readings"}), 500
 
+def parse_export_time(value):
+    """
+    Parse an ISO 8601 time (UTC unless it carries an offset) into naive UTC
+    """
+    parsed = date_parser.isoparse(value)
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed
+
+@app.route('/api/export', methods=['GET'])
+@read_only
+def export_readings():
+    """
+    Stream a device's readings in [start, end) as CSV, NDJSON or Parquet.
+    
+    With an explicit end the export is also spooled to disk, so interrupted
+    downloads can resume with a Range request; without one, end is the
+    request time and the response is not resumable.
+    """
+    device_id = request.args.get('device_id', DEFAULT_DEVICE_ID)
+    fmt = request.args.get('format', 'csv').lower()
+    if fmt not in EXPORT_FORMATS:
+        return jsonify({"error": f"Unknown format '{fmt}', expected one of: {', '.join(EXPORT_FORMATS)}"}), 400
+    try:
+        end = parse_export_time(request.args['end']) if 'end' in request.args else datetime.utcnow()
+        start = parse_export_time(request.args['start']) if 'start' in request.args else end - timedelta(hours=24)
+    except (ValueError, OverflowError) as e:
+        return jsonify({"error": f"Invalid start or end: {e}"}), 400
+    if start >= end:
+        return jsonify({"error": "start must be before end"}), 400
+    
+    export = ReadingExport(
+        db.session, GasReading, GasReading.gas_level, device_id, start, end,
+        lambda gas_level: determine_status(gas_level, device_id)
+    )
+    resumable = 'end' in request.args
+    key = export_spool.key(device_id, start, end, fmt)
+    download_name = f"gas_readings_{device_id}_{start:%Y%m%dT%H%M%S}_{end:%Y%m%dT%H%M%S}.{fmt}"
+    export_spool.cleanup()
+    
+    # Parquet is written to a file first; resumed and repeated downloads are served from the spooled file
+    if fmt == 'parquet' or (resumable and (request.range or os.path.exists(export_spool.path(key, fmt)))):
+        try:
+            path = export_spool.complete(export, fmt, 'gas_level', key)
+        except RuntimeError as e:
+            return jsonify({"error": str(e)}), 501
+        return send_file(
+            path, mimetype=EXPORT_FORMATS[fmt], as_attachment=True, download_name=download_name,
+            conditional=True, etag=key
+        )
+    
+    if resumable:
+        chunks = export_spool.tee(export, fmt, 'gas_level', key)
+    else:
+        chunks = text_chunks(export, fmt, 'gas_level')
+    response = Response(stream_with_context(chunks), mimetype=EXPORT_FORMATS[fmt])
+    response.headers['Content-Disposition'] = f'attachment; filename="{download_name}"'
+    response.headers['Accept-Ranges'] = 'bytes' if resumable else 'none'
+    if resumable:
+        response.set_etag(key)
+    return response
+
+def reading_max_age(device_id):
+    """
+    Seconds a device's latest reading stays current: its thing's current poll interval plus grace
+    """
+    if collector.scheduler is None:
+        interval = collector.interval
+    else:
+        thing_id = os.getenv('ARDUINO_THING_ID') if device_id == DEFAULT_DEVICE_ID else device_id
+        interval = collector.scheduler.interval(thing_id)
+    return interval * (1 + collector.jitter) + READING_MAX_AGE_GRACE
+
+def is_reading_stale(entry, device_id=DEFAULT_DEVICE_ID):
+    """
+    Check whether a cached reading is missing or older than reading_max_age()
+    """
+    return not entry or time.time() - entry["modified"] > reading_max_age(device_id)
+
+def latest_device_reading(device_id):
+    """
+    Most recent stored reading for a device
+    """
+    return GasReading.query.filter_by(device_id=device_id).order_by(GasReading.timestamp.desc()).first()
+
+def latest_reading_entry(device_id):
+    """
+    Cached latest reading for a device, loaded from the database on a miss
+    """
+    entry = latest_state.get(device_id, 'reading')
+    if entry is None:
+        reading = latest_device_reading(device_id)
+        if reading:
+            entry = latest_state.put(device_id, 'reading', reading.to_dict(), reading.timestamp)
+    return entry
+
+def warm_latest_state():
+    """
+    Load every device's latest reading into the cache
+    """
+    for device_id in reading_device_ids():
+        latest_reading_entry(device_id)
+
+def is_arduino_device(device_id):
+    """
+    Whether a device's readings come from Arduino Cloud, so they can be refreshed on demand.
+    Devices posting to /api/sensor-data are only as current as their last post.
+    """
+    return device_id == DEFAULT_DEVICE_ID or device_id in configured_thing_ids()
+
+def refreshes_on_demand():
+    """
+    Whether this process may fetch a stale reading from Arduino Cloud for a request.
+    With several workers only the leader does, as it also runs the collector;
+    the others serve the latest reading it stored.
+    """
+    return not MULTI_WORKER or election.is_leader
+
+def refresh_current_reading(device_id=DEFAULT_DEVICE_ID):
+    """
+    Fetch and store a new reading unless another request already stored a fresh one.
+    Returns None without fetching if the Arduino Cloud request budget is spent.
+    """
+    latest_entry = latest_reading_entry(device_id)
+    if not is_reading_stale(latest_entry, device_id):
+        return latest_entry["data"]
+    
+    # The refresh spends the same request budget as the collector's polls
+    if refresh_limiter.acquire() > 0:
+        return None
+    
+    # End the read before the network call; the reading is stored in a transaction of its own
+    db.session.close()
+    
+    # Non-default devices are Arduino Cloud things stored under their own ID
+    data = fetch_gas_reading(None if device_id == DEFAULT_DEVICE_ID else device_id)
+    return store_gas_reading(data)
+
 @app.route('/api/current-reading', methods=['GET'])
 def get_current_reading():
     try:
-        # Get latest reading from database
-        latest_reading = GasReading.query.order_by(GasReading.timestamp.desc()).first()
+        device_id = request.args.get('device_id', DEFAULT_DEVICE_ID)
         
-        # If no readings in database or last reading is older than 1 minute, fetch a new one
-        if not latest_reading or (datetime.utcnow() - latest_reading.timestamp).total_seconds() > 60:
+        # Get latest reading from the cache
+        latest_entry = latest_reading_entry(device_id)
+        
+        if latest_entry is None and not is_arduino_device(device_id):
+            return jsonify({"error": "No readings from this device"}), 404
+        
+        # If no readings in database or the collector is late with the next one, fetch a new one.
+        # Only one request performs the fetch; the others wait for its result.
+        if is_reading_stale(latest_entry, device_id) and is_arduino_device(device_id):
+            if not refreshes_on_demand():
+                if latest_entry is None:
+                    return jsonify({"error": "No reading collected from Arduino Cloud yet"}), 503
+                return conditional_response(latest_entry)
+            # Waiters must not hold pooled connections the request doing the refresh needs to store it
+            db.session.close()
             try:
-                data = fetch_gas_reading()
-                latest_reading = store_gas_reading(data)
-                return jsonify(latest_reading)
+                reading, _ = refresh_flight.do(
+                    f'current-reading:{device_id}', lambda: refresh_current_reading(device_id),
+                    timeout=REFRESH_WAIT_TIMEOUT
+                )
+                if reading is None:
+                    logger.warning(f"Arduino Cloud request budget spent; not refreshing device {device_id}")
+                    if latest_entry:
+                        return jsonify({**latest_entry["data"], "stale": True})
+                    return jsonify({"error": "Arduino Cloud rate limit reached, try again shortly"}), 503
+                return jsonify(reading)
             except Exception as arduino_error:
                 logger.error(f"Error fetching from Arduino Cloud: {arduino_error}")
-                if latest_reading:
-                    return jsonify(latest_reading.to_dict())
+                if latest_entry:
+                    return jsonify({**latest_entry["data"], "stale": True})
                 else:
                     return jsonify({"error": "Unable to fetch gas reading from Arduino Cloud"}), 503
         else:
-            return jsonify(latest_reading.to_dict())
+            return conditional_response(latest_entry)
     except Exception as e:
         logger.error(f"Error retrieving current reading: {e}")
         return jsonify({"error": "Failed to retrieve current reading"}), 500
 
 @app.route('/api/alerts', methods=['GET'])
+@read_only
 def get_alerts():
     try:
-        # Get active alerts from the last 24 hours
-        alerts = Alert.query.filter(
-            Alert.timestamp >= datetime.utcnow() - timedelta(hours=24),
+        output = list_format()
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    
+    try:
+        # Get unacknowledged alert episodes that are still open or started in the last 24 hours
+        query = Alert.query.filter(
+            db.or_(Alert.timestamp >= datetime.utcnow() - timedelta(hours=24), Alert.closed_at.is_(None)),
             Alert.is_acknowledged == False
-        ).order_by(Alert.timestamp.desc()).all()
+        )
+        
+        next_cursor = None
+        if 'limit' in request.args or 'cursor' in request.args:
+            try:
+                alerts, next_cursor = keyset_page(
+                    query, Alert.timestamp, Alert.id,
+                    cursor=request.args.get('cursor'), limit=page_size(request.args.get('limit', type=int))
+                )
+            except ValueError as e:
+                return jsonify({"error": str(e)}), 400
+            if output == 'rows':
+                return jsonify({"items": [alert.to_dict() for alert in alerts], "next_cursor": next_cursor})
+        else:
+            alerts = query.order_by(Alert.timestamp.desc()).all()
         
+        if output == 'columns':
+            return columnar_response(alert_columns(alerts), {
+                "utc_offset_seconds": int(eat_offset().total_seconds()), "next_cursor": next_cursor
+            })
         return jsonify([alert.to_dict() for alert in alerts])
     except Exception as e:
         logger.error(f"Error retrieving alerts: {e}")
         return jsonify({"error": "Failed to retrieve alerts"}), 500
 
+def alert_columns(alerts):
+    """
+    Alerts as parallel arrays, with times in epoch seconds (null while an episode is open)
+    """
+    def epochs(timestamps):
+        return [(timestamp - EPOCH).total_seconds() if timestamp else None for timestamp in timestamps]
+    
+    return {
+        "id": [alert.id for alert in alerts],
+        "device_id": [alert.device_id for alert in alerts],
+        "timestamp": epochs(alert.timestamp for alert in alerts),
+        "level": [alert.level for alert in alerts],
+        "message": [alert.message for alert in alerts],
+        "is_acknowledged": [alert.is_acknowledged for alert in alerts],
+        "peak_value": [alert.peak_value for alert in alerts],
+        "last_seen": epochs(alert.last_seen for alert in alerts),
+        "sample_count": [alert.sample_count for alert in alerts],
+        "closed_at": epochs(alert.closed_at for alert in alerts)
+    }
+
 @app.route('/api/alerts/<int:alert_id>/acknowledge', methods=['POST'])
 def acknowledge_alert(alert_id):
     try:
+        begin_write(db.session)
         alert = Alert.query.get_or_404(alert_id)
         alert.is_acknowledged = True
         db.session.commit()
+        hub.publish('alert_acknowledged', {"id": alert.id})
         
         return jsonify({"success": True, "message": "Alert acknowledged"})
     except Exception as e:
         logger.error(f"Error acknowledging alert: {e}")
         return jsonify({"error": "Failed to acknowledge alert"}), 500
 
-def background_data_collection():
+@app.route('/api/ingest/stats', methods=['GET'])
+def get_ingest_stats():
+    """
+    Write-behind queue depth and flush statistics
+    """
+    if ingest_queue is None:
+        return jsonify({"write_behind": False})
+    return jsonify({"write_behind": True, **ingest_queue.stats()})
+
+@app.route('/api/stream', methods=['GET'])
+def stream_events():
+    """
+    Server-Sent Events stream of new readings and alert changes, for one device with ?device_id=
+    """
+    if MULTI_WORKER and not hub.is_shared:
+        # Events from other workers would never arrive; the dashboard falls back to polling
+        return jsonify({"error": "Event stream needs EVENT_HUB_REDIS_URL when running several workers"}), 503
+    
+    # Under gunicorn the connection is handed to the hub's broadcaster thread instead of holding this one
+    sock = request.environ.get('gunicorn.socket')
+    subscription = hub.subscribe(request.args.get('device_id'), detached=sock is not None)
+    if subscription is None:
+        return jsonify({"error": "Too many stream subscribers"}), 503
+    
+    response = Response(mimetype='text/event-stream', headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    response.response = hub.stream(subscription) if sock is None else hub.hand_off(subscription, sock, response)
+    return response
+
+@app.cli.command('migrate')
+def migrate_command():
+    """
+    Create or upgrade the database schema
+    """
+    migrate()
+    logger.info("Database schema is up to date")
+
+def reading_device_ids():
+    """
+    Devices that have stored readings. Ends the session's transaction, so
+    callers can go on to start write transactions.
+    """
+    device_ids = [device_id for (device_id,) in db.session.query(GasReading.device_id).distinct()]
+    db.session.close()
+    return device_ids
+
+def rebuild_device_rollups(device_id):
+    """
+    Rebuild one device's rollups from its raw readings; rollups of archived ranges are kept
+    """
+    first, last = db.session.query(
+        db.func.min(GasReading.timestamp), db.func.max(GasReading.timestamp)
+    ).filter(GasReading.device_id == device_id).one()
+    db.session.close()
+    if first is None:
+        return 0
+    
+    # Rollups of a day partly moved to the archive also cover its archived readings; rebuild whole retained days only
+    day_start = datetime.combine(first.date(), datetime.min.time())
+    if len(reading_archive.read(device_id, day_start, first)[0]):
+        first = day_start + timedelta(days=1)
+        if first > last:
+            return 0
+    
+    def read_rows(lo, hi):
+        return db.session.query(
+            GasReading.timestamp, GasReading.gas_level, GasReading.status
+        ).filter(
+            GasReading.device_id == device_id, GasReading.timestamp >= lo, GasReading.timestamp < hi
+        ).order_by(GasReading.timestamp).all()
+    
+    return rebuild_rollups(db.session, ReadingRollup, device_id, read_rows, first, last + timedelta(microseconds=1))
+
+@app.cli.command('rebuild-rollups')
+def rebuild_rollups_command():
+    """
+    Rebuild the reading rollup tables from raw gas readings
+    """
+    total = sum(rebuild_device_rollups(device_id) for device_id in reading_device_ids())
+    logger.info(f"Rebuilt rollups from {total} gas readings")
+
+@app.cli.command('reclassify-readings')
+def reclassify_readings_command():
+    """
+    Re-evaluate stored reading statuses against the current threshold profiles and rebuild rollups
+    """
+    changed = 0
+    total = 0
+    for device_id in reading_device_ids():
+        device_total, device_changed = reclassify_device_readings(device_id)
+        total += device_total
+        changed += device_changed
+        rebuild_device_rollups(device_id)
+    
+    logger.info(f"Reclassified {total} gas readings, {changed} changed status")
+
+@app.cli.command('replay-anomalies')
+def replay_anomalies_command():
+    """
+    Replay stored readings through a fresh anomaly detector and report the events it would raise
+    """
+    detector = AnomalyDetector(checkpoint_path=None)
+    total = 0
+    started = time.perf_counter()
+    for device_id in reading_device_ids():
+        rows = db.session.query(GasReading.timestamp, GasReading.gas_level).filter(
+            GasReading.device_id == device_id
+        ).order_by(GasReading.timestamp, GasReading.id).yield_per(50000)
+        for timestamp, gas_level in rows:
+            detector.update(device_id, gas_level, to_epoch(timestamp))
+            total += 1
+    elapsed = time.perf_counter() - started
+    
+    logger.info(
+        f"Replayed {total} gas readings in {elapsed:.1f}s ({total / max(elapsed, 1e-9):.0f}/s): "
+        f"{detector.stats()['events']}"
+    )
+
+def reclassify_device_readings(device_id):
     """
-    Background thread to periodically collect data
+    Re-evaluate one device's stored statuses in time order. Returns (total, changed).
+    """
+    state = ClassifierState()
+    changed = 0
+    total = 0
+    last_seen = (datetime.min, 0)
+    
+    while True:
+        # Keyset-paged so each chunk is a short read followed by a short write
+        rows = db.session.query(GasReading.id, GasReading.timestamp, GasReading.gas_level, GasReading.status).filter(
+            GasReading.device_id == device_id,
+            db.or_(
+                GasReading.timestamp > last_seen[0],
+                db.and_(GasReading.timestamp == last_seen[0], GasReading.id > last_seen[1])
+            )
+        ).order_by(GasReading.timestamp, GasReading.id).limit(RECLASSIFY_CHUNK_SIZE).all()
+        # The updates below start a transaction of their own; a write after this read could fail on SQLite
+        db.session.close()
+        if not rows:
+            break
+        
+        ids, timestamps, values, statuses = zip(*rows)
+        levels = threshold_engine.classify(values, to_epochs(timestamps), device_id, state=state)
+        labels = np.array(STATUS_LABELS, dtype=object)[levels]
+        ids = np.asarray(ids)
+        stale = labels != np.asarray(statuses, dtype=object)
+        # One UPDATE per status label instead of one per row
+        for label in STATUS_LABELS:
+            label_ids = ids[stale & (labels == label)].tolist()
+            for i in range(0, len(label_ids), 10000):
+                GasReading.query.filter(GasReading.id.in_(label_ids[i:i + 10000])).update(
+                    {GasReading.status: label}, synchronize_session=False
+                )
+        db.session.commit()
+        
+        changed += int(stale.sum())
+        total += len(rows)
+        last_seen = (timestamps[-1], int(ids[-1]))
+    
+    # The cached latest reading may carry its old status
+    latest_state.invalidate(device_id, 'reading')
+    return total, changed
+
+def backfill_history(now=None):
+    """
+    Fetch readings missed while the collector was not running, for every configured thing
+    """
+    client_id = os.getenv('ARDUINO_CLIENT_ID')
+    client_secret = os.getenv('ARDUINO_CLIENT_SECRET')
+    if not (client_id and client_secret):
+        logger.error("Arduino Cloud integration not configured; skipping backfill")
+        return 0
+    
+    backfill = HistoryBackfill(db.session, GasReading, GasReading.gas_level, ReadingRollup, BackfillWatermark)
+    total = 0
+    for thing_id in configured_thing_ids():
+        try:
+            api = ArduinoCloudAPI(client_id, client_secret, thing_id)
+            total += backfill.run(api, thing_id, thing_device_id(thing_id), GAS_LEVEL_PROPERTY, now=now)
+        except Exception as e:
+            db.session.rollback()
+            logger.error(f"Failed to backfill thing {thing_id}: {e}")
+    return total
+
+@app.cli.command('backfill')
+def backfill_command():
+    """
+    Fetch readings missed since the last stored one from Arduino Cloud history
+    """
+    total = backfill_history()
+    logger.info(f"Backfill inserted {total} gas readings")
+
+def apply_retention():
+    """
+    Archive expired raw readings and prune old acknowledged alerts and finished notifications
+    """
+    moved = sum(archive_expired_readings(
+        db.session, GasReading, GasReading.gas_level, device_id, [GasReading.device_id == device_id],
+        retention_cutoff(device_id)
+    ) for device_id in reading_device_ids())
+    notified = delete_in_batches(db.session, NotificationOutbox, [
+        NotificationOutbox.status.in_((SENT, COALESCED, FAILED)),
+        NotificationOutbox.created_at < datetime.utcnow() - timedelta(days=OUTBOX_RETENTION_DAYS)
+    ])
+    # Notifications still referencing a pruned alert keep their row without the reference
+    pruned = delete_in_batches(db.session, Alert, [
+        Alert.is_acknowledged == True,
+        Alert.timestamp < datetime.utcnow() - timedelta(days=ALERT_RETENTION_DAYS)
+    ], detach=[NotificationOutbox.alert_id])
+    logger.info(
+        f"Retention run archived {moved} readings and pruned {pruned} alerts and {notified} notifications"
+    )
+
+@app.cli.command('apply-retention')
+def apply_retention_command():
+    """
+    Archive expired raw readings and prune old acknowledged alerts and finished notifications
+    """
+    apply_retention()
+
+# Readings every worker stored, for the leader's anomaly detector
+anomaly_feed = AnomalyFeed(anomaly_detector, GasReading, GasReading.gas_level)
+
+def feed_anomaly_detector():
+    """
+    Run the readings stored since the last call through the anomaly detector,
+    commit an alert per event and publish them. Returns the new alerts.
+    """
+    alerts = record_detector_events(anomaly_feed.poll(db.session))
+    db.session.commit()
+    publish_alerts(alerts)
+    return alerts
+
+def background_anomaly_feed():
+    """
+    Background thread feeding the anomaly detector on the leader when several workers ingest readings
     """
     while True:
         try:
             with app.app_context():
-                try:
-                    data = fetch_gas_reading()
-                    store_gas_reading(data)
-                    logger.info("Successfully collected data in background thread")
-                except Exception as arduino_error:
-                    logger.error(f"Failed to collect data from Arduino Cloud: {arduino_error}")
+                feed_anomaly_detector()
         except Exception as e:
-            logger.error(f"Error in background data collection: {e}")
+            logger.error(f"Error feeding the anomaly detector: {e}")
         
-        # Wait for next collection
-        time.sleep(60)  # Collect data every minute
+        time.sleep(ANOMALY_FEED_SECONDS)
 
-if __name__ == '__main__':
-    with app.app_context():
-        # Create database tables
-        db.create_all()
+def background_retention():
+    """
+    Background thread to periodically apply data retention
+    """
+    while True:
+        try:
+            with app.app_context():
+                apply_retention()
+        except Exception as e:
+            logger.error(f"Error applying data retention: {e}")
         
-        # Start background data collection thread
-        collector_thread = threading.Thread(target=background_data_collection, daemon=True)
-        collector_thread.start()
+        time.sleep(RETENTION_INTERVAL_HOURS * 3600)
+
+# Polls every configured Arduino Cloud thing concurrently; started with the app
+collector = AsyncCollector(
+    fetch_gas_reading, store_collected_readings, configured_thing_ids(),
+    scheduler=AdaptiveScheduler() if COLLECTOR_ADAPTIVE else None
+)
+# On-demand refreshes take their request from the collector's rate limit, or their own without one
+refresh_limiter = collector.scheduler or TokenBucket()
+
+@app.route('/api/collector/stats', methods=['GET'])
+def get_collector_stats():
+    """
+    Poll counts, failures, timeouts, schedule lag and scheduling decisions of the background collector
+    """
+    return jsonify(collector.stats())
+
+@app.route('/api/notifications/stats', methods=['GET'])
+def get_notification_stats():
+    """
+    Queued, delivered, coalesced, retried and failed notification counts
+    """
+    return jsonify(notifications.stats())
+
+# Queue depths and component counters, read only when /metrics is scraped
+metrics.register_stats(
+    'gas_collector', collector.stats, counters=('polls', 'failures', 'timeouts', 'stored', 'batches')
+)
+metrics.register_stats(
+    'gas_notifications', notifications.stats,
+    counters=('enqueued', 'delivered', 'messages', 'coalesced', 'retried', 'failed')
+)
+metrics.register_stats('gas_stream', lambda: {"subscribers": hub.subscriber_count})
+metrics.register_stats('gas_anomaly', anomaly_detector.stats, counters=('readings',))
+if ingest_queue is not None:
+    metrics.register_stats(
+        'gas_write_behind', ingest_queue.stats,
+        counters=('enqueued', 'rejected', 'flushed', 'retried', 'failed', 'dead_lettered', 'dropped', 'batches')
+    )
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    """
+    Counters, latency histograms and queue depths in the Prometheus text format
+    """
+    return Response(metrics.render(), content_type=CONTENT_TYPE)
+
+@app.route('/api/anomaly/stats', methods=['GET'])
+def get_anomaly_stats():
+    """
+    Devices tracked, readings processed and events raised by the anomaly detector
+    """
+    return jsonify(anomaly_detector.stats())
+
+def start_background_services():
+    """
+    Start the work that must run in exactly one process of a deployment:
+    collection, backfill, notification delivery, anomaly detection and retention
+    """
+    # Fill the outage gap in the background; live readings stored from now on are not part of it
+    if BACKFILL_ON_STARTUP:
+        backfill_until = datetime.utcnow()
         
-        # Get host and port from environment
-        host = os.getenv('HOST', '0.0.0.0')
-        port = int(os.getenv('PORT', 5000))
-        debug = os.getenv('FLASK_DEBUG', 'False').lower() == 'true'
+        def run_backfill():
+            with app.app_context():
+                backfill_history(now=backfill_until)
         
-        # Run the Flask app
-        app.run(debug=debug, host=host, port=port)
\ No newline at end of file
+        threading.Thread(target=run_backfill, daemon=True).start()
+    
+    # Deliver queued alert notifications in the background
+    notifications.start()
+    
+    # Start background data collection for all configured things
+    collector.start()
+    
+    # Detect anomalies in the readings every worker stores
+    if MULTI_WORKER:
+        threading.Thread(target=background_anomaly_feed, daemon=True).start()
+    
+    # Start periodic archival of expired readings
+    if RETENTION_INTERVAL_HOURS > 0:
+        retention_thread = threading.Thread(target=background_retention, daemon=True)
+        retention_thread.start()
+
+# Exactly one process runs the background services; the others take over if it dies
+election = LeaderElection(leader_lock(db.get_engine(app)), start_background_services)
+metrics.register_stats('gas_leader', election.stats)
+
+def create_app(serve=True):
+    """
+    The application, for every entry point: the WSGI server, the development
+    server, the Arduino Cloud sync and the benchmarks.
+    
+    With serve, this process is also prepared to serve requests and joins the
+    election for the background services. Short-lived processes pass
+    serve=False and get the configured app only. The schema is not touched;
+    run `flask --app main migrate` after installing or upgrading.
+    """
+    if serve:
+        with app.app_context():
+            warm_latest_state()
+        if MULTI_WORKER and not hub.is_shared:
+            logger.warning("EVENT_HUB_REDIS_URL is not set; dashboards will poll instead of streaming")
+        metrics.start_publishing()
+        election.start()
+    return app
+
+if __name__ == '__main__':
+    # Get host and port from environment
+    host = os.getenv('HOST', '0.0.0.0')
+    port = int(os.getenv('PORT', 5000))
+    debug = os.getenv('FLASK_DEBUG', 'False').lower() == 'true'
+    
+    # With the reloader, only the child process serves requests
+    if not debug or os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        create_app()
+    
+    # Run the Flask app
+    app.run(debug=debug, host=host, port=port)
\ No newline at end of file
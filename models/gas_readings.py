@@ -0,0 +1,229 @@
+import os
+import logging
+from datetime import datetime
+from functools import lru_cache
+
+from utils.database import RoutingSQLAlchemy
+from utils.serialization import utc_offset
+
+logger = logging.getLogger(__name__)
+
+# Shared by the dashboard (main.py), the device API blueprint and the Arduino Cloud sync; bound to the app in main.py
+db = RoutingSQLAlchemy()
+
+# Readings collected from Arduino Cloud are stored under this device
+DEFAULT_DEVICE_ID = 'default'
+
+
+@lru_cache(maxsize=None)
+def eat_offset():
+    """
+    UTC offset of EAT (Africa/Nairobi, UTC+3). EAT has no daylight saving
+    time, so timestamps are converted with a fixed offset; pytz is only
+    imported the first time one is formatted.
+    """
+    import pytz
+    return utc_offset(pytz.timezone('Africa/Nairobi'))
+
+
+def format_eat(timestamp):
+    """
+    Format a naive UTC datetime as an EAT timestamp string
+    """
+    return (timestamp + eat_offset()).isoformat(' ', 'seconds')
+
+
+class GasReading(db.Model):
+    __tablename__ = 'gas_readings'
+
+    id = db.Column(db.Integer, primary_key=True)
+    device_id = db.Column(db.String(100), nullable=False, default=DEFAULT_DEVICE_ID, server_default=DEFAULT_DEVICE_ID)
+    timestamp = db.Column(db.DateTime, default=datetime.utcnow)
+    gas_level = db.Column(db.Float, nullable=False)
+    status = db.Column(db.String(50), nullable=False)
+
+    __table_args__ = (
+        # Latest-reading lookups and time-range scans per device
+        db.Index('ix_gas_readings_device_timestamp', 'device_id', 'timestamp'),
+    )
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "device_id": self.device_id,
+            "timestamp": format_eat(self.timestamp),
+            "gas_level": self.gas_level,
+            "status": self.status
+        }
+
+
+class Alert(db.Model):
+    __tablename__ = 'alerts'
+
+    id = db.Column(db.Integer, primary_key=True)
+    device_id = db.Column(db.String(100), nullable=False, default=DEFAULT_DEVICE_ID, server_default=DEFAULT_DEVICE_ID)
+    timestamp = db.Column(db.DateTime, default=datetime.utcnow)  # Start of the episode
+    message = db.Column(db.String(255), nullable=False)
+    level = db.Column(db.String(50), nullable=False)  # "Warning" or "Danger"
+    is_acknowledged = db.Column(db.Boolean, default=False)
+    peak_value = db.Column(db.Float)
+    last_seen = db.Column(db.DateTime)
+    sample_count = db.Column(db.Integer, default=1, server_default='1')
+    closed_at = db.Column(db.DateTime)  # Set when readings return to Safe
+    sms_sent = db.Column(db.Boolean, default=False, server_default='0')  # Sent by the device's GSM module
+
+    __table_args__ = (
+        db.Index('ix_alerts_acknowledged_timestamp', 'is_acknowledged', 'timestamp'),
+        # Partial index covering only the unacknowledged alerts the dashboard lists
+        db.Index(
+            'ix_alerts_unacknowledged_timestamp', 'timestamp',
+            sqlite_where=db.text('is_acknowledged = 0'),
+            postgresql_where=db.text('NOT is_acknowledged')
+        ),
+    )
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "device_id": self.device_id,
+            "timestamp": format_eat(self.timestamp),
+            "message": self.message,
+            "level": self.level,
+            "is_acknowledged": self.is_acknowledged,
+            "peak_value": self.peak_value,
+            "last_seen": format_eat(self.last_seen) if self.last_seen else None,
+            "sample_count": self.sample_count,
+            "closed_at": format_eat(self.closed_at) if self.closed_at else None
+        }
+
+
+class SystemStatus(db.Model):
+    """
+    Last reported health of a device posting to the device API or synced from Arduino Cloud
+    """
+    __tablename__ = 'system_status'
+
+    id = db.Column(db.Integer, primary_key=True)
+    device_id = db.Column(db.String(100), nullable=False, unique=True)
+    is_online = db.Column(db.Boolean, default=False)
+    last_update = db.Column(db.DateTime)
+    battery_level = db.Column(db.Integer)
+    wifi_strength = db.Column(db.Integer)  # RSSI in dBm
+    gsm_signal = db.Column(db.Integer)
+    firmware_version = db.Column(db.String(50))
+
+    def to_dict(self):
+        return {
+            "device_id": self.device_id,
+            "is_online": self.is_online,
+            "battery_level": self.battery_level,
+            "wifi_strength": self.wifi_strength,
+            "gsm_signal": self.gsm_signal,
+            "firmware_version": self.firmware_version,
+            "last_update": format_eat(self.last_update) if self.last_update else None
+        }
+
+
+class ReadingRollup(db.Model):
+    """
+    Pre-aggregated readings per device and time bucket (1 minute, 1 hour, 1 day)
+    """
+    __tablename__ = 'reading_rollups'
+
+    id = db.Column(db.Integer, primary_key=True)
+    device_id = db.Column(db.String(100), nullable=False)
+    granularity = db.Column(db.Integer, nullable=False)  # Bucket size in seconds
+    bucket_start = db.Column(db.DateTime, nullable=False)
+    count = db.Column(db.Integer, nullable=False, default=0)
+    min_value = db.Column(db.Float, nullable=False)
+    max_value = db.Column(db.Float, nullable=False)
+    sum_value = db.Column(db.Float, nullable=False, default=0.0)
+    warning_seconds = db.Column(db.Float, nullable=False, default=0.0)
+    danger_seconds = db.Column(db.Float, nullable=False, default=0.0)
+    last_value = db.Column(db.Float, nullable=False)
+    last_level = db.Column(db.SmallInteger, nullable=False, default=0, server_default='0')  # 0/1/2 safe/warning/danger
+    last_timestamp = db.Column(db.DateTime, nullable=False)
+
+    __table_args__ = (
+        db.UniqueConstraint('device_id', 'granularity', 'bucket_start', name='uq_reading_rollups_bucket'),
+    )
+
+
+class BackfillWatermark(db.Model):
+    """
+    How far each thing property's history has been backfilled from Arduino Cloud
+    """
+    __tablename__ = 'backfill_watermarks'
+
+    id = db.Column(db.Integer, primary_key=True)
+    thing_id = db.Column(db.String(100), nullable=False)
+    property_name = db.Column(db.String(100), nullable=False)
+    synced_until = db.Column(db.DateTime)  # History before this is stored
+    pending_until = db.Column(db.DateTime)  # End of the backfill in progress
+
+    __table_args__ = (
+        db.UniqueConstraint('thing_id', 'property_name', name='uq_backfill_watermarks_property'),
+    )
+
+
+class NotificationOutbox(db.Model):
+    """
+    Alert notifications waiting for, or recording, delivery to one recipient
+    """
+    __tablename__ = 'notification_outbox'
+
+    id = db.Column(db.Integer, primary_key=True)
+    alert_id = db.Column(db.Integer, db.ForeignKey('alerts.id'))
+    channel = db.Column(db.String(20), nullable=False)  # "sms", "webhook" or "email"
+    recipient = db.Column(db.String(255), nullable=False)
+    level = db.Column(db.String(50), nullable=False)
+    message = db.Column(db.String(255), nullable=False)
+    payload = db.Column(db.Text)  # JSON
+    status = db.Column(db.String(20), nullable=False, default='pending')  # pending, sending, sent, coalesced, failed
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    next_attempt_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    sent_at = db.Column(db.DateTime)
+    last_error = db.Column(db.String(255))
+
+    __table_args__ = (
+        db.Index('ix_notification_outbox_status_due', 'status', 'next_attempt_at'),
+    )
+
+
+def migrate():
+    """
+    Create missing tables, columns and indexes. Run once per deployment or
+    upgrade (flask --app main migrate), not on every start.
+    """
+    url = db.engine.url
+    if url.get_backend_name() == 'sqlite' and url.database not in (None, '', ':memory:'):
+        # A bare file name such as sqlite:///gas.db lives in the working directory
+        directory = os.path.dirname(url.database)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+    db.create_all()
+    ensure_schema()
+
+
+def ensure_schema():
+    """
+    Add declared columns and indexes that are missing on tables created by older versions
+    """
+    inspector = db.inspect(db.engine)
+    for table in db.metadata.sorted_tables:
+        existing = {column['name'] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing:
+                continue
+            column_type = column.type.compile(dialect=db.engine.dialect)
+            default = f" DEFAULT '{column.server_default.arg}'" if column.server_default is not None else ''
+            with db.engine.begin() as conn:
+                conn.execute(db.text(f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}{default}'))
+            logger.info(f"Added column {table.name}.{column.name}")
+            if (table.name, column.name) == ('alerts', 'closed_at'):
+                # Alerts from before episodes are single readings; close them so they are never extended
+                with db.engine.begin() as conn:
+                    conn.execute(db.text('UPDATE alerts SET closed_at = timestamp WHERE closed_at IS NULL'))
+        for index in table.indexes:
+            index.create(bind=db.engine, checkfirst=True)
@@ -1,67 +1,150 @@
-from flask import Blueprint, jsonify, request
-from models.gas_readings import GasReading, Alert, SystemStatus, db
-from datetime import datetime, timedelta
-from utils.gas_utils import get_status_from_ppm, validate_reading
-from utils.notification_service import send_notification, get_sms_config
+from flask import Blueprint, current_app, jsonify, request
+from models.gas_readings import GasReading, Alert, SystemStatus, ReadingRollup, db
+from datetime import datetime, timedelta, timezone
+from dateutil import parser as date_parser
+import numpy as np
+from utils.alert_episodes import alert_episodes
+from utils.database import begin_write, read_only
+from utils.ingest import alert_message, detect_anomalies, get_notification_dispatcher, publish_alerts
+from utils.latest_state import cache_sensor_reading, cache_system_status, conditional_response, latest_state
+from utils.metrics import INGEST_SECONDS
+from utils.gas_utils import validate_reading, validate_readings
+from utils.downsample import choose_resolution, parse_resolution, query_buckets, query_lttb
+from utils.notification_service import get_sms_config
+from utils.event_hub import hub
+from utils.pagination import keyset_page, page_size
+from utils.retention import reading_archive, retention_cutoff
+from utils.rollups import rollup_tracker, query_rollup_buckets, to_epochs
+from utils.thresholds import threshold_engine
 import logging
+import time
 
 api_bp = Blueprint('api', __name__)
 
-@api_bp.route('/current-reading')
-def current_reading():
-    device_id = request.args.get('device_id', 'default')
-    latest_reading = GasReading.query.filter_by(device_id=device_id).order_by(GasReading.timestamp.desc()).first()
+# Upper bound on readings accepted by a single /sensor-data/batch request
+MAX_BATCH_SIZE = 5000
+
+def parse_device_timestamp(value, default):
+    """
+    Parse a device-side timestamp (epoch seconds/milliseconds or ISO 8601) into naive UTC
+    """
+    if value is None:
+        return default
     
-    if not latest_reading:
-        return jsonify({"ppm": 0, "status": "unknown"})
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        # ESP8266 clocks commonly report milliseconds since the epoch
+        seconds = value / 1000 if value > 1e11 else value
+        return datetime.utcfromtimestamp(seconds)
     
-    return jsonify({
-        "ppm": latest_reading.ppm,
-        "status": get_status_from_ppm(latest_reading.ppm),
-        "timestamp": latest_reading.timestamp.isoformat()
-    })
+    parsed = date_parser.isoparse(value)
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed
+
+# /api/current-reading, /api/alerts and acknowledgements are served by main.py
 
 @api_bp.route('/gas-readings')
+@read_only
 def gas_readings():
     device_id = request.args.get('device_id', 'default')
     hours = request.args.get('hours', 24, type=int)
-    start_time = datetime.now(datetime.UTC) - timedelta(hours=hours)
-    
-    readings = GasReading.query.filter(
+    end_time = datetime.now(timezone.utc).replace(tzinfo=None)
+    start_time = end_time - timedelta(hours=hours)
+    filters = [
         GasReading.timestamp >= start_time,
         GasReading.device_id == device_id
-    ).order_by(GasReading.timestamp).all()
+    ]
+    
+    try:
+        resolution = parse_resolution(request.args.get('resolution'))
+        max_points = request.args.get('max_points', type=int)
+        resolution = choose_resolution(start_time, end_time, resolution, max_points)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    
+    # Ranges older than the raw retention window are served from the archive
+    archived, archived_ids = [], []
+    if start_time < retention_cutoff(device_id):
+        ids, timestamps, values = reading_archive.read(device_id, start_time, end_time)
+        archived, archived_ids = list(zip(timestamps.tolist(), values.tolist())), ids.tolist()
+    
+    if max_points and request.args.get('method') == 'lttb':
+        points = query_lttb(db.session, GasReading.timestamp, GasReading.gas_level, filters, max_points, prefix=archived)
+        return jsonify([{
+            "time": timestamp.strftime("%H:%M"),
+            "ppm": ppm,
+            "timestamp": timestamp.isoformat()
+        } for timestamp, ppm in points])
+    
+    if resolution:
+        def raw_buckets(lo, hi):
+            return query_buckets(
+                db.session, GasReading.timestamp, GasReading.gas_level, GasReading.id,
+                [GasReading.device_id == device_id, GasReading.timestamp >= lo, GasReading.timestamp < hi],
+                resolution
+            )
+        
+        # Readings outside the rollups' coverage are aggregated from raw rows by raw_buckets
+        buckets = query_rollup_buckets(
+            db.session, ReadingRollup, device_id, start_time, end_time, resolution, raw_buckets
+        ) or query_buckets(db.session, GasReading.timestamp, GasReading.gas_level, GasReading.id, filters, resolution)
+        return jsonify([{
+            "time": bucket["start"].strftime("%H:%M"),
+            "ppm": bucket["avg"],
+            "min": bucket["min"],
+            "max": bucket["max"],
+            "last": bucket["last"],
+            "count": bucket["count"],
+            "timestamp": bucket["start"].isoformat()
+        } for bucket in buckets])
+    
+    if 'limit' in request.args or 'cursor' in request.args:
+        try:
+            readings, next_cursor = keyset_page(
+                GasReading.query.filter(*filters), GasReading.timestamp, GasReading.id,
+                cursor=request.args.get('cursor'), limit=page_size(request.args.get('limit', type=int)),
+                descending=False, extra=[
+                    GasReading(id=reading_id, device_id=device_id, timestamp=timestamp, gas_level=ppm)
+                    for reading_id, (timestamp, ppm) in zip(archived_ids, archived)
+                ]
+            )
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        return jsonify({"items": [{
+            "time": reading.timestamp.strftime("%H:%M"),
+            "ppm": reading.gas_level,
+            "timestamp": reading.timestamp.isoformat()
+        } for reading in readings], "next_cursor": next_cursor})
+    
+    readings = GasReading.query.filter(*filters).order_by(GasReading.timestamp).all()
     
     return jsonify([{
+        "time": timestamp.strftime("%H:%M"),
+        "ppm": ppm,
+        "timestamp": timestamp.isoformat()
+    } for timestamp, ppm in archived] + [{
         "time": reading.timestamp.strftime("%H:%M"),
-        "ppm": reading.ppm,
+        "ppm": reading.gas_level,
         "timestamp": reading.timestamp.isoformat()
     } for reading in readings])
 
-@api_bp.route('/alerts')
-def alerts():
-    active_only = request.args.get('active_only', 'true').lower() == 'true'
-    
-    query = Alert.query
-    if active_only:
-        query = query.filter_by(is_active=True)
-    
-    alerts_list = query.order_by(Alert.timestamp.desc()).all()
-    return jsonify([alert.to_dict() for alert in alerts_list])
-
 @api_bp.route('/system-status')
 def system_status():
     device_id = request.args.get('device_id', 'default')
-    status = SystemStatus.query.filter_by(device_id=device_id).order_by(SystemStatus.last_update.desc()).first()
-    
-    if not status:
-        return jsonify({
-            "is_online": False,
-            "battery_level": None,
-            "last_update": None
-        })
+    entry = latest_state.get(device_id, 'system_status')
+    if entry is None:
+        status = SystemStatus.query.filter_by(device_id=device_id).order_by(SystemStatus.last_update.desc()).first()
+        
+        if not status:
+            return jsonify({
+                "is_online": False,
+                "battery_level": None,
+                "last_update": None
+            })
+        
+        entry = cache_system_status(status)
     
-    return jsonify(status.to_dict())
+    return conditional_response(entry)
 
 @api_bp.route('/gsm-config')
 def gsm_config():
@@ -70,6 +153,7 @@ def gsm_config():
 
 # Handle incoming data from ESP8266 with MQ-6 sensor
 @api_bp.route('/sensor-data', methods=['POST'])
+@INGEST_SECONDS.time(route='receive_sensor_data')
 def receive_sensor_data():
     try:
         data = request.json
@@ -85,12 +169,48 @@ def receive_sensor_data():
             logging.warning(f"Invalid reading from device {device_id}: {message}")
             return jsonify({"error": message}), 400
         
+        # In write-behind mode, queue non-danger readings for a group commit.
+        # Danger readings are always written synchronously so their alert is durable.
+        received_at = time.time()
+        label = threshold_engine.classify_reading(
+            device_id, float(data['ppm']), received_at, gas_type=data.get('gas_type')
+        )
+        gas_status = label.lower()
+        anomalies = detect_anomalies(device_id, float(data['ppm']), received_at)
+        ingest_queue = get_ingest_queue()
+        if ingest_queue is not None and gas_status != 'danger':
+            entry = {
+                "device_id": device_id,
+                "ppm": float(data['ppm']),
+                "status": label,
+                "timestamp": datetime.utcnow(),
+                "data": data
+            }
+            if ingest_queue.put(entry, store_readings):
+                if anomalies:
+                    # Anomaly alerts are not deferred with the reading
+                    db.session.commit()
+                    publish_alerts(anomalies)
+                cache_sensor_reading(GasReading(
+                    device_id=device_id, gas_level=entry["ppm"], status=label, timestamp=entry["timestamp"]
+                ))
+                return jsonify({
+                    "success": True,
+                    "reading_id": None,
+                    "queued": True,
+                    "status": gas_status,
+                    "should_alert": gas_status == 'warning'
+                })
+        
         # Create new reading
         reading = GasReading(
-            ppm=data['ppm'],
-            device_id=device_id
+            gas_level=float(data['ppm']),
+            status=label,
+            device_id=device_id,
+            timestamp=datetime.utcnow()
         )
         db.session.add(reading)
+        rollup_tracker.record(db.session, ReadingRollup, device_id, [reading.timestamp], [reading.gas_level], [label])
         
         # Update system status
         status = SystemStatus.query.filter_by(device_id=device_id).first()
@@ -105,34 +225,26 @@ def receive_sensor_data():
         status.gsm_signal = data.get('gsm_signal', status.gsm_signal)
         status.firmware_version = data.get('firmware_version', status.firmware_version)
         
-        # Check if we need to create an alert
-        gas_status = get_status_from_ppm(data['ppm'])
-        if gas_status in ['warning', 'danger']:
-            alert = Alert(
-                level=gas_status,
-                message=f"Gas levels at {gas_status.upper()} level: {data['ppm']} PPM detected by device {device_id}"
+        # Open, update or close the device's alert episode; only a new episode notifies
+        alert = alert_episodes.observe(
+            db.session, Alert, device_id, label, reading.gas_level, reading.timestamp, alert_message(device_id)
+        )
+        if alert:
+            # Delivered by the dispatcher after this request commits
+            get_notification_dispatcher().enqueue(
+                db.session, alert.id, alert.level, alert.message, {"ppm": data['ppm'], "device_id": device_id}
             )
-            db.session.add(alert)
-            db.session.commit()  # Commit to get the alert ID
-            
-            # Log the notification (actual SMS will be sent by ESP8266/GSM module)
-            try:
-                send_notification(
-                    message=alert.message,
-                    level=alert.level,
-                    data={"ppm": data['ppm'], "device_id": device_id}
-                )
-                alert.notification_sent = True
-                
-                # Mark SMS as queued for sending
-                if data.get('gsm_ready', False):
-                    alert.sms_sent = True
-                
-            except Exception as e:
-                logging.error(f"Failed to process notification: {str(e)}")
+            # Mark SMS as queued for sending by the device's GSM module
+            if data.get('gsm_ready', False):
+                alert.sms_sent = True
         
         db.session.commit()
         
+        cache_sensor_reading(reading)
+        cache_system_status(status)
+        hub.publish('reading', reading.to_dict())
+        publish_alerts(([alert] if alert else []) + anomalies)
+        
         return jsonify({
             "success": True, 
             "reading_id": reading.id,
@@ -144,17 +256,184 @@ def receive_sensor_data():
         logging.error(f"Error processing sensor data: {str(e)}")
         return jsonify({"error": str(e)}), 500
 
-# Acknowledge an alert
-@api_bp.route('/alerts/<int:alert_id>/acknowledge', methods=['POST'])
-def acknowledge_alert(alert_id):
-    alert = Alert.query.get_or_404(alert_id)
-    alert.is_acknowledged = True
+def store_readings(entries):
+    """
+    Persist validated readings from one or more devices in a single transaction.
+    
+    Each entry holds device_id, ppm, status label, timestamp and the raw device payload
+    under "data". Rows are bulk-inserted, each device's SystemStatus is upserted
+    once from its latest reading and readings are folded into alert episodes in time order.
+    """
+    now = datetime.utcnow()
+    latest_by_device = {}
+    entries_by_device = {}
+    for entry in entries:
+        device_id = entry["device_id"]
+        entries_by_device.setdefault(device_id, []).append(entry)
+        latest = latest_by_device.get(device_id)
+        if latest is None or entry["timestamp"] >= latest["timestamp"]:
+            latest_by_device[device_id] = entry
+    
+    if entries:
+        db.session.bulk_insert_mappings(GasReading, [
+            {
+                "gas_level": entry["ppm"], "status": entry["status"],
+                "device_id": entry["device_id"], "timestamp": entry["timestamp"]
+            }
+            for entry in entries
+        ])
+    
+    for device_id, device_entries in entries_by_device.items():
+        rollup_tracker.record(
+            db.session, ReadingRollup, device_id,
+            [entry["timestamp"] for entry in device_entries],
+            [entry["ppm"] for entry in device_entries],
+            [entry["status"] for entry in device_entries]
+        )
+    
+    statuses = {
+        status.device_id: status
+        for status in SystemStatus.query.filter(SystemStatus.device_id.in_(list(latest_by_device))).all()
+    } if latest_by_device else {}
+    for device_id, entry in latest_by_device.items():
+        data = entry["data"]
+        status = statuses.get(device_id)
+        if not status:
+            status = statuses[device_id] = SystemStatus(device_id=device_id)
+            db.session.add(status)
+        
+        status.is_online = True
+        status.last_update = now
+        status.battery_level = data.get('battery_level', status.battery_level)
+        status.wifi_strength = data.get('wifi_strength', status.wifi_strength)
+        status.gsm_signal = data.get('gsm_signal', status.gsm_signal)
+        status.firmware_version = data.get('firmware_version', status.firmware_version)
+    
+    alerts = []
+    dispatcher = get_notification_dispatcher()
+    for device_id, device_entries in entries_by_device.items():
+        message = alert_message(device_id)
+        for entry in sorted(device_entries, key=lambda entry: entry["timestamp"]):
+            alert = alert_episodes.observe(
+                db.session, Alert, device_id, entry["status"], entry["ppm"], entry["timestamp"], message
+            )
+            if alert:
+                dispatcher.enqueue(
+                    db.session, alert.id, alert.level, alert.message, {"ppm": entry["ppm"], "device_id": device_id}
+                )
+                if entry["data"].get('gsm_ready', False):
+                    alert.sms_sent = True
+                alerts.append(alert)
+    
     db.session.commit()
-    return jsonify({"success": True})
+    
+    if alerts:
+        dispatcher.wake()
+    for alert in alerts:
+        hub.publish('alert', alert.to_dict())
+    
+    for status in statuses.values():
+        cache_system_status(status)
+    for device_id, entry in latest_by_device.items():
+        reading = GasReading(
+            device_id=device_id, gas_level=entry["ppm"], status=entry["status"], timestamp=entry["timestamp"]
+        )
+        cache_sensor_reading(reading)
+        hub.publish('reading', reading.to_dict())
+
+def get_ingest_queue():
+    """
+    Return the application's write-behind queue, or None when readings are written synchronously
+    """
+    return current_app.extensions.get('ingest_queue')
+
+# Handle batches of readings from one or more devices
+@api_bp.route('/sensor-data/batch', methods=['POST'])
+@INGEST_SECONDS.time(route='receive_sensor_data_batch')
+def receive_sensor_data_batch():
+    try:
+        data = request.json
+        items = data.get('readings') if isinstance(data, dict) else data
+        
+        if not isinstance(items, list) or not items:
+            return jsonify({"error": "Invalid data format"}), 400
+        if len(items) > MAX_BATCH_SIZE:
+            return jsonify({"error": f"Batch exceeds {MAX_BATCH_SIZE} readings"}), 413
+        
+        now = datetime.utcnow()
+        results = [None] * len(items)
+        ppm_values = np.full(len(items), np.nan)
+        timestamps = [None] * len(items)
+        
+        for i, item in enumerate(items):
+            if not isinstance(item, dict) or 'ppm' not in item:
+                results[i] = {"index": i, "accepted": False, "error": "Invalid data format"}
+                continue
+            try:
+                ppm_values[i] = float(item['ppm'])
+                timestamps[i] = parse_device_timestamp(item.get('timestamp'), now)
+            except (TypeError, ValueError, OverflowError):
+                results[i] = {"index": i, "accepted": False, "error": "Invalid ppm or timestamp"}
+        
+        # Validate the whole batch in one pass
+        is_valid, messages = validate_readings(ppm_values)
+        
+        groups = {}
+        for i, item in enumerate(items):
+            if results[i] is not None:
+                continue
+            
+            device_id = item.get('device_id', 'default')
+            if not is_valid[i]:
+                logging.warning(f"Invalid reading from device {device_id}: {messages[i]}")
+                results[i] = {"index": i, "accepted": False, "error": messages[i]}
+                continue
+            groups.setdefault((device_id, item.get('gas_type')), []).append(i)
+        
+        # Classify each device's readings in time order, one array per device
+        gas_statuses = {}
+        anomalies = []
+        for (device_id, gas_type), indices in groups.items():
+            indices.sort(key=lambda i: timestamps[i])
+            epochs = to_epochs([timestamps[i] for i in indices])
+            labels = threshold_engine.classify_readings(device_id, ppm_values[indices], epochs, gas_type)
+            gas_statuses.update(zip(indices, labels))
+            for i, epoch in zip(indices, epochs.tolist()):
+                anomalies.extend(detect_anomalies(device_id, float(ppm_values[i]), epoch))
+        
+        entries = []
+        for i in sorted(gas_statuses):
+            device_id = items[i].get('device_id', 'default')
+            label = gas_statuses[i]
+            entries.append({
+                "device_id": device_id,
+                "ppm": float(ppm_values[i]),
+                "status": label,
+                "timestamp": timestamps[i],
+                "data": items[i]
+            })
+            results[i] = {"index": i, "accepted": True, "device_id": device_id, "status": label.lower()}
+        
+        # Commits the anomaly alerts with the readings
+        store_readings(entries)
+        publish_alerts(anomalies)
+        
+        return jsonify({
+            "success": True,
+            "accepted": len(entries),
+            "rejected": len(items) - len(entries),
+            "results": results
+        })
+    
+    except Exception as e:
+        db.session.rollback()
+        logging.error(f"Error processing sensor data batch: {str(e)}")
+        return jsonify({"error": str(e)}), 500
 
 # Update GSM SMS status
 @api_bp.route('/alerts/<int:alert_id>/sms-status', methods=['POST'])
 def update_sms_status(alert_id):
+    begin_write(db.session)
     alert = Alert.query.get_or_404(alert_id)
     data = request.json
     
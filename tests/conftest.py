@@ -0,0 +1,72 @@
+import os
+import shutil
+import tempfile
+
+import pytest
+
+from benchmarks.loadgen import ArduinoCloudStub
+
+# Local Arduino Cloud stand-in with a simulated round trip, so concurrent requests overlap
+STUB = ArduinoCloudStub(latency_ms=100)
+WORKDIR = tempfile.mkdtemp(prefix='gas-monitor-tests-')
+
+# Settings are read when the application modules are first imported, so they
+# are set here, before any test module is collected
+os.environ.update({
+    'DATABASE_URI': f"sqlite:///{os.path.join(WORKDIR, 'test.db')}",
+    'ARDUINO_API_URL': STUB.url,
+    'ARDUINO_CLIENT_ID': 'test',
+    'ARDUINO_CLIENT_SECRET': 'test',
+    'ARDUINO_THING_ID': 'test-thing',
+    'ARDUINO_THING_IDS': '',
+    'BACKFILL_ON_STARTUP': 'False',
+    'RETENTION_INTERVAL_HOURS': '0',
+    'ARCHIVE_DIR': os.path.join(WORKDIR, 'archive'),
+    'EXPORT_DIR': os.path.join(WORKDIR, 'exports'),
+    'ANOMALY_CHECKPOINT_PATH': os.path.join(WORKDIR, 'anomaly_state.json'),
+    'LEADER_LOCK_PATH': os.path.join(WORKDIR, 'leader.lock'),
+    'WEBHOOK_URLS': '',
+    'EMAIL_RECIPIENTS': ''
+})
+
+
+@pytest.fixture(scope='session')
+def arduino_stub():
+    STUB.start()
+    yield STUB
+    STUB.stop()
+    shutil.rmtree(WORKDIR, ignore_errors=True)
+
+
+@pytest.fixture(scope='session')
+def app_module(arduino_stub):
+    """
+    main imported against a fresh SQLite database and the stub, without background services
+    """
+    # The log file is written to the working directory
+    cwd = os.getcwd()
+    os.chdir(WORKDIR)
+    try:
+        import main
+        app = main.create_app(serve=False)
+        with app.app_context():
+            main.migrate()
+    finally:
+        os.chdir(cwd)
+    return main
+
+
+@pytest.fixture
+def app(app_module, monkeypatch):
+    """
+    The application with empty tables and an empty latest-state cache
+    """
+    from utils.latest_state import MemoryBackend
+
+    with app_module.app.app_context():
+        db = app_module.db
+        for table in reversed(db.metadata.sorted_tables):
+            db.session.execute(table.delete())
+        db.session.commit()
+    monkeypatch.setattr(app_module.latest_state, 'backend', MemoryBackend())
+    return app_module.app
@@ -0,0 +1,41 @@
+from datetime import datetime, timedelta
+
+import utils.ingest
+from models.gas_readings import Alert, GasReading, db
+from utils.anomaly import ANOMALY_LEVEL, AnomalyDetector, AnomalyFeed
+
+DEVICE = 'sensor-1'
+
+
+def test_leader_feed_raises_one_leak_onset_for_readings_posted_to_any_worker(app, app_module, monkeypatch):
+    detector = AnomalyDetector(checkpoint_path=None)
+    monkeypatch.setattr(app_module, 'anomaly_feed', AnomalyFeed(detector, GasReading, GasReading.gas_level))
+    monkeypatch.setattr(utils.ingest, 'MULTI_WORKER', True)
+    start = datetime.utcnow() - timedelta(hours=1)
+    with app.app_context():
+        # Stored before the leader was elected
+        db.session.add(GasReading(device_id=DEVICE, gas_level=500.0, status='Danger', timestamp=start))
+        db.session.commit()
+        assert app_module.feed_anomaly_detector() == []
+
+    # A steady baseline, then a leak, posted alternately through both ingest routes
+    client = app.test_client()
+    values = [10.0 + i % 3 for i in range(40)] + [25.0 + i for i in range(20)]
+    for i, ppm in enumerate(values):
+        if i % 2:
+            assert client.post('/api/sensor-data', json={"device_id": DEVICE, "ppm": ppm}).status_code == 200
+        else:
+            with app.app_context():
+                app_module.store_gas_reading({"device_id": DEVICE, "gas_level": ppm, "status": 'Safe'})
+
+    with app.app_context():
+        assert Alert.query.filter_by(level=ANOMALY_LEVEL).count() == 0
+        # A backfilled reading older than the detected ones is skipped
+        db.session.add(GasReading(device_id=DEVICE, gas_level=900.0, status='Danger', timestamp=start))
+        db.session.commit()
+
+        alerts = app_module.feed_anomaly_detector()
+
+        assert [alert.message.startswith('Possible leak') for alert in alerts] == [True]
+        assert Alert.query.filter_by(level=ANOMALY_LEVEL).count() == 1
+    assert detector.stats()["readings"] == len(values)
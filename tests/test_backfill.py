@@ -0,0 +1,30 @@
+from datetime import datetime, timedelta
+
+from utils.backfill import fetch_window
+
+START = datetime(2026, 3, 1)
+
+
+class CappedTimeseries:
+    """
+    Timeseries endpoint returning at most `cap` points per request, like Arduino Cloud's
+    """
+    def __init__(self, points, cap):
+        self.points = points
+        self.cap = cap
+        self.downloaded = 0
+
+    def get_property_timeseries(self, thing_id, property_id, start, end):
+        page = [point for point in self.points if start <= point[0] < end][:self.cap]
+        self.downloaded += len(page)
+        return page
+
+
+def test_fetch_window_downloads_each_point_once():
+    points = [(START + timedelta(seconds=10 * i), float(i)) for i in range(2500)]
+    api = CappedTimeseries(points, cap=1000)
+
+    fetched = fetch_window(api, 'thing', 'gaslevel-id', START, START + timedelta(days=1), page_size=1000)
+
+    assert fetched == points
+    assert api.downloaded == 2500
@@ -0,0 +1,72 @@
+import time
+import threading
+
+from utils.collector import AsyncCollector
+
+THINGS = 500
+
+
+class StubThings:
+    """
+    Stands in for Arduino Cloud: every fetch takes `latency` seconds
+    """
+    def __init__(self, latency=0.05):
+        self.latency = latency
+        self.polled = {}
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.stored = []
+        self.store_threads = set()
+        self._lock = threading.Lock()
+
+    def fetch(self, thing_id):
+        with self._lock:
+            self.polled.setdefault(thing_id, time.monotonic())
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            time.sleep(self.latency)
+            return {"thing_id": thing_id, "gas_level": 100, "status": "Safe"}
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+
+    def store(self, readings):
+        with self._lock:
+            self.stored.extend(readings)
+            self.store_threads.add(threading.current_thread().name)
+
+
+def wait_until(condition, timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.02)
+    return condition()
+
+
+def test_polls_500_things_concurrently_within_one_interval():
+    things = StubThings(latency=0.05)
+    thing_ids = [f'thing-{i}' for i in range(THINGS)]
+    interval, timeout = 2.0, 1.0
+    collector = AsyncCollector(
+        things.fetch, things.store, thing_ids, interval=interval, concurrency=50, timeout=timeout,
+        jitter=0.1, batch_size=100, flush_interval=0.1
+    )
+    started = time.monotonic()
+    collector.start()
+    try:
+        # First polls are spread over one interval; polled one at a time they would take 25 seconds
+        assert wait_until(lambda: len(things.polled) == THINGS, interval + timeout)
+        assert max(things.polled.values()) - started < interval + timeout
+        assert wait_until(lambda: len(things.stored) >= THINGS, 2)
+    finally:
+        collector.stop()
+
+    stats = collector.stats()
+    assert stats["timeouts"] == 0 and stats["failures"] == 0
+    assert 1 < things.max_in_flight <= 50
+    # Stores run on their own thread, never on one a hung fetch could hold
+    assert things.store_threads == {'collector-store_0'}
+
@@ -0,0 +1,33 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+REQUESTS = 100
+
+
+def test_concurrent_stale_requests_fetch_and_store_once(app, app_module, monkeypatch):
+    fetches = []
+    fetch_gas_reading = app_module.fetch_gas_reading
+
+    def counting_fetch(thing_id=None):
+        fetches.append(thing_id)
+        return fetch_gas_reading(thing_id)
+
+    monkeypatch.setattr(app_module, 'fetch_gas_reading', counting_fetch)
+    # Release every request at once so they all find the reading missing
+    start = threading.Barrier(REQUESTS)
+
+    def get_current_reading(_):
+        client = app.test_client()
+        start.wait()
+        return client.get('/api/current-reading')
+
+    with ThreadPoolExecutor(max_workers=REQUESTS) as pool:
+        responses = list(pool.map(get_current_reading, range(REQUESTS)))
+
+    assert [response.status_code for response in responses] == [200] * REQUESTS
+    assert all("stale" not in response.get_json() for response in responses)
+    assert len({response.get_json()["id"] for response in responses}) == 1
+    assert len(fetches) == 1
+
+    with app.app_context():
+        assert app_module.GasReading.query.filter_by(device_id='default').count() == 1
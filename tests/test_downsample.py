@@ -0,0 +1,22 @@
+import math
+from datetime import datetime, timedelta
+
+import pytest
+
+from utils.downsample import MAX_POINTS_LIMIT, choose_resolution
+
+END = datetime(2026, 3, 2, 12, 0)
+
+
+def test_resolution_never_yields_more_than_the_points_limit():
+    start = END - timedelta(days=30)
+    # 518.4 seconds rounds up to 519, so 30 days make 4995 buckets
+    smallest = math.ceil((END - start).total_seconds() / MAX_POINTS_LIMIT)
+
+    assert choose_resolution(start, END, resolution=1) == smallest
+    assert choose_resolution(start, END, resolution=1, max_points=10 * MAX_POINTS_LIMIT) == smallest
+    assert choose_resolution(start, END, resolution=86400) == 86400
+    assert choose_resolution(start, END, max_points=30) == 86400
+    assert choose_resolution(start, END) is None
+    with pytest.raises(ValueError):
+        choose_resolution(start, END, resolution=60, max_points=0)
@@ -0,0 +1,74 @@
+import socket
+import time
+
+import pytest
+from flask import Response
+
+from utils.event_hub import EventHub
+
+
+def read_until(sock, token, timeout=2):
+    sock.settimeout(timeout)
+    data = b''
+    while token not in data:
+        try:
+            chunk = sock.recv(65536)
+        except socket.timeout:
+            break
+        if not chunk:
+            break
+        data += chunk
+    return data
+
+
+def wait_until(condition, timeout=2):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+def test_handed_off_streams_are_written_by_the_broadcaster_for_their_device_only():
+    hub = EventHub(heartbeat_interval=0.2)
+    clients = []
+    for device_id in ('sensor-1', 'sensor-2'):
+        server_side, client_side = socket.socketpair()
+        subscription = hub.subscribe(device_id, detached=True)
+        response = Response(mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
+        # The request thread gives the connection away and is done with it
+        with pytest.raises(BrokenPipeError):
+            list(hub.hand_off(subscription, server_side, response))
+        server_side.close()
+        clients.append(client_side)
+
+    head = read_until(clients[0], b'retry: 3000\n\n')
+    assert head.startswith(b'HTTP/1.1 200 OK\r\n')
+    assert b'Content-Type: text/event-stream' in head and b'Connection: close' in head
+
+    hub.publish('reading', {"device_id": 'sensor-2', "gas_level": 300})
+    hub.publish('reading', {"device_id": 'sensor-1', "gas_level": 120})
+    hub.publish('alert_acknowledged', {"id": 7})
+    received = read_until(clients[0], b'"id": 7')
+    assert b'"gas_level": 120' in received and b'"gas_level": 300' not in received
+    assert b': heartbeat' in read_until(clients[0], b': heartbeat')
+
+    # A client that hangs up is closed and unsubscribed by the broadcaster
+    clients[0].close()
+    assert wait_until(lambda: hub.subscriber_count == 1)
+    assert b'"gas_level": 300' in read_until(clients[1], b'"gas_level": 300')
+    clients[1].close()
+    assert wait_until(lambda: hub.subscriber_count == 0)
+
+
+def test_thread_served_streams_skip_other_devices_events():
+    hub = EventHub(heartbeat_interval=0.05)
+    subscription = hub.subscribe('sensor-1')
+    stream = hub.stream(subscription)
+    assert next(stream) == "retry: 3000\n\n"
+
+    hub.publish('reading', {"device_id": 'sensor-2', "gas_level": 300})
+    hub.publish('reading', {"device_id": 'sensor-1', "gas_level": 120})
+    assert '"gas_level": 120' in next(stream)
+    assert next(stream) == ": heartbeat\n\n"
+    stream.close()
+    assert hub.subscriber_count == 0
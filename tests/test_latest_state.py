@@ -0,0 +1,130 @@
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+import pytest
+from sqlalchemy import event
+
+import utils.latest_state
+from models.gas_readings import GasReading, db
+from utils.latest_state import LATEST_STATE_TTL, LatestState
+
+
+class FakeTime:
+    """
+    Stands in for the time module in utils.latest_state; only moves when the test advances it
+    """
+    def __init__(self):
+        self.now = time.time()
+
+    def time(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+@pytest.fixture
+def fake_time(monkeypatch):
+    clock = FakeTime()
+    monkeypatch.setattr(utils.latest_state, 'time', clock)
+    return clock
+
+
+@contextmanager
+def count_queries(app):
+    """
+    Collect the SQL statements run on the application's engine inside the block
+    """
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    with app.app_context():
+        engine = db.engine
+    event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, 'before_cursor_execute', before_cursor_execute)
+
+
+def post_reading(client, ppm, device_id='sensor-1', **extra):
+    response = client.post('/api/sensor-data', json={"device_id": device_id, "ppm": ppm, **extra})
+    assert response.status_code == 200
+    return response.get_json()
+
+
+def test_ingest_writes_through_so_status_reads_skip_the_database(app):
+    client = app.test_client()
+    stored = post_reading(client, 120, battery_level=87)
+
+    with count_queries(app) as statements:
+        reading = client.get('/api/current-reading?device_id=sensor-1')
+        status = client.get('/api/system-status?device_id=sensor-1')
+
+    assert statements == []
+    assert reading.status_code == 200
+    assert reading.get_json()["id"] == stored["reading_id"]
+    assert reading.get_json()["gas_level"] == 120
+    assert status.status_code == 200
+    assert status.get_json()["battery_level"] == 87
+
+    post_reading(client, 140)
+    assert client.get('/api/current-reading?device_id=sensor-1').get_json()["gas_level"] == 140
+
+
+def test_unchanged_state_answers_conditional_requests_with_304(app):
+    client = app.test_client()
+    post_reading(client, 120)
+
+    first = client.get('/api/current-reading?device_id=sensor-1')
+    etag = first.headers['ETag']
+    assert first.headers['Last-Modified']
+    assert 'no-cache' in first.headers['Cache-Control']
+
+    not_modified = client.get('/api/current-reading?device_id=sensor-1', headers={'If-None-Match': etag})
+    assert not_modified.status_code == 304
+    assert not_modified.data == b''
+    assert not_modified.headers['ETag'] == etag
+
+    since = client.get(
+        '/api/current-reading?device_id=sensor-1', headers={'If-Modified-Since': first.headers['Last-Modified']}
+    )
+    assert since.status_code == 304
+
+    post_reading(client, 140)
+    changed = client.get('/api/current-reading?device_id=sensor-1', headers={'If-None-Match': etag})
+    assert changed.status_code == 200
+    assert changed.headers['ETag'] != etag
+    assert changed.get_json()["gas_level"] == 140
+
+
+def test_entries_expire_after_the_ttl_and_reload_from_the_database(app, fake_time):
+    client = app.test_client()
+    post_reading(client, 120)
+
+    # Another process stores a newer reading without updating this process's cache
+    with app.app_context():
+        db.session.add(GasReading(device_id='sensor-1', gas_level=300, status='Safe', timestamp=datetime.utcnow()))
+        db.session.commit()
+
+    fake_time.advance(LATEST_STATE_TTL - 1)
+    assert client.get('/api/current-reading?device_id=sensor-1').get_json()["gas_level"] == 120
+
+    fake_time.advance(2)
+    assert client.get('/api/current-reading?device_id=sensor-1').get_json()["gas_level"] == 300
+
+
+def test_older_writes_never_replace_a_newer_entry(fake_time):
+    state = LatestState(ttl=30)
+    newer = state.put('sensor-1', 'reading', {"gas_level": 140}, datetime(2026, 1, 1, 12, 0, 5))
+    state.put('sensor-1', 'reading', {"gas_level": 120}, datetime(2026, 1, 1, 12, 0, 0))
+
+    entry = state.get('sensor-1', 'reading')
+    assert entry["data"] == {"gas_level": 140}
+    assert entry["etag"] == newer["etag"]
+
+    fake_time.advance(31)
+    assert state.get('sensor-1', 'reading') is None
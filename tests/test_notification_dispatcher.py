@@ -0,0 +1,152 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from models.gas_readings import NotificationOutbox, db
+from utils.notification_service import COALESCED, FAILED, PENDING, SENT, NotificationDispatcher, RecordingHandler
+
+
+@pytest.fixture
+def make_dispatcher(app):
+    """
+    Build a dispatcher over the test outbox that delivers to a RecordingHandler; passes are driven by the test
+    """
+    dispatchers = []
+
+    def make(handler=None, recipients=('+100',), **kwargs):
+        handler = handler or RecordingHandler()
+        dispatcher = NotificationDispatcher(
+            app, NotificationOutbox, channels={"sms": (handler, list(recipients))}, workers=1, **kwargs
+        )
+        dispatchers.append(dispatcher)
+        return dispatcher, handler
+
+    yield make
+    for dispatcher in dispatchers:
+        dispatcher._pool.shutdown(wait=True)
+
+
+def enqueue(app, dispatcher, message, level='Warning'):
+    with app.app_context():
+        dispatcher.enqueue(db.session, None, level, message, {"gas_level": 450})
+        db.session.commit()
+
+
+def dispatch(app, dispatcher):
+    """
+    One dispatcher pass, waiting for the deliveries it submitted
+    """
+    with app.app_context():
+        dispatcher._dispatch()
+    # The single pool worker runs deliveries in order, so this returns once they are done
+    dispatcher._pool.submit(lambda: None).result()
+
+
+def make_due(app, dispatcher=None):
+    """
+    Move held and retried rows to now, and coalescing windows into the past, as if time had passed
+    """
+    with app.app_context():
+        NotificationOutbox.query.filter_by(status=PENDING).update(
+            {"next_attempt_at": datetime.utcnow() - timedelta(seconds=1)}, synchronize_session=False
+        )
+        db.session.commit()
+    if dispatcher is not None:
+        for key, sent_at in dispatcher._last_sent.items():
+            dispatcher._last_sent[key] = sent_at - timedelta(seconds=dispatcher.coalesce_seconds + 1)
+
+
+def statuses(app):
+    with app.app_context():
+        return [row.status for row in NotificationOutbox.query.order_by(NotificationOutbox.id)]
+
+
+def test_alerts_within_the_window_are_coalesced_into_one_message(app, make_dispatcher):
+    dispatcher, handler = make_dispatcher(coalesce_seconds=60, burst=10)
+
+    enqueue(app, dispatcher, 'first')
+    dispatch(app, dispatcher)
+    assert [message for _, _, message, _ in handler.sent] == ['first']
+
+    enqueue(app, dispatcher, 'second')
+    enqueue(app, dispatcher, 'third', level='Danger')
+    dispatch(app, dispatcher)
+    # Held until the window since the last message closes
+    assert len(handler.sent) == 1
+    with app.app_context():
+        held = NotificationOutbox.query.filter_by(status=PENDING).all()
+        assert len(held) == 2
+        assert all(row.next_attempt_at > datetime.utcnow() + timedelta(seconds=50) for row in held)
+
+    make_due(app, dispatcher)
+    dispatch(app, dispatcher)
+    assert len(handler.sent) == 2
+    recipient, level, message, payload = handler.sent[1]
+    assert recipient == '+100'
+    assert level == 'Danger'
+    assert message == '2 gas alerts:\nsecond\nthird'
+    assert payload == {"gas_level": 450}
+    assert statuses(app) == [SENT, COALESCED, SENT]
+    assert dispatcher.stats()["messages"] == 2
+    assert dispatcher.stats()["coalesced"] == 1
+
+
+def test_failed_delivery_is_retried_with_backoff_then_marked_failed(app, make_dispatcher):
+    dispatcher, handler = make_dispatcher(
+        RecordingHandler(fail_times=1), coalesce_seconds=0, burst=10, max_attempts=3
+    )
+
+    enqueue(app, dispatcher, 'leak')
+    dispatch(app, dispatcher)
+    assert handler.sent == []
+    with app.app_context():
+        row = NotificationOutbox.query.one()
+        assert (row.status, row.attempts) == (PENDING, 1)
+        assert row.next_attempt_at > datetime.utcnow()
+        assert 'Simulated delivery failure' in row.last_error
+
+    # Not due yet: the next pass leaves it alone
+    dispatch(app, dispatcher)
+    assert handler.sent == []
+
+    make_due(app)
+    dispatch(app, dispatcher)
+    assert [message for _, _, message, _ in handler.sent] == ['leak']
+    assert statuses(app) == [SENT]
+    assert dispatcher.stats()["retried"] == 1
+
+    handler.fail_times = 3
+    enqueue(app, dispatcher, 'unreachable')
+    for _ in range(3):
+        make_due(app)
+        dispatch(app, dispatcher)
+    assert statuses(app) == [SENT, FAILED]
+    assert dispatcher.stats()["failed"] == 1
+
+
+def test_each_recipient_has_its_own_token_bucket(app, make_dispatcher):
+    dispatcher, handler = make_dispatcher(
+        recipients=('+100', '+200'), coalesce_seconds=0, rate_per_hour=1, burst=2
+    )
+
+    enqueue(app, dispatcher, 'one')
+    dispatch(app, dispatcher)
+    enqueue(app, dispatcher, 'two')
+    dispatch(app, dispatcher)
+    assert sorted(recipient for recipient, _, _, _ in handler.sent) == ['+100', '+100', '+200', '+200']
+
+    # Both buckets are spent; a third alert waits about an hour for a token
+    enqueue(app, dispatcher, 'three')
+    dispatch(app, dispatcher)
+    assert len(handler.sent) == 4
+    with app.app_context():
+        held = NotificationOutbox.query.filter_by(status=PENDING).all()
+        assert sorted(row.recipient for row in held) == ['+100', '+200']
+        assert all(row.next_attempt_at > datetime.utcnow() + timedelta(minutes=30) for row in held)
+
+    # A recipient that has not spent its bucket is not held back by the others
+    dispatcher.register_handler('sms', handler, ['+100', '+200', '+300'])
+    enqueue(app, dispatcher, 'four')
+    dispatch(app, dispatcher)
+    assert handler.sent[-1][0] == '+300'
+    assert len(handler.sent) == 5
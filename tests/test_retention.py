@@ -0,0 +1,102 @@
+from datetime import datetime, timedelta
+
+import routes.api
+from models.gas_readings import Alert, GasReading, NotificationOutbox, ReadingRollup, db
+from utils.notification_service import PENDING, SENT
+from utils.rollups import RollupTracker
+
+DEVICE = 'sensor-1'
+
+
+def outbox_row(alert_id, status, created_at):
+    return NotificationOutbox(
+        alert_id=alert_id, channel='sms', recipient='+100', level='Warning', message='leak', status=status,
+        created_at=created_at, next_attempt_at=created_at
+    )
+
+
+def test_retention_prunes_finished_notifications_and_detaches_pruned_alerts(app, app_module):
+    old = datetime.utcnow() - timedelta(days=120)
+    with app.app_context():
+        alert = Alert(device_id=DEVICE, message='leak', level='Warning', timestamp=old, is_acknowledged=True)
+        db.session.add(alert)
+        db.session.flush()
+        db.session.add_all([
+            outbox_row(alert.id, SENT, old),
+            outbox_row(alert.id, PENDING, old),
+            outbox_row(None, SENT, datetime.utcnow())
+        ])
+        db.session.commit()
+
+        app_module.apply_retention()
+
+        assert Alert.query.count() == 0
+        remaining = NotificationOutbox.query.order_by(NotificationOutbox.id).all()
+        assert [(row.status, row.alert_id) for row in remaining] == [(PENDING, None), (SENT, None)]
+
+
+def test_rebuild_keeps_rollups_of_archived_days(app, app_module, monkeypatch):
+    now = datetime.utcnow().replace(microsecond=0)
+    day = datetime.combine((now - timedelta(days=10)).date(), datetime.min.time())
+    # The morning of the day is archived, the afternoon is still in the raw table
+    readings = [(day + timedelta(hours=hour), 100.0 + hour, 'Safe') for hour in range(24)]
+    readings += [(now - timedelta(minutes=minutes), 200.0, 'Safe') for minutes in (30, 20, 10)]
+    with app.app_context():
+        db.session.add_all(
+            GasReading(device_id=DEVICE, gas_level=value, status=status, timestamp=timestamp)
+            for timestamp, value, status in readings
+        )
+        RollupTracker(shared=True).record(db.session, ReadingRollup, DEVICE, *zip(*readings))
+        db.session.commit()
+
+    monkeypatch.setattr(app_module, 'retention_cutoff', lambda device_id: day + timedelta(hours=12))
+    with app.app_context():
+        app_module.apply_retention()
+        assert GasReading.query.filter(GasReading.timestamp < day + timedelta(days=1)).count() == 12
+
+        app_module.rebuild_device_rollups(DEVICE)
+
+        daily = ReadingRollup.query.filter_by(device_id=DEVICE, granularity=86400, bucket_start=day).one()
+        assert daily.count == 24
+        recent = ReadingRollup.query.filter(
+            ReadingRollup.granularity == 86400, ReadingRollup.bucket_start > day
+        ).all()
+        assert sum(row.count for row in recent) == 3
+
+
+def test_history_pages_include_archived_readings(app, app_module, monkeypatch):
+    device_id = 'sensor-archived'
+    now = datetime.utcnow().replace(microsecond=0)
+    with app.app_context():
+        db.session.add_all(
+            GasReading(device_id=device_id, gas_level=100.0 + hours, status='Safe',
+                       timestamp=now - timedelta(hours=hours + 0.5))
+            for hours in range(6)
+        )
+        db.session.commit()
+
+    cutoff = now - timedelta(hours=3)
+    monkeypatch.setattr(app_module, 'retention_cutoff', lambda device_id: cutoff)
+    monkeypatch.setattr(routes.api, 'retention_cutoff', lambda device_id: cutoff)
+    with app.app_context():
+        app_module.apply_retention()
+        assert GasReading.query.filter_by(device_id=device_id).count() == 3
+
+    client = app.test_client()
+
+    def pages(path, limit):
+        items, cursor = [], ''
+        while cursor is not None:
+            page = client.get(f'{path}?device_id={device_id}&hours=7&limit={limit}&cursor={cursor}').get_json()
+            items.extend(page["items"])
+            cursor = page["next_cursor"]
+        return items
+
+    newest_first = pages('/api/gas_readings', 2)
+    assert [item["gas_level"] for item in newest_first] == [100.0 + hours for hours in range(6)]
+    oldest_first = pages('/api/gas-readings', 4)
+    assert [item["ppm"] for item in oldest_first] == [105.0 - hours for hours in range(6)]
+
+    rows = client.get(f'/api/gas_readings?device_id={device_id}&hours=7').get_json()
+    assert len(rows) == 6
+    assert all(row.keys() == rows[0].keys() for row in rows)
@@ -0,0 +1,94 @@
+from datetime import datetime, timedelta
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from models.gas_readings import GasReading, ReadingRollup, db
+from utils.downsample import query_buckets
+from utils.rollups import RollupTracker, query_rollup_buckets
+
+DEVICE = 'sensor-1'
+
+
+def add_readings(start, minutes, every=timedelta(minutes=1)):
+    readings = [(start + every * i, 100 + i % 50, 'Safe') for i in range(minutes)]
+    db.session.add_all(
+        GasReading(device_id=DEVICE, gas_level=gas_level, status=status, timestamp=timestamp)
+        for timestamp, gas_level, status in readings
+    )
+    db.session.commit()
+    return readings
+
+
+def raw_buckets(resolution, lo, hi):
+    return query_buckets(
+        db.session, GasReading.timestamp, GasReading.gas_level, GasReading.id,
+        [GasReading.device_id == DEVICE, GasReading.timestamp >= lo, GasReading.timestamp < hi], resolution
+    )
+
+
+def comparable(buckets):
+    return [(bucket["start"], bucket["count"], bucket["min"], bucket["max"], round(bucket["avg"], 6), bucket["last"])
+            for bucket in buckets]
+
+
+def test_readings_outside_rollup_coverage_come_from_raw_rows(app):
+    end = datetime(2026, 3, 2, 12, 0)
+    start = end - timedelta(hours=6)
+    with app.app_context():
+        # Stored before rollups existed, rolled up, then stored but not yet rolled up
+        add_readings(start, 130)
+        rolled = add_readings(start + timedelta(minutes=130), 150)
+        add_readings(start + timedelta(minutes=280), 70)
+        RollupTracker(shared=True).record(db.session, ReadingRollup, DEVICE, *zip(*rolled))
+        db.session.commit()
+
+        def fallback(lo, hi):
+            return raw_buckets(3600, lo, hi)
+
+        without_fallback = query_rollup_buckets(db.session, ReadingRollup, DEVICE, start, end, 3600)
+        buckets = query_rollup_buckets(db.session, ReadingRollup, DEVICE, start, end, 3600, fallback)
+        expected = raw_buckets(3600, start, end)
+
+    assert sum(bucket["count"] for bucket in without_fallback) == 150
+    assert comparable(buckets) == comparable(expected)
+    assert sum(bucket["count"] for bucket in buckets) == 350
+
+
+def test_rebuild_commits_one_transaction_per_day(app, app_module):
+    start = datetime(2026, 3, 1, 18, 0)
+    with app.app_context():
+        add_readings(start, 3 * 24 * 6, every=timedelta(minutes=10))
+        commits = []
+
+        def after_commit(session):
+            commits.append(session)
+
+        event.listen(Session, 'after_commit', after_commit)
+        try:
+            total = app_module.rebuild_device_rollups(DEVICE)
+        finally:
+            event.remove(Session, 'after_commit', after_commit)
+
+        rebuilt = query_rollup_buckets(db.session, ReadingRollup, DEVICE, start, start + timedelta(days=3), 3600)
+        expected = raw_buckets(3600, start, start + timedelta(days=3))
+
+    assert total == 3 * 24 * 6
+    # 18:00 on day one to 17:50 on day four spans four calendar days
+    assert len(commits) == 4
+    assert comparable(rebuilt) == comparable(expected)
+
+
+def test_both_history_routes_include_readings_outside_rollup_coverage(app):
+    start = datetime.utcnow().replace(second=0, microsecond=0) - timedelta(hours=4)
+    with app.app_context():
+        # 120 readings stored before the rollups existed, then 60 rolled up
+        add_readings(start, 120)
+        rolled = add_readings(start + timedelta(minutes=120), 60)
+        RollupTracker(shared=True).record(db.session, ReadingRollup, DEVICE, *zip(*rolled))
+        db.session.commit()
+
+    client = app.test_client()
+    for path in ('/api/gas-readings', '/api/gas_readings'):
+        buckets = client.get(f'{path}?device_id={DEVICE}&resolution=1h').get_json()
+        assert sum(bucket["count"] for bucket in buckets) == 180, path
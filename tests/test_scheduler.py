@@ -0,0 +1,91 @@
+from utils.scheduler import AdaptiveScheduler, TokenBucket
+
+
+class FakeClock:
+    """
+    Monotonic clock that only moves when the test advances it
+    """
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+def test_token_bucket_spends_burst_then_refills_at_rate():
+    clock = FakeClock()
+    bucket = TokenBucket(rate=2, burst=3, clock=clock)
+
+    assert [bucket.acquire() for _ in range(3)] == [0.0, 0.0, 0.0]
+    assert bucket.acquire() == 0.5
+
+    clock.advance(0.5)
+    assert bucket.acquire() == 0.0
+    assert bucket.acquire() == 0.5
+
+
+def test_token_bucket_reserve_queues_behind_earlier_reservations():
+    clock = FakeClock()
+    bucket = TokenBucket(rate=1, burst=1, clock=clock)
+
+    assert bucket.reserve() == 0.0
+    assert bucket.reserve() == 1.0
+    assert bucket.reserve() == 2.0
+
+    clock.advance(2)
+    assert bucket.acquire() == 1.0
+
+
+def test_scheduler_acquire_refuses_without_waiting_and_counts_it():
+    clock = FakeClock()
+    scheduler = AdaptiveScheduler(rate_limit=1, burst=1, clock=clock)
+
+    assert scheduler.acquire() == 0.0
+    assert scheduler.acquire() == 1.0
+    assert scheduler.stats()["rate_limit_refused"] == 1
+
+    clock.advance(1)
+    assert scheduler.acquire() == 0.0
+
+
+def test_scheduler_on_demand_and_polls_share_one_budget():
+    clock = FakeClock()
+    scheduler = AdaptiveScheduler(rate_limit=1, burst=2, clock=clock)
+
+    assert scheduler.reserve() == 0.0
+    assert scheduler.acquire() == 0.0
+    # The poll that follows waits for the token the on-demand refresh took
+    assert scheduler.reserve() == 1.0
+    assert scheduler.stats()["rate_limited"] == 1
+
+
+def test_scheduler_backs_off_flat_safe_readings_and_snaps_back_on_danger():
+    clock = FakeClock()
+    scheduler = AdaptiveScheduler(
+        min_interval=5, base_interval=60, max_interval=300, backoff=2, flat_slope=0.5, clock=clock
+    )
+
+    intervals = []
+    for _ in range(5):
+        intervals.append(scheduler.observe('thing', 100, 'Safe'))
+        clock.advance(intervals[-1])
+    assert intervals == [120, 240, 300, 300, 300]
+    assert scheduler.interval('thing') == 300
+
+    assert scheduler.observe('thing', 100, 'Danger') == 5
+    assert scheduler.interval('thing') == 5
+    assert scheduler.interval('other') == 60
+
+
+def test_scheduler_polls_steep_rise_at_minimum_interval():
+    clock = FakeClock()
+    scheduler = AdaptiveScheduler(min_interval=5, base_interval=60, steep_slope=5, clock=clock)
+
+    scheduler.observe('thing', 100, 'Safe')
+    clock.advance(60)
+    # 10 PPM in a minute is steep even though the reading is still Safe
+    assert scheduler.observe('thing', 110, 'Safe') == 5
+    assert scheduler.stats()["decisions"]["steep"] == 1
@@ -0,0 +1,47 @@
+import pytest
+
+from models.gas_readings import GasReading, ReadingRollup, SystemStatus
+
+
+@pytest.fixture
+def sync(app, monkeypatch):
+    import utils.sync_arduino_data as sync
+
+    monkeypatch.setattr(sync, 'read_last_values', lambda api, thing_id, properties: {
+        "gas_level": 150.0, "battery_level": 80, "device_status": "online"
+    })
+    return sync
+
+
+def test_standalone_sync_runs_readings_through_the_anomaly_detector(app, app_module, sync, monkeypatch):
+    updates = []
+    update = app_module.anomaly_detector.update
+
+    def recording_update(device_id, value, epoch):
+        updates.append((device_id, value))
+        return update(device_id, value, epoch)
+
+    monkeypatch.setattr(app_module.anomaly_detector, 'update', recording_update)
+
+    assert sync.sync_data_from_arduino_cloud('test-thing')
+
+    device_id = 'arduino_cloud_test-thi'
+    assert updates == [(device_id, 150.0)]
+    with app.app_context():
+        reading = GasReading.query.filter_by(device_id=device_id).one()
+        assert reading.gas_level == 150.0
+        assert ReadingRollup.query.filter_by(device_id=device_id).count() == 3
+        assert SystemStatus.query.filter_by(device_id=device_id).one().battery_level == 80
+
+
+def test_failed_status_update_leaves_no_reading_behind(app, sync, monkeypatch):
+    def failing_update(device_id, values):
+        raise RuntimeError('database is locked')
+
+    monkeypatch.setattr(sync, 'update_system_status', failing_update)
+
+    assert not sync.sync_data_from_arduino_cloud('test-thing')
+
+    with app.app_context():
+        assert GasReading.query.count() == 0
+        assert ReadingRollup.query.count() == 0
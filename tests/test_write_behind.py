@@ -0,0 +1,64 @@
+import json
+from datetime import datetime
+
+from utils.write_behind import WriteBehindQueue
+
+
+class FlakyStore:
+    """
+    Flush function that fails its first `fail_times` calls
+    """
+    def __init__(self, fail_times=0):
+        self.fail_times = fail_times
+        self.written = []
+
+    def __call__(self, items):
+        if self.fail_times:
+            self.fail_times -= 1
+            raise RuntimeError('database is locked')
+        self.written.extend(items)
+
+
+def drain(ingest_queue, items, flush_fns=None):
+    for item, flush_fn in zip(items, flush_fns or [None] * len(items)):
+        assert ingest_queue.put(item, flush_fn)
+    ingest_queue.stop()
+
+
+def test_failed_flush_is_retried_with_backoff(tmp_path):
+    store = FlakyStore(fail_times=2)
+    ingest_queue = WriteBehindQueue(
+        store, max_delay_ms=10, backoff_ms=1, retries=3, dead_letter_path=str(tmp_path / 'dead.jsonl')
+    ).start()
+    drain(ingest_queue, [{"gas_level": 120}, {"gas_level": 130}])
+
+    assert store.written == [{"gas_level": 120}, {"gas_level": 130}]
+    stats = ingest_queue.stats()
+    assert (stats["flushed"], stats["retried"], stats["failed"]) == (2, 2, 0)
+    assert not (tmp_path / 'dead.jsonl').exists()
+
+
+def test_batches_failing_every_retry_go_to_the_dead_letter_file(tmp_path):
+    store = FlakyStore(fail_times=100)
+    dead_letter = tmp_path / 'spool' / 'dead.jsonl'
+    ingest_queue = WriteBehindQueue(
+        store, max_delay_ms=10, backoff_ms=1, retries=2, dead_letter_path=str(dead_letter)
+    ).start()
+    timestamp = datetime(2026, 3, 1, 12, 0)
+    drain(ingest_queue, [{"gas_level": 120, "timestamp": timestamp}])
+
+    stats = ingest_queue.stats()
+    assert (stats["flushed"], stats["retried"], stats["failed"], stats["dead_lettered"]) == (0, 2, 1, 1)
+    lines = [json.loads(line) for line in dead_letter.read_text().splitlines()]
+    assert lines == [{"flush": "FlakyStore", "item": {"gas_level": 120, "timestamp": "2026-03-01 12:00:00"}}]
+
+
+def test_items_are_written_by_the_flush_function_they_were_queued_with(tmp_path):
+    readings, device_readings = FlakyStore(), FlakyStore()
+    ingest_queue = WriteBehindQueue(
+        readings, max_delay_ms=50, dead_letter_path=str(tmp_path / 'dead.jsonl')
+    ).start()
+    drain(ingest_queue, [{"gas_level": 1}, {"ppm": 2}, {"gas_level": 3}], [None, device_readings, None])
+
+    assert readings.written == [{"gas_level": 1}, {"gas_level": 3}]
+    assert device_readings.written == [{"ppm": 2}]
@@ -0,0 +1,172 @@
+import os
+import time
+import logging
+import threading
+
+from sqlalchemy import func
+
+from utils.leader import MULTI_WORKER
+from utils.metrics import ALERTS_CREATED
+
+logger = logging.getLogger(__name__)
+
+# Seconds between database writes for an open episode; opening and closing are written immediately
+ALERT_EPISODE_FLUSH_SECONDS = float(os.getenv('ALERT_EPISODE_FLUSH_SECONDS', 10))
+
+ALERT_LEVELS = ('warning', 'danger')
+
+
+class Episode:
+    """
+    In-memory state of one open alert
+    """
+    __slots__ = ('alert_id', 'peak', 'last_seen', 'count', 'flushed_at')
+
+    def __init__(self, alert_id, peak, last_seen, count, flushed_at):
+        self.alert_id = alert_id
+        self.peak = peak
+        self.last_seen = last_seen
+        self.count = count
+        self.flushed_at = flushed_at
+
+
+class AlertEpisodes:
+    """
+    Index of open alert episodes, one per (device, level).
+
+    A Warning or Danger reading opens an alert for its device and level, or
+    updates the open one in place (peak value, last seen, sample count). A
+    Safe reading closes the device's open alerts. The index lives in memory,
+    so deciding whether to open an alert never queries the database, and
+    in-place updates are written at most every flush_seconds per episode.
+
+    The alert model needs device_id, level, message, timestamp, peak_value,
+    last_seen, sample_count and closed_at columns; is_active is cleared on
+    close if the model has it.
+
+    With shared=True, other processes may ingest readings for the same
+    devices. Before opening an alert the index then adopts an episode another
+    process already opened, and Safe readings also close other processes'
+    episodes in the database, at most every flush_seconds per device.
+    """
+    def __init__(self, flush_seconds=ALERT_EPISODE_FLUSH_SECONDS, shared=MULTI_WORKER):
+        self.flush_seconds = flush_seconds
+        self.shared = shared
+        self._open = {}
+        self._closed_checked = {}
+        self._loaded = False
+        self._lock = threading.Lock()
+
+    def _load(self, session, model):
+        # Rows without last_seen predate episodes and are never reopened
+        rows = session.query(
+            model.id, model.device_id, model.level, model.peak_value, model.last_seen, model.sample_count
+        ).filter(model.closed_at.is_(None), model.last_seen.isnot(None)).order_by(model.timestamp).all()
+        now = time.monotonic()
+        for alert_id, device_id, level, peak, last_seen, count in rows:
+            self._open[(device_id, level.lower())] = Episode(alert_id, peak, last_seen, count or 1, now)
+        self._loaded = True
+        logger.info(f"Loaded {len(self._open)} open alert episodes")
+
+    def _write(self, session, model, episode, **values):
+        # A closed alert is never extended, whoever closed it
+        updated = session.query(model).filter(model.id == episode.alert_id, model.closed_at.is_(None)).update({
+            model.peak_value: episode.peak,
+            model.last_seen: episode.last_seen,
+            model.sample_count: episode.count,
+            **{getattr(model, key): value for key, value in values.items()}
+        }, synchronize_session=False)
+        episode.flushed_at = time.monotonic()
+        return updated
+
+    def observe(self, session, model, device_id, status, value, timestamp, message):
+        """
+        Fold one reading into its device's episodes within the caller's transaction.
+
+        message(level, value) builds the text of a newly opened alert. Returns
+        the newly opened alert, or None if the reading opened nothing.
+        """
+        level = str(status).lower()
+        with self._lock:
+            if not self._loaded:
+                self._load(session, model)
+
+            if level not in ALERT_LEVELS:
+                self._close(session, model, device_id, timestamp)
+                return None
+
+            episode = self._open.get((device_id, level))
+            if episode is not None:
+                episode.peak = max(episode.peak, value)
+                episode.last_seen = max(episode.last_seen, timestamp)
+                episode.count += 1
+                if time.monotonic() - episode.flushed_at < self.flush_seconds:
+                    return None
+                if self._write(session, model, episode):
+                    return None
+                # The alert was closed elsewhere, deleted or its opening transaction rolled back; open a new one
+                del self._open[(device_id, level)]
+
+            if self.shared and self._adopt(session, model, device_id, level, value, timestamp):
+                return None
+
+            alert = model(
+                device_id=device_id,
+                level=status,
+                message=message(status, value),
+                timestamp=timestamp,
+                peak_value=value,
+                last_seen=timestamp,
+                sample_count=1
+            )
+            session.add(alert)
+            session.flush()  # Assigns the alert ID; committed with the reading
+            self._open[(device_id, level)] = Episode(alert.id, value, timestamp, 1, time.monotonic())
+            ALERTS_CREATED.inc(level=status)
+            return alert
+
+    def _adopt(self, session, model, device_id, level, value, timestamp):
+        """
+        Take over an episode for (device, level) that another process opened
+        """
+        row = session.query(model.id, model.peak_value, model.last_seen, model.sample_count).filter(
+            model.device_id == device_id, func.lower(model.level) == level,
+            model.closed_at.is_(None), model.last_seen.isnot(None)
+        ).order_by(model.timestamp.desc()).first()
+        if row is None:
+            return False
+        alert_id, peak, last_seen, count = row
+        episode = Episode(alert_id, max(peak or value, value), max(last_seen, timestamp), (count or 1) + 1, 0.0)
+        self._write(session, model, episode)
+        self._open[(device_id, level)] = episode
+        return True
+
+    def _close(self, session, model, device_id, timestamp):
+        for level in ALERT_LEVELS:
+            episode = self._open.get((device_id, level))
+            # A late Safe reading (e.g. flushed from the write-behind queue) does not close a newer episode
+            if episode is None or episode.last_seen > timestamp:
+                continue
+            del self._open[(device_id, level)]
+            values = {"closed_at": timestamp}
+            if hasattr(model, 'is_active'):
+                values["is_active"] = False
+            self._write(session, model, episode, **values)
+
+        if self.shared:
+            # Episodes opened by other processes
+            now = time.monotonic()
+            if now - self._closed_checked.get(device_id, 0.0) < self.flush_seconds:
+                return
+            self._closed_checked[device_id] = now
+            values = {model.closed_at: timestamp}
+            if hasattr(model, 'is_active'):
+                values[model.is_active] = False
+            session.query(model).filter(
+                model.device_id == device_id, func.lower(model.level).in_(ALERT_LEVELS),
+                model.closed_at.is_(None), model.last_seen.isnot(None), model.last_seen <= timestamp
+            ).update(values, synchronize_session=False)
+
+
+# Shared index for the ingest paths in this process
+alert_episodes = AlertEpisodes()
@@ -0,0 +1,378 @@
+import os
+import json
+import math
+import time
+import atexit
+import logging
+import threading
+from datetime import datetime
+
+from sqlalchemy import func
+
+from utils.metrics import ALERTS_CREATED
+
+logger = logging.getLogger(__name__)
+
+EPOCH = datetime(1970, 1, 1)
+
+# Baseline EWMA time constant in minutes, and readings before detection starts
+ANOMALY_BASELINE_MINUTES = float(os.getenv('ANOMALY_BASELINE_MINUTES', 60))
+ANOMALY_WARMUP = int(os.getenv('ANOMALY_WARMUP', 20))
+# Standard deviation floor in PPM so a perfectly quiet sensor does not alarm on noise
+ANOMALY_MIN_SD = float(os.getenv('ANOMALY_MIN_SD', 1.0))
+# CUSUM slack and decision threshold, in standard deviations. The defaults keep
+# false alarms to well under one per device-year at one reading every 5 seconds.
+ANOMALY_CUSUM_K = float(os.getenv('ANOMALY_CUSUM_K', 1.0))
+ANOMALY_CUSUM_H = float(os.getenv('ANOMALY_CUSUM_H', 10))
+# Sustained rise in PPM per minute treated as a leak onset, and the smoothing time constant in seconds
+ANOMALY_RISE_PER_MIN = float(os.getenv('ANOMALY_RISE_PER_MIN', 2))
+ANOMALY_RATE_TAU = float(os.getenv('ANOMALY_RATE_TAU', 60))
+# A single reading this many standard deviations from both the baseline and its neighbours is a spike
+ANOMALY_SPIKE_SIGMA = float(os.getenv('ANOMALY_SPIKE_SIGMA', 6))
+# Identical consecutive readings reported as a stuck sensor
+ANOMALY_STUCK_COUNT = int(os.getenv('ANOMALY_STUCK_COUNT', 30))
+# Gap between readings reported as a dropout; keep above the longest collector poll interval
+ANOMALY_DROPOUT_SECONDS = float(os.getenv('ANOMALY_DROPOUT_SECONDS', 900))
+ANOMALY_CHECKPOINT_PATH = os.getenv('ANOMALY_CHECKPOINT_PATH', 'data/anomaly_state.json')
+ANOMALY_CHECKPOINT_SECONDS = float(os.getenv('ANOMALY_CHECKPOINT_SECONDS', 60))
+# Seconds between the leader's scans for new readings, and readings per scan, when several workers ingest
+ANOMALY_FEED_SECONDS = float(os.getenv('ANOMALY_FEED_SECONDS', 2))
+ANOMALY_FEED_BATCH = int(os.getenv('ANOMALY_FEED_BATCH', 1000))
+
+ANOMALY_KINDS = ("leak_onset", "spike", "stuck", "dropout")
+# Alert level for detector events
+ANOMALY_LEVEL = "Anomaly"
+
+
+class DeviceState:
+    """
+    Constant-size detector state for one device
+    """
+    __slots__ = ('count', 'mean', 'var', 'cusum', 'fast', 'rate', 'last_value', 'last_epoch',
+                 'same', 'onset', 'pending_spike')
+
+    def __init__(self, count=0, mean=0.0, var=0.0, cusum=0.0, fast=0.0, rate=0.0, last_value=0.0,
+                 last_epoch=0.0, same=0, onset=False, pending_spike=None):
+        self.count = count
+        self.mean = mean
+        self.var = var
+        self.cusum = cusum
+        self.fast = fast
+        self.rate = rate
+        self.last_value = last_value
+        self.last_epoch = last_epoch
+        self.same = same
+        self.onset = onset
+        self.pending_spike = pending_spike  # (value, epoch) awaiting the next reading
+
+    def to_list(self):
+        return [getattr(self, name) for name in self.__slots__]
+
+
+class AnomalyDetector:
+    """
+    Streaming per-device leak-onset and sensor-fault detector.
+
+    Each reading updates an EWMA baseline and variance, an upper CUSUM of
+    deviations from the baseline and a smoothed rate of rise, all in O(1)
+    time and memory per device. The baseline and rate are weighted by the
+    time since the previous reading, so they behave the same however often
+    a device reports. Events:
+    - leak_onset: the CUSUM crosses cusum_h standard deviations, or the level
+      rises faster than rise_per_min while above the baseline. The baseline
+      is frozen until readings return to it and the CUSUM drains to zero, so
+      a slow leak is not absorbed into it; the event re-arms only then.
+    - spike: one reading far from both the baseline and the readings either
+      side of it. It is confirmed by the next reading and kept out of the
+      baseline; if the next reading is also far off, it is a level shift and
+      left to the CUSUM.
+    - stuck: stuck_count identical readings in a row.
+    - dropout: a gap longer than dropout_seconds before a reading.
+
+    Readings must arrive in time order per device, so historical backfills
+    bypass the detector. State is checkpointed to a JSON file at most every
+    checkpoint_seconds and restored on start.
+    """
+    def __init__(self, baseline_minutes=ANOMALY_BASELINE_MINUTES, warmup=ANOMALY_WARMUP, min_sd=ANOMALY_MIN_SD,
+                 cusum_k=ANOMALY_CUSUM_K, cusum_h=ANOMALY_CUSUM_H, rise_per_min=ANOMALY_RISE_PER_MIN,
+                 rate_tau=ANOMALY_RATE_TAU, spike_sigma=ANOMALY_SPIKE_SIGMA, stuck_count=ANOMALY_STUCK_COUNT,
+                 dropout_seconds=ANOMALY_DROPOUT_SECONDS, checkpoint_path=ANOMALY_CHECKPOINT_PATH,
+                 checkpoint_seconds=ANOMALY_CHECKPOINT_SECONDS):
+        self.baseline_tau = baseline_minutes * 60
+        self.warmup = warmup
+        self.min_var = min_sd * min_sd
+        self.cusum_k = cusum_k
+        self.cusum_h = cusum_h
+        self.rise_per_min = rise_per_min
+        self.rate_tau = rate_tau
+        self.spike_sigma = spike_sigma
+        self.stuck_count = stuck_count
+        self.dropout_seconds = dropout_seconds
+        self.checkpoint_path = checkpoint_path
+        self.checkpoint_seconds = checkpoint_seconds
+        self._states = {}
+        self._lock = threading.Lock()
+        self._checkpointed_at = time.monotonic()
+        self._events = dict.fromkeys(ANOMALY_KINDS, 0)
+        self._readings = 0
+        self._dirty = False
+        self.restore()
+
+    def update(self, device_id, value, epoch):
+        """
+        Fold one reading into its device's state and return the list of events it raised
+        """
+        with self._lock:
+            events = self._update(device_id, float(value), epoch)
+            self._readings += 1
+            self._dirty = True
+            for event in events:
+                self._events[event["kind"]] += 1
+        if self.checkpoint_path and time.monotonic() - self._checkpointed_at >= self.checkpoint_seconds:
+            self.checkpoint()
+        return events
+
+    def _event(self, kind, device_id, value, epoch, message):
+        return {"kind": kind, "device_id": device_id, "value": value, "epoch": epoch, "message": message}
+
+    def _update(self, device_id, value, epoch):
+        state = self._states.get(device_id)
+        if state is None:
+            state = self._states[device_id] = DeviceState(mean=value, fast=value, last_value=value, last_epoch=epoch)
+        events = []
+
+        dt = epoch - state.last_epoch
+        if state.count and dt > self.dropout_seconds:
+            events.append(self._event(
+                "dropout", device_id, value, epoch, f"No readings from {device_id} for {dt / 60:.0f} minutes"
+            ))
+            # The rate estimate does not span the gap
+            state.fast = value
+            state.rate = 0.0
+            state.pending_spike = None
+
+        state.count += 1
+        sd = math.sqrt(max(state.var, self.min_var))
+        deviation = value - state.mean
+        detecting = state.count > self.warmup
+
+        pending = state.pending_spike
+        if pending is not None:
+            state.pending_spike = None
+            if abs(deviation) <= self.spike_sigma * sd:
+                events.append(self._event(
+                    "spike", device_id, pending[0], pending[1],
+                    f"Isolated {pending[0]:g} PPM spike from {device_id} against a {state.mean:.1f} PPM baseline"
+                ))
+        elif detecting and abs(deviation) > self.spike_sigma * sd \
+                and abs(value - state.last_value) > self.spike_sigma * sd:
+            # Hold the reading back until the next one shows whether it was a spike or a level shift
+            state.pending_spike = (value, epoch)
+            state.last_epoch = epoch
+            return events
+
+        if value == state.last_value:
+            state.same += 1
+            if state.same == self.stuck_count:
+                events.append(self._event(
+                    "stuck", device_id, value, epoch,
+                    f"Sensor on {device_id} reported {value:g} PPM {self.stuck_count + 1} times in a row"
+                ))
+        else:
+            state.same = 0
+
+        # Time-aware smoothing so the rate does not depend on the reporting interval
+        if dt > 0:
+            weight = 1.0 - math.exp(-dt / self.rate_tau)
+            previous_fast = state.fast
+            state.fast += weight * (value - state.fast)
+            state.rate += weight * ((state.fast - previous_fast) / dt * 60.0 - state.rate)
+
+        state.cusum = max(0.0, state.cusum + deviation - self.cusum_k * sd)
+        if detecting and not state.onset:
+            if state.cusum > self.cusum_h * sd:
+                reason = f"drifted {deviation:+.1f} PPM above its {state.mean:.1f} PPM baseline"
+            elif state.rate > self.rise_per_min and deviation > self.cusum_k * sd:
+                reason = f"rising {state.rate:.1f} PPM/min"
+            else:
+                reason = None
+            if reason:
+                state.onset = True
+                events.append(self._event(
+                    "leak_onset", device_id, value, epoch, f"Possible leak on {device_id}: {value:g} PPM, {reason}"
+                ))
+        elif state.onset:
+            # Cap the sum so it drains within a few readings once the level is back at the baseline
+            state.cusum = min(state.cusum, self.cusum_h * sd)
+            if state.cusum == 0.0:
+                state.onset = False
+
+        if not state.onset:
+            weight = max(1.0 - math.exp(-max(dt, 0.0) / self.baseline_tau), 1.0 / state.count)
+            state.mean += weight * deviation
+            state.var = (1.0 - weight) * (state.var + weight * deviation * deviation)
+
+        state.last_value = value
+        state.last_epoch = epoch
+        return events
+
+    def checkpoint(self):
+        """
+        Write every device's state to the checkpoint file atomically, if it changed.
+        Devices another process saved more recently are kept from the existing file.
+        """
+        with self._lock:
+            if not self._dirty:
+                return
+            self._dirty = False
+            snapshot = {device_id: state.to_list() for device_id, state in self._states.items()}
+            self._checkpointed_at = time.monotonic()
+        try:
+            directory = os.path.dirname(self.checkpoint_path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            snapshot = self._merge_saved(snapshot)
+            tmp_path = f'{self.checkpoint_path}.{os.getpid()}.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump({"version": 1, "fields": DeviceState.__slots__, "devices": snapshot}, f)
+            os.replace(tmp_path, self.checkpoint_path)
+        except OSError as e:
+            logger.error(f"Failed to checkpoint anomaly detector state: {e}")
+
+    def _merge_saved(self, snapshot):
+        if not os.path.exists(self.checkpoint_path):
+            return snapshot
+        try:
+            with open(self.checkpoint_path) as f:
+                saved = json.load(f)
+            last_epoch = saved["fields"].index("last_epoch")
+        except (OSError, ValueError, KeyError) as e:
+            logger.error(f"Overwriting unreadable anomaly detector checkpoint: {e}")
+            return snapshot
+        ours = DeviceState.__slots__.index("last_epoch")
+        for device_id, values in saved["devices"].items():
+            current = snapshot.get(device_id)
+            if current is None or (values[last_epoch] or 0) > (current[ours] or 0):
+                saved_state = dict(zip(saved["fields"], values))
+                snapshot[device_id] = DeviceState(**saved_state).to_list()
+        return snapshot
+
+    def restore(self):
+        """
+        Load device states from the checkpoint file, if there is one
+        """
+        if not self.checkpoint_path or not os.path.exists(self.checkpoint_path):
+            return
+        try:
+            with open(self.checkpoint_path) as f:
+                saved = json.load(f)
+            fields = saved["fields"]
+            for device_id, values in saved["devices"].items():
+                state = DeviceState(**dict(zip(fields, values)))
+                if state.pending_spike is not None:
+                    state.pending_spike = tuple(state.pending_spike)
+                self._states[device_id] = state
+            logger.info(f"Restored anomaly detector state for {len(self._states)} devices")
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            logger.error(f"Ignoring unreadable anomaly detector checkpoint: {e}")
+
+    def last_epoch(self, device_id):
+        """
+        Epoch of the device's latest reading, or None for a device not seen yet
+        """
+        with self._lock:
+            state = self._states.get(device_id)
+            return state.last_epoch if state is not None else None
+
+    def stats(self):
+        with self._lock:
+            return {
+                "devices": len(self._states),
+                "readings": self._readings,
+                "events": dict(self._events),
+                "devices_in_leak_onset": sum(1 for state in self._states.values() if state.onset)
+            }
+
+
+class AnomalyFeed:
+    """
+    Runs stored readings through a detector in ID order.
+
+    With several workers, a detector in each one would see only the readings
+    posted to it, and each would raise its own leak onset for the same leak.
+    The elected leader polls the readings every worker stored instead, so one
+    detector sees each device's whole series. The feed starts after the
+    newest reading stored when it first polls. Readings older than the
+    device's last detected one (historical backfills) are skipped, as the
+    detector needs time order. IDs are taken to be committed in order, as
+    they are on SQLite, where one transaction writes at a time.
+    """
+    def __init__(self, detector, model, value_column, batch_size=ANOMALY_FEED_BATCH):
+        self.detector = detector
+        self.model = model
+        self.value_column = value_column
+        self.batch_size = batch_size
+        self.after_id = None
+
+    def poll(self, session):
+        """
+        Fold readings stored since the last poll into the detector and return the events they raised
+        """
+        model = self.model
+        if self.after_id is None:
+            self.after_id = session.query(func.max(model.id)).scalar() or 0
+            return []
+        rows = session.query(model.id, model.device_id, self.value_column, model.timestamp).filter(
+            model.id > self.after_id
+        ).order_by(model.id).limit(self.batch_size).all()
+        events = []
+        for reading_id, device_id, value, timestamp in rows:
+            self.after_id = reading_id
+            epoch = (timestamp - EPOCH).total_seconds()
+            last_epoch = self.detector.last_epoch(device_id)
+            if last_epoch is not None and epoch < last_epoch:
+                continue
+            events.extend(self.detector.update(device_id, value, epoch))
+        return events
+
+
+# Shared detector for the ingest paths in this process
+anomaly_detector = AnomalyDetector()
+atexit.register(anomaly_detector.checkpoint)
+
+
+def record_anomalies(session, model, events, notify=None):
+    """
+    Add an alert row per detector event within the caller's transaction.
+
+    Anomaly alerts are closed on creation, so they stay out of the alert
+    episode index; they are listed with other recent alerts until
+    acknowledged. notify(alert) is called for leak onsets once IDs are assigned.
+    Returns the new alerts.
+    """
+    alerts = []
+    for event in events:
+        timestamp = datetime.utcfromtimestamp(event["epoch"])
+        alert = model(
+            device_id=event["device_id"],
+            level=ANOMALY_LEVEL,
+            message=event["message"][:255],
+            timestamp=timestamp,
+            peak_value=event["value"],
+            last_seen=timestamp,
+            sample_count=1,
+            closed_at=timestamp
+        )
+        session.add(alert)
+        alerts.append((alert, event))
+        logger.warning(f"Anomaly ({event['kind']}): {event['message']}")
+    if not alerts:
+        return []
+
+    session.flush()
+    ALERTS_CREATED.inc(len(alerts), level=ANOMALY_LEVEL)
+    if notify is not None:
+        for alert, event in alerts:
+            if event["kind"] == "leak_onset":
+                notify(alert)
+    return [alert for alert, _ in alerts]
@@ -1,41 +1,265 @@
-import requests
 import os
+import time
+from datetime import timezone
+from dateutil import parser as date_parser
+from functools import wraps
+import threading
 import logging
 
+from utils.metrics import count_retry, observe_response
+
+ARDUINO_API_URL = os.getenv('ARDUINO_API_URL', 'https://api2.arduino.cc')
+AUTH_URL = f'{ARDUINO_API_URL}/iot/v1/clients/token'
+AUDIENCE = 'https://api2.arduino.cc/iot'
+
+# Refresh tokens this many seconds before they actually expire
+TOKEN_REFRESH_MARGIN = 60
+
+# Seconds a thing's property name -> ID map is reused before it is re-read
+PROPERTY_MAP_TTL = float(os.getenv('ARDUINO_PROPERTY_MAP_TTL', 600))
+
+# Keep-alive connections per host; should cover the collector's concurrency
+HTTP_POOL_SIZE = int(os.getenv('ARDUINO_HTTP_POOL_SIZE', 16))
+# Most points the timeseries endpoint returns for one request
+TIMESERIES_MAX_POINTS = 1000
+
+_session = None
+_session_lock = threading.Lock()
+_token_managers = {}
+_token_managers_lock = threading.Lock()
+_property_maps = {}
+_property_maps_lock = threading.Lock()
+
+
+def with_retries(call):
+    """
+    Retry an Arduino Cloud call up to 3 times with exponential backoff, counting
+    failed attempts under `call`. tenacity is imported on the first call, so
+    processes that never reach Arduino Cloud do not load it.
+    """
+    def decorator(fn):
+        retrying = None
+
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            nonlocal retrying
+            if retrying is None:
+                from tenacity import retry, stop_after_attempt, wait_exponential
+                retrying = retry(
+                    stop=stop_after_attempt(3), wait=wait_exponential(multiplier=1, min=2, max=10),
+                    after=count_retry(call)
+                )(fn)
+            return retrying(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def get_session():
+    """
+    Return the shared keep-alive session used for all Arduino Cloud traffic
+    """
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                # Imported here so importing the app does not pay for requests and its TLS stack
+                import requests
+                session = requests.Session()
+                adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=HTTP_POOL_SIZE)
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                session.hooks['response'].append(observe_response)
+                _session = session
+    return _session
+
+
+class TokenManager:
+    """
+    Caches an Arduino Cloud OAuth token and refreshes it shortly before it expires.
+
+    Concurrent callers that find the token expired block on a lock while a single
+    thread performs the client-credentials exchange, then all reuse its result.
+    """
+    def __init__(self, client_id, client_secret, session=None, refresh_margin=TOKEN_REFRESH_MARGIN):
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.session = session or get_session()
+        self.refresh_margin = refresh_margin
+        self.token_requests = 0
+        self._token = None
+        self._expires_at = 0.0
+        self._lock = threading.Lock()
+
+    def _is_valid(self):
+        return self._token is not None and time.monotonic() < self._expires_at
+
+    def get_token(self):
+        """
+        Return a valid access token, fetching a new one only if the cached one expired
+        """
+        if self._is_valid():
+            return self._token
+
+        with self._lock:
+            # Another thread may have refreshed while we waited for the lock
+            if not self._is_valid():
+                self._refresh()
+            return self._token
+
+    def invalidate(self):
+        """
+        Drop the cached token, e.g. after the API answered 401
+        """
+        with self._lock:
+            self._token = None
+            self._expires_at = 0.0
+
+    def _refresh(self):
+        payload = {
+            'grant_type': 'client_credentials',
+            'client_id': self.client_id,
+            'client_secret': self.client_secret,
+            'audience': AUDIENCE
+        }
+        self.token_requests += 1
+        response = self.session.post(AUTH_URL, data=payload, timeout=10)
+        response.raise_for_status()
+        body = response.json()
+
+        token = body.get('access_token')
+        if not token:
+            raise ValueError("Arduino Cloud token response did not contain an access token")
+
+        expires_in = float(body.get('expires_in', 300))
+        self._token = token
+        self._expires_at = time.monotonic() + max(expires_in - self.refresh_margin, 0)
+        logging.debug(f"Obtained Arduino Cloud token valid for {expires_in:.0f}s")
+
+
+def get_token_manager(client_id, client_secret):
+    """
+    Return the process-wide token manager for a set of client credentials
+    """
+    key = (client_id, client_secret)
+    manager = _token_managers.get(key)
+    if manager is None:
+        with _token_managers_lock:
+            manager = _token_managers.get(key)
+            if manager is None:
+                manager = TokenManager(client_id, client_secret)
+                _token_managers[key] = manager
+    return manager
+
+
+def cache_property_map(thing_id, properties):
+    """
+    Remember a thing's property name -> ID map from a properties response
+    """
+    property_map = {prop['name'].lower(): prop['id'] for prop in properties if 'name' in prop and 'id' in prop}
+    with _property_maps_lock:
+        _property_maps[thing_id] = (time.monotonic() + PROPERTY_MAP_TTL, property_map)
+    return property_map
+
+
+def get_cached_property_map(thing_id):
+    """
+    Return a thing's cached property name -> ID map, or None if it is missing or expired
+    """
+    with _property_maps_lock:
+        entry = _property_maps.get(thing_id)
+    if entry is None or time.monotonic() >= entry[0]:
+        return None
+    return entry[1]
+
+
 class ArduinoCloudAPI:
-    def __init__(self, client_id, client_secret, thing_id):
+    def __init__(self, client_id, client_secret, thing_id=None):
         self.client_id = client_id
         self.client_secret = client_secret
         self.thing_id = thing_id
         self.token = None
-        self.base_url = 'https://api2.arduino.cc/iot/v2'
-        self.auth_url = 'https://api2.arduino.cc/iot/v1/clients/token'
+        self.base_url = f'{ARDUINO_API_URL}/iot/v2'
+        self.session = get_session()
+        self.token_manager = get_token_manager(client_id, client_secret)
         self.authenticate()
 
     def authenticate(self):
-        data = {
-            'grant_type': 'client_credentials',
-            'client_id': self.client_id,
-            'client_secret': self.client_secret,
-            'audience': 'https://api2.arduino.cc/iot'
-        }
-        headers = {'Content-Type': 'application/x-www-form-urlencoded'}
-        response = requests.post(self.auth_url, data=data, headers=headers)
-        if response.status_code == 200:
-            self.token = response.json().get('access_token')
-        else:
+        import requests
+        try:
+            self.token = self.token_manager.get_token()
+            return True
+        except (requests.RequestException, ValueError):
             logging.error('Failed to authenticate with Arduino Cloud API.')
+            return False
 
     def get_headers(self):
+        self.token = self.token_manager.get_token()
         return {'Authorization': f'Bearer {self.token}'}
 
     def get_latest_data(self):
         url = f'{self.base_url}/things/{self.thing_id}/properties'
-        response = requests.get(url, headers=self.get_headers())
+        response = self.session.get(url, headers=self.get_headers(), timeout=10)
         if response.status_code == 200:
             properties = response.json()
             data = {prop['name']: prop['last_value'] for prop in properties}
             return data
         else:
+            if response.status_code == 401:
+                self.token_manager.invalidate()
             logging.error('Failed to retrieve data from Arduino Cloud.')
             return {}
+
+    def get_thing_properties(self, thing_id=None):
+        """
+        Return all properties of a thing, including their last values, in one request
+        """
+        thing_id = thing_id or self.thing_id
+        url = f'{self.base_url}/things/{thing_id}/properties'
+        response = self.session.get(url, headers=self.get_headers(), timeout=10)
+        if response.status_code != 200:
+            if response.status_code == 401:
+                self.token_manager.invalidate()
+            logging.error(f'Failed to retrieve properties for thing {thing_id} ({response.status_code}).')
+            return []
+        properties = response.json()
+        cache_property_map(thing_id, properties)
+        return properties
+
+    def get_last_value(self, thing_id, property_id):
+        """
+        Return a single property, including its last value
+        """
+        url = f'{self.base_url}/things/{thing_id}/properties/{property_id}'
+        response = self.session.get(url, headers=self.get_headers(), timeout=10)
+        if response.status_code != 200:
+            if response.status_code == 401:
+                self.token_manager.invalidate()
+            logging.error(f'Failed to retrieve property {property_id} of thing {thing_id} ({response.status_code}).')
+            return None
+        return response.json()
+
+    def get_property_timeseries(self, thing_id, property_id, start, end):
+        """
+        Return the raw (timestamp, value) points of a property in [start, end), oldest first.
+        The API has no limit parameter and returns at most TIMESERIES_MAX_POINTS per request;
+        a full response means the range continues after its last point. Timestamps are naive UTC datetimes.
+        """
+        url = f'{self.base_url}/things/{thing_id}/properties/{property_id}/timeseries'
+        params = {
+            'from': start.strftime('%Y-%m-%dT%H:%M:%S.%fZ'),
+            'to': end.strftime('%Y-%m-%dT%H:%M:%S.%fZ'),
+            'interval': 1,
+            'desc': 'false'
+        }
+        response = self.session.get(url, headers=self.get_headers(), params=params, timeout=30)
+        if response.status_code == 401:
+            self.token_manager.invalidate()
+        response.raise_for_status()
+
+        points = []
+        for point in response.json().get('data', []):
+            timestamp = date_parser.isoparse(point['time'])
+            if timestamp.tzinfo is not None:
+                timestamp = timestamp.astimezone(timezone.utc).replace(tzinfo=None)
+            points.append((timestamp, float(point['value'])))
+        return points
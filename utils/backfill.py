@@ -0,0 +1,197 @@
+import os
+import logging
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from utils.arduino_cloud import TIMESERIES_MAX_POINTS, get_cached_property_map
+from utils.database import begin_write
+from utils.rollups import rollup_tracker, to_epochs
+from utils.thresholds import STATUS_LABELS, ClassifierState, threshold_engine
+
+logger = logging.getLogger(__name__)
+
+# Backfill settings
+BACKFILL_MAX_HOURS = float(os.getenv('BACKFILL_MAX_HOURS', 72))
+BACKFILL_CHUNK_MINUTES = int(os.getenv('BACKFILL_CHUNK_MINUTES', 360))
+BACKFILL_CONCURRENCY = int(os.getenv('BACKFILL_CONCURRENCY', 4))
+# Historic points within this many seconds of a stored reading are treated as duplicates
+BACKFILL_DEDUP_SECONDS = float(os.getenv('BACKFILL_DEDUP_SECONDS', 1))
+
+
+def split_windows(start, end, chunk=timedelta(minutes=BACKFILL_CHUNK_MINUTES)):
+    """
+    Split [start, end) into consecutive windows no longer than chunk
+    """
+    windows = []
+    while start < end:
+        windows.append((start, min(start + chunk, end)))
+        start += chunk
+    return windows
+
+
+def fetch_window(api, thing_id, property_id, start, end, page_size=TIMESERIES_MAX_POINTS):
+    """
+    Fetch every point of a property in [start, end). A response as long as the
+    API's page_size cap was cut short, so the next request starts just after
+    its last point; each point is downloaded once.
+    """
+    points = []
+    cursor = start
+    while cursor < end:
+        page = api.get_property_timeseries(thing_id, property_id, cursor, end)
+        fresh = [(timestamp, value) for timestamp, value in page
+                 if cursor <= timestamp < end and (not points or timestamp > points[-1][0])]
+        points.extend(fresh)
+        if len(page) < page_size or not fresh:
+            break
+        cursor = points[-1][0] + timedelta(microseconds=1)
+    return points
+
+
+def drop_duplicates(points, existing, tolerance=BACKFILL_DEDUP_SECONDS):
+    """
+    Remove points within tolerance seconds of an existing reading timestamp
+    """
+    if not points or not existing:
+        return points
+    epochs = to_epochs([timestamp for timestamp, _ in points])
+    stored = np.sort(to_epochs(existing))
+    idx = np.searchsorted(stored, epochs)
+    nearest = np.minimum(
+        np.abs(epochs - stored[np.clip(idx - 1, 0, len(stored) - 1)]),
+        np.abs(epochs - stored[np.clip(idx, 0, len(stored) - 1)])
+    )
+    return [point for point, duplicate in zip(points, nearest <= tolerance) if not duplicate]
+
+
+def find_property_id(api, thing_id, property_name):
+    """
+    Resolve a property name (case and underscores ignored) to its ID
+    """
+    normalized = property_name.lower().replace('_', '')
+    property_map = get_cached_property_map(thing_id)
+    if property_map is None:
+        api.get_thing_properties(thing_id)
+        property_map = get_cached_property_map(thing_id) or {}
+    for name, property_id in property_map.items():
+        if name.replace('_', '') == normalized:
+            return property_id
+    return None
+
+
+class HistoryBackfill:
+    """
+    Fills gaps in stored readings from Arduino Cloud's historic timeseries.
+
+    A watermark row per (thing, property) records how far the history has
+    been stored (synced_until) and the end of the backfill in progress
+    (pending_until). Windows are fetched concurrently but stored in order,
+    each in its own transaction that also advances the watermark, so a crash
+    resumes at the first window that was not committed.
+    """
+    def __init__(self, session, model, value_column, rollup_model, watermark_model,
+                 concurrency=BACKFILL_CONCURRENCY, max_hours=BACKFILL_MAX_HOURS):
+        self.session = session
+        self.model = model
+        self.value_column = value_column
+        self.rollup_model = rollup_model
+        self.watermark_model = watermark_model
+        self.concurrency = concurrency
+        self.max_hours = max_hours
+
+    def _store_window(self, device_id, points, state):
+        """
+        De-duplicate one window's points against stored readings and bulk-insert the rest.
+        Returns the number of rows inserted; the caller commits.
+        """
+        if not points:
+            return 0
+        # The duplicate check and the insert see the same readings
+        begin_write(self.session)
+        model = self.model
+        tolerance = timedelta(seconds=BACKFILL_DEDUP_SECONDS)
+        existing = [timestamp for (timestamp,) in self.session.query(model.timestamp).filter(
+            model.device_id == device_id,
+            model.timestamp >= points[0][0] - tolerance,
+            model.timestamp <= points[-1][0] + tolerance
+        )]
+        points = drop_duplicates(points, existing)
+        if not points:
+            return 0
+
+        timestamps, values = zip(*points)
+        levels = threshold_engine.classify(values, to_epochs(timestamps), device_id, state=state)
+        statuses = np.array(STATUS_LABELS, dtype=object)[levels].tolist()
+        self.session.bulk_insert_mappings(model, [{
+            "device_id": device_id,
+            "timestamp": timestamp,
+            self.value_column.key: value,
+            "status": status
+        } for timestamp, value, status in zip(timestamps, values, statuses)])
+        rollup_tracker.record(self.session, self.rollup_model, device_id, timestamps, values, statuses)
+        return len(points)
+
+    def _backfill_range(self, watermark, api, thing_id, property_id, device_id, start, end):
+        windows = split_windows(start, end)
+        state = ClassifierState()
+        inserted = 0
+        # No transaction stays open while windows are fetched; each is stored in its own
+        self.session.commit()
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            for i in range(0, len(windows), self.concurrency):
+                group = windows[i:i + self.concurrency]
+                results = executor.map(lambda window: fetch_window(api, thing_id, property_id, *window), group)
+                for (_, window_end), points in zip(group, results):
+                    inserted += self._store_window(device_id, points, state)
+                    watermark.synced_until = window_end
+                    self.session.commit()
+        return inserted
+
+    def run(self, api, thing_id, device_id, property_name, now=None):
+        """
+        Fetch readings missed since the last stored one. Returns the number of rows inserted.
+
+        An interrupted backfill is resumed first; then the gap between the
+        latest stored reading and now is filled, looking back at most max_hours.
+        """
+        now = now or datetime.utcnow()
+        floor = now - timedelta(hours=self.max_hours)
+
+        property_id = find_property_id(api, thing_id, property_name)
+        if property_id is None:
+            logger.warning(f"Property {property_name} not found on thing {thing_id}; nothing to backfill")
+            return 0
+
+        begin_write(self.session)
+        watermark = self.session.query(self.watermark_model).filter_by(
+            thing_id=thing_id, property_name=property_name
+        ).first()
+        if watermark is None:
+            watermark = self.watermark_model(thing_id=thing_id, property_name=property_name)
+            self.session.add(watermark)
+
+        inserted = 0
+        if watermark.pending_until is not None and watermark.synced_until is not None \
+                and watermark.synced_until < watermark.pending_until:
+            inserted += self._backfill_range(
+                watermark, api, thing_id, property_id, device_id,
+                max(watermark.synced_until, floor), watermark.pending_until
+            )
+            begin_write(self.session)
+
+        # Readings the live collector stored after `now` are not part of the gap
+        latest = self.session.query(self.model.timestamp).filter(
+            self.model.device_id == device_id, self.model.timestamp < now
+        ).order_by(self.model.timestamp.desc()).limit(1).scalar()
+        start = max(timestamp for timestamp in (latest, watermark.synced_until, floor) if timestamp is not None)
+
+        watermark.synced_until = start
+        watermark.pending_until = now
+        self.session.commit()
+        if start < now:
+            inserted += self._backfill_range(watermark, api, thing_id, property_id, device_id, start, now)
+
+        logger.info(f"Backfilled {inserted} readings for thing {thing_id} ({property_name}) since {start:%Y-%m-%d %H:%M}")
+        return inserted
@@ -0,0 +1,191 @@
+import os
+import time
+import random
+import atexit
+import asyncio
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from utils.metrics import COLLECTOR_LAG_SECONDS
+
+logger = logging.getLogger(__name__)
+
+# Collector settings
+COLLECTOR_INTERVAL = float(os.getenv('COLLECTOR_INTERVAL', 60))
+COLLECTOR_CONCURRENCY = int(os.getenv('COLLECTOR_CONCURRENCY', 16))
+COLLECTOR_TIMEOUT = float(os.getenv('COLLECTOR_TIMEOUT', 15))
+# Each poll is rescheduled within +/- this fraction of the interval
+COLLECTOR_JITTER = float(os.getenv('COLLECTOR_JITTER', 0.1))
+COLLECTOR_BATCH_SIZE = int(os.getenv('COLLECTOR_BATCH_SIZE', 200))
+COLLECTOR_FLUSH_INTERVAL = float(os.getenv('COLLECTOR_FLUSH_INTERVAL', 1.0))
+
+
+def configured_thing_ids():
+    """
+    Things to poll: ARDUINO_THING_IDS (comma-separated), else ARDUINO_THING_ID
+    """
+    thing_ids = os.getenv('ARDUINO_THING_IDS') or os.getenv('ARDUINO_THING_ID') or ''
+    return [thing_id.strip() for thing_id in thing_ids.split(',') if thing_id.strip()]
+
+
+class AsyncCollector:
+    """
+    Polls many Arduino Cloud things concurrently on independent, jittered schedules.
+
+    fetch_fn(thing_id) returns one reading and store_fn(readings) persists a
+    list of them. Both are blocking: fetches run on a bounded thread pool, so
+    a slow thing only delays its own next poll, and stores on a thread of
+    their own, so fetches that hang past their timeout cannot hold them up.
+    At most `concurrency` fetches are in flight, each is abandoned after
+    `timeout` seconds, and results are handed to store_fn in batches by a
+    single writer task.
+
+    With a scheduler (see utils.scheduler.AdaptiveScheduler), each thing's
+    next interval follows its latest reading and every request waits for the
+    shared API rate limit; otherwise things are polled every `interval`.
+    """
+    def __init__(self, fetch_fn, store_fn, thing_ids, interval=COLLECTOR_INTERVAL,
+                 concurrency=COLLECTOR_CONCURRENCY, timeout=COLLECTOR_TIMEOUT, jitter=COLLECTOR_JITTER,
+                 batch_size=COLLECTOR_BATCH_SIZE, flush_interval=COLLECTOR_FLUSH_INTERVAL, scheduler=None):
+        self.fetch_fn = fetch_fn
+        self.store_fn = store_fn
+        self.thing_ids = list(thing_ids)
+        self.interval = interval
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.jitter = jitter
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.scheduler = scheduler
+        self._executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='collector')
+        self._store_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='collector-store')
+        self._stopping = None
+        self._results = None
+        self._loop = None
+        self._thread = None
+        self._stats = {
+            "things": len(self.thing_ids),
+            "polls": 0,
+            "failures": 0,
+            "timeouts": 0,
+            "stored": 0,
+            "batches": 0,
+            "last_lag_seconds": 0.0,
+            "max_lag_seconds": 0.0
+        }
+
+    def stats(self):
+        stats = dict(self._stats)
+        stats["pending"] = self._results.qsize() if self._results is not None else 0
+        if self.scheduler is not None:
+            stats["scheduler"] = self.scheduler.stats()
+        return stats
+
+    def _next_delay(self, interval=None):
+        return (interval or self.interval) * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    async def _run_in_executor(self, fn, *args, executor=None):
+        return await self._loop.run_in_executor(executor or self._executor, fn, *args)
+
+    async def _sleep(self, delay):
+        """
+        Sleep for delay seconds; returns True if the collector is stopping
+        """
+        try:
+            await asyncio.wait_for(self._stopping.wait(), max(delay, 0))
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    async def _poll_thing(self, thing_id, semaphore):
+        # Spread first polls across the interval so things do not fire in lockstep
+        due = time.monotonic() + random.uniform(0, self.interval)
+        while not self._stopping.is_set():
+            if await self._sleep(due - time.monotonic()):
+                return
+
+            interval = None
+            async with semaphore:
+                if self.scheduler is not None and await self._sleep(self.scheduler.reserve()):
+                    return
+                lag = max(time.monotonic() - due, 0.0)
+                self._stats["last_lag_seconds"] = lag
+                self._stats["max_lag_seconds"] = max(self._stats["max_lag_seconds"], lag)
+                COLLECTOR_LAG_SECONDS.observe(lag)
+                try:
+                    reading = await asyncio.wait_for(self._run_in_executor(self.fetch_fn, thing_id), self.timeout)
+                    self._stats["polls"] += 1
+                    if self.scheduler is not None:
+                        interval = self.scheduler.observe(thing_id, reading['gas_level'], reading['status'])
+                    await self._results.put(reading)
+                except asyncio.TimeoutError:
+                    self._stats["timeouts"] += 1
+                    logger.warning(f"Timed out polling thing {thing_id} after {self.timeout}s")
+                except Exception as e:
+                    self._stats["failures"] += 1
+                    logger.error(f"Failed to poll thing {thing_id}: {e}")
+
+            if interval is None and self.scheduler is not None:
+                interval = self.scheduler.interval(thing_id)
+            due += self._next_delay(interval)
+            if due < time.monotonic():
+                # Fell behind by more than one interval; skip missed polls instead of bursting
+                due = time.monotonic()
+
+    async def _write_batches(self):
+        while not (self._stopping.is_set() and self._results.empty()):
+            batch = []
+            try:
+                batch.append(await asyncio.wait_for(self._results.get(), self.flush_interval))
+            except asyncio.TimeoutError:
+                continue
+
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._results.get(), remaining))
+                except asyncio.TimeoutError:
+                    break
+
+            try:
+                await self._run_in_executor(self.store_fn, batch, executor=self._store_executor)
+                self._stats["stored"] += len(batch)
+                self._stats["batches"] += 1
+            except Exception as e:
+                logger.error(f"Failed to store {len(batch)} collected readings: {e}", exc_info=True)
+
+    async def run(self):
+        """
+        Poll all things until stop() is called
+        """
+        self._loop = asyncio.get_running_loop()
+        self._stopping = asyncio.Event()
+        self._results = asyncio.Queue(maxsize=max(self.batch_size * 10, len(self.thing_ids)))
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        writer = asyncio.create_task(self._write_batches())
+        await asyncio.gather(*(self._poll_thing(thing_id, semaphore) for thing_id in self.thing_ids))
+        await writer
+
+    def start(self):
+        """
+        Run the collector's event loop in a single background thread
+        """
+        if self._thread is None:
+            self._thread = threading.Thread(target=lambda: asyncio.run(self.run()), name='collector', daemon=True)
+            self._thread.start()
+            atexit.register(self.stop)
+        return self
+
+    def stop(self, timeout=10):
+        """
+        Stop polling and wait for collected readings to be stored
+        """
+        if self._loop is not None and not self._loop.is_closed():
+            self._loop.call_soon_threadsafe(self._stopping.set)
+        if self._thread is not None:
+            self._thread.join(timeout)
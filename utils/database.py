@@ -0,0 +1,175 @@
+import os
+import logging
+from functools import wraps
+
+from flask import g, has_app_context
+from flask_sqlalchemy import SignallingSession, SQLAlchemy, get_state
+from sqlalchemy import event, orm
+from sqlalchemy.engine import make_url
+from sqlalchemy.pool import QueuePool
+
+logger = logging.getLogger(__name__)
+
+# "on" applies the settings below; "off" keeps SQLAlchemy's defaults (for comparison benchmarks)
+DB_PROFILE = os.getenv('DB_PROFILE', 'on').lower()
+# Optional replica (or second URI) that read-only endpoints query; SQLite reads use a separate pool by default
+DATABASE_READ_URI = os.getenv('DATABASE_READ_URI')
+
+# Connection pool per engine
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', 10))
+DB_MAX_OVERFLOW = int(os.getenv('DB_MAX_OVERFLOW', 10))
+DB_POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', 30))
+# Server databases drop idle connections; recycle them before that happens
+DB_POOL_RECYCLE = int(os.getenv('DB_POOL_RECYCLE', 1800))
+
+# SQLite: wait this long for the write lock instead of failing with "database is locked"
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv('SQLITE_BUSY_TIMEOUT_MS', 10000))
+# NORMAL is durable in WAL mode except for the last transactions before a power loss
+SQLITE_SYNCHRONOUS = os.getenv('SQLITE_SYNCHRONOUS', 'NORMAL').upper()
+SQLITE_MMAP_SIZE = int(os.getenv('SQLITE_MMAP_SIZE', 256 * 1024 * 1024))
+SQLITE_CACHE_SIZE_KB = int(os.getenv('SQLITE_CACHE_SIZE_KB', 64 * 1024))
+
+READ_BIND = 'read'
+# Connection execution option that makes a transaction begin with the write lock (see begin_write)
+WRITE_LOCK = 'sqlite_write_lock'
+
+
+def is_memory_sqlite(url):
+    return url.get_backend_name() == 'sqlite' and url.database in (None, '', ':memory:')
+
+
+def engine_options(uri, profile=DB_PROFILE):
+    """
+    create_engine() options for a database URI: a queue pool sized for
+    concurrent requests on every backend, plus pre-ping on server databases
+    """
+    url = make_url(uri)
+    if profile == 'off' or is_memory_sqlite(url):
+        return {}
+
+    options = {
+        "pool_size": DB_POOL_SIZE,
+        "max_overflow": DB_MAX_OVERFLOW,
+        "pool_timeout": DB_POOL_TIMEOUT
+    }
+    if url.get_backend_name() == 'sqlite':
+        # Flask-SQLAlchemy would otherwise open a new connection (NullPool) per session.
+        # Pooled connections move between request threads; the pool hands each to one thread at a time.
+        options["poolclass"] = QueuePool
+        options["connect_args"] = {"check_same_thread": False, "timeout": SQLITE_BUSY_TIMEOUT_MS / 1000}
+    else:
+        options["pool_pre_ping"] = True
+        options["pool_recycle"] = DB_POOL_RECYCLE
+    return options
+
+
+def read_uri(uri):
+    """
+    URI read-only endpoints use: DATABASE_READ_URI, else the primary database
+    itself for SQLite (so readers get their own pool), else None (no routing)
+    """
+    if DATABASE_READ_URI:
+        return DATABASE_READ_URI
+    url = make_url(uri)
+    if url.get_backend_name() == 'sqlite' and not is_memory_sqlite(url):
+        return uri
+    return None
+
+
+def configure_app(app, uri):
+    """
+    Set the engine options and, if reads are routed, the read bind on a Flask app
+    """
+    app.config['SQLALCHEMY_DATABASE_URI'] = uri
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(uri)
+    reader = read_uri(uri) if DB_PROFILE != 'off' else None
+    if reader:
+        app.config['SQLALCHEMY_BINDS'] = {**(app.config.get('SQLALCHEMY_BINDS') or {}), READ_BIND: reader}
+
+
+def apply_sqlite_pragmas(engine, read_only=False):
+    """
+    Put every new SQLite connection in WAL mode with the profile's pragmas.
+
+    Transactions begin deferred, so reads take no lock and never wait for
+    the writer, and a transaction's first write waits up to the busy timeout
+    for the write lock. A deferred transaction that read before it writes
+    would instead fail outright if another writer committed since its read,
+    so those begin with BEGIN IMMEDIATE through begin_write(). Read-only
+    connections refuse writes.
+    """
+    @event.listens_for(engine, 'connect')
+    def on_connect(dbapi_connection, connection_record):
+        # Let SQLAlchemy emit BEGIN itself (see on_begin)
+        dbapi_connection.isolation_level = None
+        cursor = dbapi_connection.cursor()
+        cursor.execute('PRAGMA journal_mode=WAL')
+        cursor.execute(f'PRAGMA synchronous={SQLITE_SYNCHRONOUS}')
+        cursor.execute(f'PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}')
+        cursor.execute(f'PRAGMA mmap_size={SQLITE_MMAP_SIZE}')
+        cursor.execute(f'PRAGMA cache_size=-{SQLITE_CACHE_SIZE_KB}')
+        cursor.execute('PRAGMA temp_store=MEMORY')
+        if read_only:
+            cursor.execute('PRAGMA query_only=ON')
+        cursor.close()
+
+    @event.listens_for(engine, 'begin')
+    def on_begin(connection):
+        write_lock = not read_only and connection.get_execution_options().get(WRITE_LOCK, False)
+        connection.exec_driver_sql('BEGIN IMMEDIATE' if write_lock else 'BEGIN')
+
+
+def begin_write(session):
+    """
+    Begin a session's transaction on the primary database holding the write
+    lock (BEGIN IMMEDIATE on SQLite; other databases begin as usual). Call it
+    before the first query of a transaction that reads and then writes; it has
+    no effect on a transaction that has already run a statement.
+    """
+    return session.connection(execution_options={WRITE_LOCK: True})
+
+
+def init_engines(db, app):
+    """
+    Create the engines and install the SQLite pragmas before the first connection is made
+    """
+    if DB_PROFILE == 'off':
+        return
+    with app.app_context():
+        engines = [(db.get_engine(app), False)]
+        if READ_BIND in (app.config.get('SQLALCHEMY_BINDS') or {}):
+            engines.append((db.get_engine(app, bind=READ_BIND), True))
+    for engine, read_only in engines:
+        if engine.dialect.name == 'sqlite' and not is_memory_sqlite(engine.url):
+            apply_sqlite_pragmas(engine, read_only=read_only)
+
+
+def read_only(view):
+    """
+    Route a view's queries to the read pool or replica. The view must not write.
+    """
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        g.db_read_only = True
+        return view(*args, **kwargs)
+    return wrapper
+
+
+class RoutingSession(SignallingSession):
+    """
+    Session that sends queries from read-only views to the read bind, and everything else to the primary
+    """
+    def get_bind(self, mapper=None, clause=None):
+        if not self._flushing and has_app_context() and g.get('db_read_only'):
+            state = get_state(self.app)
+            if READ_BIND in (self.app.config.get('SQLALCHEMY_BINDS') or {}):
+                return state.db.get_engine(self.app, bind=READ_BIND)
+        return super().get_bind(mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """
+    Flask-SQLAlchemy with read/write routing (see read_only)
+    """
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
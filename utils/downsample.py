@@ -0,0 +1,139 @@
+import math
+from datetime import datetime
+
+import numpy as np
+from sqlalchemy import Integer, cast, func
+
+# Upper bound on points returned by a downsampled history query
+MAX_POINTS_LIMIT = 5000
+
+_RESOLUTION_UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+
+def parse_resolution(value):
+    """
+    Parse a bucket size such as "30", "30s", "5m", "1h" or "1d" into seconds
+    """
+    if value is None or value == '':
+        return None
+    value = str(value).strip().lower()
+    unit = _RESOLUTION_UNITS.get(value[-1])
+    seconds = int(value[:-1]) * unit if unit else int(value)
+    if seconds <= 0:
+        raise ValueError("Resolution must be positive")
+    return seconds
+
+
+def choose_resolution(start, end, resolution=None, max_points=None):
+    """
+    Pick a bucket size in seconds that honours both resolution and max_points,
+    and never yields more than MAX_POINTS_LIMIT buckets. Returns None for raw
+    readings when neither is given.
+    """
+    if max_points is not None and max_points <= 0:
+        raise ValueError("max_points must be positive")
+    if resolution is None and max_points is None:
+        return None
+    max_points = min(max_points or MAX_POINTS_LIMIT, MAX_POINTS_LIMIT)
+    window = (end - start).total_seconds()
+    return max(resolution or 1, math.ceil(window / max_points))
+
+
+def bucket_expression(dialect_name, column, seconds):
+    """
+    SQL expression numbering the fixed-size time bucket a timestamp falls into
+    """
+    if dialect_name == 'sqlite':
+        return cast(func.strftime('%s', column), Integer) / seconds
+    if dialect_name in ('mysql', 'mariadb'):
+        return func.floor(func.unix_timestamp(column) / seconds)
+    return func.floor(func.extract('epoch', column) / seconds)
+
+
+def query_buckets(session, time_column, value_column, id_column, filters, seconds):
+    """
+    Aggregate readings into fixed time buckets in SQL.
+
+    Returns a list of dicts ordered oldest first with the bucket start as a naive
+    UTC datetime and count/min/avg/max/last of the values in each bucket. "last"
+    is the value of the newest row (highest id) in the bucket.
+    """
+    dialect_name = session.bind.dialect.name
+    bucket = bucket_expression(dialect_name, time_column, seconds).label('bucket')
+
+    rows = session.query(
+        bucket,
+        func.count(value_column),
+        func.min(value_column),
+        func.avg(value_column),
+        func.max(value_column),
+        func.max(id_column)
+    ).filter(*filters).group_by(bucket).order_by(bucket).all()
+
+    last_ids = [row[5] for row in rows]
+    last_values = dict(
+        session.query(id_column, value_column).filter(id_column.in_(last_ids)).all()
+    ) if last_ids else {}
+
+    return [{
+        "start": datetime.utcfromtimestamp(int(row[0]) * seconds),
+        "count": row[1],
+        "min": row[2],
+        "avg": float(row[3]) if row[3] is not None else None,
+        "max": row[4],
+        "last": last_values.get(row[5])
+    } for row in rows]
+
+
+def lttb(x, y, threshold):
+    """
+    Largest-Triangle-Three-Buckets downsampling.
+
+    Returns the indices of the points to keep, preserving the visual shape of
+    the series (peaks included) with at most threshold points.
+    """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    n = len(x)
+    if threshold >= n or threshold < 3:
+        return np.arange(n)
+
+    selected = np.empty(threshold, dtype=np.int64)
+    selected[0] = 0
+    selected[-1] = n - 1
+    edges = np.linspace(1, n - 1, threshold - 1).astype(np.int64)
+
+    previous = 0
+    for i in range(threshold - 2):
+        start, end = edges[i], edges[i + 1]
+        # Average of the next bucket is the third triangle vertex
+        next_start, next_end = end, edges[i + 2] if i + 2 < len(edges) else n
+        if next_end <= next_start:
+            next_end = next_start + 1
+        avg_x = x[next_start:next_end].mean()
+        avg_y = y[next_start:next_end].mean()
+
+        areas = np.abs(
+            (x[previous] - avg_x) * (y[start:end] - y[previous])
+            - (x[previous] - x[start:end]) * (avg_y - y[previous])
+        )
+        previous = start + int(np.argmax(areas))
+        selected[i + 1] = previous
+
+    return selected
+
+
+def query_lttb(session, time_column, value_column, filters, max_points, prefix=()):
+    """
+    Load (timestamp, value) pairs without building ORM objects and reduce them with LTTB.
+
+    prefix holds (timestamp, value) pairs loaded elsewhere, such as the archive,
+    that precede the queried rows. Returns a list of tuples ordered oldest first.
+    """
+    rows = list(prefix) + session.query(time_column, value_column).filter(*filters).order_by(time_column).all()
+    if len(rows) <= max_points:
+        return rows
+
+    epochs = [row[0].timestamp() for row in rows]
+    values = [row[1] for row in rows]
+    return [rows[i] for i in lttb(epochs, values, min(max_points, MAX_POINTS_LIMIT))]
@@ -0,0 +1,368 @@
+import os
+import json
+import time
+import queue
+import errno
+import socket
+import logging
+import selectors
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Optional Redis URL; when set, events published by any worker process reach every worker's subscribers
+EVENT_HUB_REDIS_URL = os.getenv('EVENT_HUB_REDIS_URL') or os.getenv('LATEST_STATE_REDIS_URL')
+EVENT_HUB_CHANNEL = os.getenv('EVENT_HUB_CHANNEL', 'gas-monitor:events')
+# Open streams per process; further subscribers get a 503 and poll instead
+EVENT_STREAM_MAX_SUBSCRIBERS = int(os.getenv('EVENT_STREAM_MAX_SUBSCRIBERS', 500))
+
+HEARTBEAT = ": heartbeat\n\n"
+RETRY = "retry: 3000\n\n"
+
+
+class Subscription:
+    """
+    A single stream client with its own bounded outbox. With a device_id it
+    receives only that device's events and events that belong to no device.
+    """
+    def __init__(self, max_queue, device_id=None):
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.device_id = device_id
+        self.dropped = False
+
+    def wants(self, device_id):
+        return self.device_id is None or device_id is None or device_id == self.device_id
+
+    def offer(self, message):
+        """
+        Queue a serialized event without blocking. Returns False if the outbox is full.
+        """
+        try:
+            self.queue.put_nowait(message)
+            return True
+        except queue.Full:
+            return False
+
+    def close(self):
+        pass
+
+
+class SocketSubscription(Subscription):
+    """
+    A stream client whose connection has been handed to the broadcaster
+    thread; its outbox is the bytes not yet written to the socket
+    """
+    def __init__(self, broadcaster, max_buffer, device_id=None):
+        super().__init__(0, device_id)
+        self.broadcaster = broadcaster
+        self.max_buffer = max_buffer
+        self.sock = None
+        self.buffer = bytearray()
+        self.lock = threading.Lock()
+
+    def offer(self, message):
+        data = message.encode()
+        with self.lock:
+            if len(self.buffer) + len(data) > self.max_buffer:
+                return False
+            self.buffer += data
+        self.broadcaster.wake()
+        return True
+
+    def close(self):
+        self.dropped = True
+        self.broadcaster.detach(self)
+
+
+class StreamBroadcaster:
+    """
+    One thread that writes every handed-off stream in the process.
+
+    Sockets are non-blocking and watched with a selector: readable means the
+    client sent something or hung up, writable is only asked for while a
+    client has bytes waiting. An idle stream costs a file descriptor and a
+    small buffer instead of a server thread. Heartbeats are added to every
+    stream every heartbeat_interval seconds.
+    """
+    def __init__(self, heartbeat_interval, on_close):
+        self.heartbeat_interval = heartbeat_interval
+        self.on_close = on_close
+        self._selector = selectors.DefaultSelector()
+        self._wake_r, self._wake_w = socket.socketpair()
+        self._wake_r.setblocking(False)
+        self._wake_w.setblocking(False)
+        self._selector.register(self._wake_r, selectors.EVENT_READ)
+        self._clients = set()
+        self._attaching = []
+        self._detaching = []
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def attach(self, subscription):
+        with self._lock:
+            self._attaching.append(subscription)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='event-broadcaster', daemon=True)
+                self._thread.start()
+        self.wake()
+
+    def detach(self, subscription):
+        with self._lock:
+            self._detaching.append(subscription)
+        self.wake()
+
+    def wake(self):
+        try:
+            self._wake_w.send(b'\0')
+        except (BlockingIOError, OSError):
+            # Already awake: the wake-up socket has unread bytes
+            pass
+
+    def _run(self):
+        next_heartbeat = time.monotonic() + self.heartbeat_interval
+        while True:
+            try:
+                self._step(max(0.0, next_heartbeat - time.monotonic()))
+                if time.monotonic() >= next_heartbeat:
+                    next_heartbeat = time.monotonic() + self.heartbeat_interval
+                    for subscription in list(self._clients):
+                        # Comment lines keep proxies from closing the idle connection
+                        if not subscription.offer(HEARTBEAT):
+                            self._close(subscription)
+                for subscription in list(self._clients):
+                    self._write(subscription)
+            except Exception as e:
+                logger.error(f"Event broadcaster error: {e}", exc_info=True)
+
+    def _step(self, timeout):
+        for key, mask in self._selector.select(timeout):
+            if key.fileobj is self._wake_r:
+                try:
+                    while self._wake_r.recv(4096):
+                        pass
+                except BlockingIOError:
+                    pass
+            elif mask & selectors.EVENT_READ:
+                self._read(key.data)
+
+        with self._lock:
+            attaching, self._attaching = self._attaching, []
+            detaching, self._detaching = self._detaching, []
+        for subscription in attaching:
+            if subscription.dropped:
+                # Dropped before its hand-off reached this thread
+                subscription.sock.close()
+                continue
+            self._clients.add(subscription)
+            self._selector.register(subscription.sock, selectors.EVENT_READ, subscription)
+        for subscription in detaching:
+            self._close(subscription)
+
+    def _read(self, subscription):
+        try:
+            data = subscription.sock.recv(4096)
+        except BlockingIOError:
+            return
+        except OSError:
+            data = b''
+        if not data:
+            # The client hung up
+            self._close(subscription)
+
+    def _write(self, subscription):
+        if subscription not in self._clients:
+            return
+        with subscription.lock:
+            pending = bytes(subscription.buffer)
+        sent = 0
+        if pending:
+            try:
+                sent = subscription.sock.send(pending)
+            except BlockingIOError:
+                pass
+            except OSError:
+                self._close(subscription)
+                return
+            with subscription.lock:
+                del subscription.buffer[:sent]
+        events = selectors.EVENT_READ | (selectors.EVENT_WRITE if sent < len(pending) else 0)
+        if self._selector.get_key(subscription.sock).events != events:
+            self._selector.modify(subscription.sock, events, subscription)
+
+    def _close(self, subscription):
+        if subscription in self._clients:
+            self._clients.discard(subscription)
+            self._selector.unregister(subscription.sock)
+            subscription.sock.close()
+        subscription.dropped = True
+        self.on_close(subscription)
+
+
+class EventHub:
+    """
+    In-process publish/subscribe hub feeding Server-Sent Event streams.
+
+    Publishing serializes each event once and hands it, without blocking, to
+    every subscriber that wants the event's device. A subscriber whose outbox
+    is full is considered too slow and is dropped; its browser reconnects and
+    reloads state from the REST endpoints.
+
+    Under gunicorn a stream's connection is handed to the broadcaster thread
+    (see hand_off()), so open streams do not hold worker threads. Elsewhere
+    (the development server) stream() serves each one on a server thread.
+    """
+    def __init__(self, max_queue=100, heartbeat_interval=15, max_subscribers=EVENT_STREAM_MAX_SUBSCRIBERS,
+                 relay=None, max_buffer=64 * 1024):
+        self.max_queue = max_queue
+        self.heartbeat_interval = heartbeat_interval
+        self.max_subscribers = max_subscribers
+        self.max_buffer = max_buffer
+        self.relay = relay
+        self._subscribers = set()
+        self._lock = threading.Lock()
+        self._broadcaster = None
+        if relay is not None:
+            relay.start(self._deliver)
+
+    @property
+    def is_shared(self):
+        """
+        Whether subscribers also receive events published by other processes
+        """
+        return self.relay is not None
+
+    @property
+    def subscriber_count(self):
+        return len(self._subscribers)
+
+    def subscribe(self, device_id=None, detached=False):
+        """
+        Register a new subscriber, or return None if the hub is at capacity.
+        A detached subscriber is served by the broadcaster thread; pass it to hand_off().
+        """
+        with self._lock:
+            if len(self._subscribers) >= self.max_subscribers:
+                return None
+            if detached:
+                if self._broadcaster is None:
+                    self._broadcaster = StreamBroadcaster(self.heartbeat_interval, self._forget)
+                subscription = SocketSubscription(self._broadcaster, self.max_buffer, device_id)
+            else:
+                subscription = Subscription(self.max_queue, device_id)
+            self._subscribers.add(subscription)
+            return subscription
+
+    def unsubscribe(self, subscription):
+        self._forget(subscription)
+        subscription.close()
+
+    def _forget(self, subscription):
+        with self._lock:
+            self._subscribers.discard(subscription)
+
+    def publish(self, event, data):
+        """
+        Send an event to its device's subscribers, dropping the ones that cannot keep up
+        """
+        message = f"event: {event}\ndata: {json.dumps(data)}\n\n"
+        device_id = data.get('device_id') if isinstance(data, dict) else None
+        if self.relay is not None:
+            try:
+                # Delivered to this process's subscribers by the relay, like everyone else's
+                self.relay.publish(message, device_id)
+                return
+            except Exception as e:
+                logger.error(f"Failed to relay event, delivering locally only: {e}")
+        self._deliver(message, device_id)
+
+    def _deliver(self, message, device_id=None):
+        with self._lock:
+            subscribers = list(self._subscribers)
+
+        for subscription in subscribers:
+            if not subscription.wants(device_id):
+                continue
+            if not subscription.offer(message):
+                subscription.dropped = True
+                self.unsubscribe(subscription)
+                logger.warning("Dropped slow event stream subscriber")
+
+    def stream(self, subscription):
+        """
+        Generate the SSE byte stream for one subscriber, with periodic heartbeats
+        """
+        try:
+            yield RETRY
+            while not subscription.dropped:
+                try:
+                    message = subscription.queue.get(timeout=self.heartbeat_interval)
+                except queue.Empty:
+                    # Comment lines keep proxies from closing the idle connection
+                    yield HEARTBEAT
+                    continue
+                if subscription.dropped:
+                    break
+                yield message
+        finally:
+            self.unsubscribe(subscription)
+
+    def hand_off(self, subscription, sock, response):
+        """
+        Body of a detached stream's response: give the connection to the broadcaster thread.
+
+        The server runs it when it starts sending the response, after Flask has
+        finished the headers. The status line and headers are queued for the
+        broadcaster on a duplicate of the socket. The request then ends with a
+        broken-pipe error, which gunicorn treats as a client that went away: it
+        closes its own descriptor without writing anything, and its thread is
+        free for the next request.
+        """
+        try:
+            head = [f"HTTP/1.1 {response.status}"]
+            head += [f"{name}: {value}" for name, value in response.headers.items() if name.lower() != 'connection']
+            head.append("Connection: close")
+            with subscription.lock:
+                # Ahead of any event published since the subscription was made
+                subscription.buffer[:0] = ("\r\n".join(head) + "\r\n\r\n" + RETRY).encode('latin-1')
+            subscription.sock = sock.dup()
+            subscription.sock.setblocking(False)
+        except Exception:
+            self.unsubscribe(subscription)
+            raise
+        subscription.broadcaster.attach(subscription)
+        raise BrokenPipeError(errno.EPIPE, "Event stream handed to the broadcaster thread")
+        yield  # A generator, so it runs when the server iterates the response
+
+
+class RedisRelay:
+    """
+    Carries serialized events between worker processes over Redis pub/sub
+    """
+    def __init__(self, url, channel=EVENT_HUB_CHANNEL):
+        import redis  # Optional dependency, only needed with several workers
+        self.client = redis.Redis.from_url(url)
+        self.channel = channel
+        self._thread = None
+
+    def publish(self, message, device_id=None):
+        self.client.publish(self.channel, json.dumps([device_id, message]))
+
+    def start(self, deliver):
+        def listen():
+            while True:
+                try:
+                    pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+                    pubsub.subscribe(self.channel)
+                    for item in pubsub.listen():
+                        device_id, message = json.loads(item['data'])
+                        deliver(message, device_id)
+                except Exception as e:
+                    logger.error(f"Event relay connection failed, reconnecting: {e}")
+                    time.sleep(1)
+
+        self._thread = threading.Thread(target=listen, name='event-relay', daemon=True)
+        self._thread.start()
+
+
+# Shared hub for the application process
+hub = EventHub(relay=RedisRelay(EVENT_HUB_REDIS_URL) if EVENT_HUB_REDIS_URL else None)
@@ -0,0 +1,300 @@
+import os
+import io
+import csv
+import json
+import heapq
+import hashlib
+import itertools
+import logging
+import threading
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+from sqlalchemy import select
+
+from utils.retention import reading_archive
+
+try:
+    import pyarrow as pa  # Optional, enables Parquet export
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
+logger = logging.getLogger(__name__)
+
+# Rows fetched per database round trip and formatted per output chunk
+EXPORT_BATCH_SIZE = int(os.getenv('EXPORT_BATCH_SIZE', 5000))
+# Finished and partial exports kept for resumed downloads
+EXPORT_DIR = os.getenv('EXPORT_DIR', 'data/exports')
+EXPORT_SPOOL_HOURS = float(os.getenv('EXPORT_SPOOL_HOURS', 24))
+
+EXPORT_FORMATS = {
+    "csv": "text/csv",
+    "ndjson": "application/x-ndjson",
+    "parquet": "application/vnd.apache.parquet"
+}
+TEXT_FORMATS = ('csv', 'ndjson')
+
+
+class ReadingExport:
+    """
+    One device's readings in [start, end), streamed oldest first.
+
+    Database rows are read through a server-side cursor in yield_per batches
+    and archived rows one day partition at a time, then merged in
+    (timestamp, id) order, so memory stays flat for any range. `after` is a
+    (timestamp, id) keyset cursor used to continue an interrupted export.
+    Rows are (id, timestamp, value, status) tuples.
+    """
+    def __init__(self, session, model, value_column, device_id, start, end, status_fn,
+                 archive=reading_archive, batch_size=EXPORT_BATCH_SIZE):
+        self.session = session
+        self.model = model
+        self.value_column = value_column
+        self.device_id = device_id
+        self.start = start
+        self.end = end
+        self.status_fn = status_fn
+        self.archive = archive
+        self.batch_size = batch_size
+
+    def _database_batches(self, after):
+        model = self.model
+        statement = select(model.id, model.timestamp, self.value_column, model.status).where(
+            model.device_id == self.device_id, model.timestamp >= self.start, model.timestamp < self.end
+        )
+        if after is not None:
+            statement = statement.where(
+                (model.timestamp > after[0]) | ((model.timestamp == after[0]) & (model.id > after[1]))
+            )
+        # Core rows skip the ORM's per-row loading; stream_results uses a server-side cursor where supported
+        result = self.session.connection().execute(
+            statement.order_by(model.timestamp, model.id).execution_options(stream_results=True)
+        )
+        return result.partitions(self.batch_size)
+
+    def _archived_rows(self, after):
+        day = self.start
+        while day < self.end:
+            day_end = min(datetime.combine(day.date() + timedelta(days=1), datetime.min.time()), self.end)
+            ids, micros, values = self.archive.read(self.device_id, day, day_end)
+            if len(ids):
+                timestamps = micros.astype(object)
+                if after is not None:
+                    keep = (micros > np.datetime64(after[0], 'us')) | (
+                        (micros == np.datetime64(after[0], 'us')) & (ids > after[1])
+                    )
+                    ids, timestamps, values = ids[keep], timestamps[keep], values[keep]
+                for reading_id, timestamp, value in zip(ids.tolist(), timestamps.tolist(), values.tolist()):
+                    yield reading_id, timestamp, value, self.status_fn(value)
+            day = day_end
+
+    def batches(self, after=None):
+        """
+        Yield lists of up to batch_size rows in (timestamp, id) order
+        """
+        archived = self._archived_rows(after)
+        first = next(archived, None)
+        if first is None:
+            # Nothing archived in range: pass database batches straight through
+            yield from self._database_batches(after)
+            return
+
+        rows = heapq.merge(
+            itertools.chain([first], archived),
+            (row for batch in self._database_batches(after) for row in batch),
+            key=lambda row: (row[1], row[0])
+        )
+        while True:
+            batch = list(itertools.islice(rows, self.batch_size))
+            if not batch:
+                return
+            yield batch
+
+
+def csv_header(value_name):
+    return f"id,device_id,timestamp,{value_name},status\r\n"
+
+
+def format_csv(batch, device_id):
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(
+        (reading_id, device_id, timestamp.isoformat(), value, status)
+        for reading_id, timestamp, value, status in batch
+    )
+    return buffer.getvalue()
+
+
+def format_ndjson(batch, device_id, value_name):
+    # Constant fields are encoded once per batch
+    prefix = f'"device_id":{json.dumps(device_id)},'
+    statuses = {}
+    lines = []
+    for reading_id, timestamp, value, status in batch:
+        encoded = statuses.get(status)
+        if encoded is None:
+            encoded = statuses[status] = json.dumps(status)
+        lines.append(
+            f'{{"id":{reading_id},{prefix}"timestamp":"{timestamp.isoformat()}",'
+            f'"{value_name}":{json.dumps(value)},"status":{encoded}}}\n'
+        )
+    return ''.join(lines)
+
+
+def text_chunks(export, fmt, value_name, after=None):
+    """
+    Yield the export as CSV or NDJSON text, one chunk per batch
+    """
+    if fmt == 'csv' and after is None:
+        yield csv_header(value_name)
+    for batch in export.batches(after):
+        if fmt == 'csv':
+            yield format_csv(batch, export.device_id)
+        else:
+            yield format_ndjson(batch, export.device_id, value_name)
+
+
+def parse_cursor(line, fmt):
+    """
+    (timestamp, id) of an exported text line, or None for the CSV header
+    """
+    if fmt == 'csv':
+        fields = next(csv.reader([line]))
+        if fields[0] == 'id':
+            return None
+        reading_id, timestamp = fields[0], fields[2]
+    else:
+        row = json.loads(line)
+        reading_id, timestamp = row['id'], row['timestamp']
+    return datetime.fromisoformat(timestamp), int(reading_id)
+
+
+def write_parquet(export, path, value_name):
+    if pa is None:
+        raise RuntimeError("Parquet export requires the pyarrow package")
+    schema = pa.schema([
+        ("id", pa.int64()), ("device_id", pa.string()), ("timestamp", pa.timestamp('us')),
+        (value_name, pa.float64()), ("status", pa.string())
+    ])
+    with pq.ParquetWriter(path, schema) as writer:
+        for batch in export.batches():
+            ids, timestamps, values, statuses = zip(*batch)
+            writer.write_table(pa.table({
+                "id": ids, "device_id": [export.device_id] * len(batch), "timestamp": timestamps,
+                value_name: values, "status": statuses
+            }, schema=schema))
+
+
+class ExportSpool:
+    """
+    Files backing resumable exports, keyed by device, range and format.
+
+    A streamed export is also written to <key>.part and renamed to the
+    finished file when complete. A request for a byte range is served from
+    the finished file, which is first completed from the partial one by
+    continuing after its last complete line. The exported range is a
+    snapshot: rows stored in it afterwards are not added.
+    """
+    def __init__(self, root=EXPORT_DIR, max_age_hours=EXPORT_SPOOL_HOURS):
+        self.root = root
+        self.max_age_hours = max_age_hours
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(device_id, start, end, fmt):
+        return hashlib.sha1(f"{device_id}|{start.isoformat()}|{end.isoformat()}|{fmt}".encode()).hexdigest()[:24]
+
+    def path(self, key, fmt):
+        # Absolute, since send_file() resolves relative paths against the app root rather than the working directory
+        return os.path.abspath(os.path.join(self.root, f"{key}.{fmt}"))
+
+    def _key_lock(self, key):
+        with self._lock:
+            return self._locks.setdefault(key, threading.Lock())
+
+    def cleanup(self):
+        """
+        Remove spool files older than max_age_hours
+        """
+        if not os.path.isdir(self.root):
+            return
+        cutoff = time.time() - self.max_age_hours * 3600
+        for name in os.listdir(self.root):
+            path = os.path.join(self.root, name)
+            try:
+                if os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+            except OSError:
+                pass
+
+    def _resume_point(self, part_path, fmt):
+        """
+        Truncate a partial text export after its last complete line and return the cursor to continue from
+        """
+        size = os.path.getsize(part_path)
+        with open(part_path, 'rb+') as f:
+            tail_start = max(size - 65536, 0)
+            f.seek(tail_start)
+            tail = f.read()
+            newline = tail.rfind(b'\n')
+            if newline < 0:
+                f.truncate(0)
+                return None, False
+            f.truncate(tail_start + newline + 1)
+            previous = tail.rfind(b'\n', 0, newline)
+            if previous < 0 and tail_start > 0:
+                # A single line longer than the tail; start over
+                f.truncate(0)
+                return None, False
+            return parse_cursor(tail[previous + 1:newline + 1].decode(), fmt), True
+
+    def complete(self, export, fmt, value_name, key):
+        """
+        Return the path of the finished export, generating or finishing it first
+        """
+        path = self.path(key, fmt)
+        with self._key_lock(key):
+            if os.path.exists(path):
+                return path
+            os.makedirs(self.root, exist_ok=True)
+            part_path = path + '.part'
+            if fmt == 'parquet':
+                write_parquet(export, part_path, value_name)
+            else:
+                after, resumed = self._resume_point(part_path, fmt) if os.path.exists(part_path) else (None, False)
+                if resumed:
+                    logger.info(f"Resuming export {key} after {after}")
+                with open(part_path, 'a' if resumed else 'w', encoding='utf-8', newline='') as f:
+                    chunks = text_chunks(export, fmt, value_name, after)
+                    if resumed and after is None and fmt == 'csv':
+                        next(chunks)  # Only the CSV header was written
+                    for chunk in chunks:
+                        f.write(chunk)
+            os.replace(part_path, path)
+        return path
+
+    def tee(self, export, fmt, value_name, key):
+        """
+        Yield a text export while spooling it for later range requests
+        """
+        lock = self._key_lock(key)
+        if os.path.exists(self.path(key, fmt)) or not lock.acquire(blocking=False):
+            # Already spooled or being spooled by another request
+            yield from text_chunks(export, fmt, value_name)
+            return
+        try:
+            os.makedirs(self.root, exist_ok=True)
+            part_path = self.path(key, fmt) + '.part'
+            with open(part_path, 'w', encoding='utf-8', newline='') as f:
+                for chunk in text_chunks(export, fmt, value_name):
+                    f.write(chunk)
+                    yield chunk
+            os.replace(part_path, self.path(key, fmt))
+        finally:
+            lock.release()
+
+
+# Shared export spool for the application process
+export_spool = ExportSpool()
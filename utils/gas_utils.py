@@ -1,16 +1,19 @@
-def get_status_from_ppm(ppm):
+import numpy as np
+
+from utils.thresholds import threshold_engine
+
+MAX_VALID_PPM = 1000  # Example threshold - adjust based on sensor specs
+
+def get_status_from_ppm(ppm, device_id=None, gas_type=None):
     """
     Determine gas level status based on PPM reading
     Returns: 'safe', 'warning', or 'danger'
     
-    Note: These thresholds should be adjusted based on the specific
-    combustible gas being monitored and sensor specifications
-    """
-    if ppm < 30:
-        return "safe"
-    elif ppm < 50:
-        return "warning"
-    return "danger"
+    Note: Thresholds come from the threshold profiles in utils/thresholds.py and
+    should be adjusted based on the specific combustible gas being monitored
+    and sensor specifications
+    """
+    return threshold_engine.status(ppm, device_id, gas_type).lower()
 
 def validate_reading(ppm):
     """
@@ -20,7 +23,30 @@ def validate_reading(ppm):
     if ppm < 0:
         return False, "Negative PPM reading detected"
     
-    if ppm > 1000:  # Example threshold - adjust based on sensor specs
+    if ppm > MAX_VALID_PPM:
         return False, "Reading exceeds maximum expected value"
     
-    return True, "Valid reading"
\ No newline at end of file
+    return True, "Valid reading"
+
+def get_statuses_from_ppm(ppm_values, device_id=None, gas_type=None):
+    """
+    Vectorized get_status_from_ppm for an array of PPM readings
+    Returns: NumPy array of 'safe', 'warning', or 'danger'
+    """
+    levels = threshold_engine.profile_for(device_id, gas_type).levels(ppm_values)
+    return np.array(["safe", "warning", "danger"])[levels]
+
+def validate_readings(ppm_values):
+    """
+    Vectorized validate_reading for an array of PPM readings
+    Returns: (is_valid mask, messages array)
+    """
+    ppm = np.asarray(ppm_values, dtype=float)
+    messages = np.full(ppm.shape, "Valid reading", dtype=object)
+    
+    with np.errstate(invalid='ignore'):
+        messages[ppm > MAX_VALID_PPM] = "Reading exceeds maximum expected value"
+        messages[ppm < 0] = "Negative PPM reading detected"
+    messages[~np.isfinite(ppm)] = "Non-numeric PPM reading"
+    
+    return messages == "Valid reading", messages
@@ -0,0 +1,51 @@
+from flask import current_app
+
+from models.gas_readings import Alert, db
+from utils.anomaly import anomaly_detector, record_anomalies
+from utils.event_hub import hub
+from utils.leader import MULTI_WORKER
+
+
+def get_notification_dispatcher():
+    """
+    Return the application's notification dispatcher; delivery runs in the process elected for background services
+    """
+    return current_app.extensions['notifications']
+
+
+def alert_message(device_id):
+    """
+    Build the alert text for a device's newly opened episode
+    """
+    return lambda level, ppm: f"Gas levels at {level.upper()} level: {ppm:g} PPM detected by device {device_id}"
+
+
+def detect_anomalies(device_id, ppm, epoch):
+    """
+    Run a live reading through the anomaly detector and add an alert for each
+    event it raises. The caller commits and publishes the returned alerts.
+    With several workers the leader runs the stored readings through the
+    detector instead, so this adds nothing.
+    """
+    if MULTI_WORKER:
+        return []
+    return record_detector_events(anomaly_detector.update(device_id, ppm, epoch))
+
+
+def record_detector_events(events):
+    """
+    Add an alert for each anomaly detector event and queue leak onsets for notification
+    """
+    return record_anomalies(db.session, Alert, events, notify=lambda alert: get_notification_dispatcher().enqueue(
+        db.session, alert.id, alert.level, alert.message, {"ppm": alert.peak_value, "device_id": alert.device_id}
+    ))
+
+
+def publish_alerts(alerts):
+    """
+    Wake the notification dispatcher and push committed alerts to dashboard clients
+    """
+    if alerts:
+        get_notification_dispatcher().wake()
+    for alert in alerts:
+        hub.publish('alert', alert.to_dict())
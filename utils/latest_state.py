@@ -0,0 +1,169 @@
+import os
+import json
+import hashlib
+import logging
+import threading
+import time
+from datetime import datetime
+
+from flask import jsonify, request
+
+from utils.leader import MULTI_WORKER
+
+logger = logging.getLogger(__name__)
+
+# Optional Redis URL; when set, all worker processes share one cache
+LATEST_STATE_REDIS_URL = os.getenv('LATEST_STATE_REDIS_URL')
+LATEST_STATE_KEY_PREFIX = os.getenv('LATEST_STATE_KEY_PREFIX', 'gas-monitor:latest:')
+# Entries are reloaded from the database after this many seconds, so writes
+# by processes that do not share the cache (e.g. the sync CLI) still show up.
+# Workers without a shared cache reload sooner to see each other's readings.
+LATEST_STATE_TTL = float(os.getenv(
+    'LATEST_STATE_TTL', 5 if MULTI_WORKER and not LATEST_STATE_REDIS_URL else 30
+))
+
+EPOCH = datetime(1970, 1, 1)
+
+
+def to_epoch(timestamp):
+    """
+    Seconds since the epoch for a naive UTC datetime
+    """
+    return (timestamp - EPOCH).total_seconds()
+
+
+class MemoryBackend:
+    """
+    Process-local store
+    """
+    def __init__(self):
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        return self._entries.get(key)
+
+    def put_if_newer(self, key, entry):
+        with self._lock:
+            current = self._entries.get(key)
+            if current is not None and current["modified"] > entry["modified"]:
+                return False
+            self._entries[key] = entry
+            return True
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+
+class RedisBackend:
+    """
+    Store shared by every process connected to the same Redis server
+    """
+    # Replace the entry unless the stored one is newer, atomically
+    PUT_IF_NEWER = """
+    local current = redis.call('GET', KEYS[1])
+    if current and cjson.decode(current)['modified'] > tonumber(ARGV[2]) then
+        return 0
+    end
+    redis.call('SET', KEYS[1], ARGV[1])
+    return 1
+    """
+
+    def __init__(self, url, prefix=LATEST_STATE_KEY_PREFIX):
+        import redis  # Optional dependency, only needed for the shared backend
+        self.client = redis.Redis.from_url(url)
+        self.prefix = prefix
+        self._put_if_newer = self.client.register_script(self.PUT_IF_NEWER)
+
+    def get(self, key):
+        value = self.client.get(self.prefix + key)
+        return json.loads(value) if value is not None else None
+
+    def put_if_newer(self, key, entry):
+        return bool(self._put_if_newer(keys=[self.prefix + key], args=[json.dumps(entry), entry["modified"]]))
+
+    def delete(self, key):
+        self.client.delete(self.prefix + key)
+
+
+class LatestState:
+    """
+    Write-through cache of each device's latest reading and system status.
+
+    Ingest paths put() what they store; status endpoints get() it without
+    querying the database and answer conditional requests from the stored
+    ETag and modification time. An entry is only replaced by one at least as
+    new, so late or backfilled writes never roll the state back. On a miss,
+    callers load the row from the database and put() it (read-through).
+    """
+    def __init__(self, backend=None, ttl=LATEST_STATE_TTL):
+        self.backend = backend or MemoryBackend()
+        self.ttl = ttl
+
+    def get(self, device_id, kind):
+        """
+        Return the cached entry ({"data", "etag", "modified"}) for a device, or None
+        """
+        try:
+            entry = self.backend.get(f"{kind}:{device_id}")
+        except Exception as e:
+            logger.error(f"Latest state lookup failed for {device_id}: {e}")
+            return None
+        if entry is not None and time.time() - entry["cached_at"] > self.ttl:
+            return None
+        return entry
+
+    def put(self, device_id, kind, data, modified):
+        """
+        Cache the response body of a device's latest state modified at `modified` (naive UTC)
+        """
+        body = json.dumps(data, sort_keys=True, default=str)
+        entry = {
+            # Stored as decoded JSON so both backends return the same shape
+            "data": json.loads(body),
+            "etag": hashlib.sha1(body.encode()).hexdigest()[:20],
+            "modified": to_epoch(modified),
+            "cached_at": time.time()
+        }
+        try:
+            self.backend.put_if_newer(f"{kind}:{device_id}", entry)
+        except Exception as e:
+            logger.error(f"Latest state update failed for {device_id}: {e}")
+        return entry
+
+    def invalidate(self, device_id, kind):
+        try:
+            self.backend.delete(f"{kind}:{device_id}")
+        except Exception as e:
+            logger.error(f"Latest state invalidation failed for {device_id}: {e}")
+
+
+def cache_sensor_reading(reading):
+    """
+    Cache a GasReading (stored or not) in the /api/current-reading response shape
+    """
+    return latest_state.put(reading.device_id, 'reading', reading.to_dict(), reading.timestamp)
+
+
+def cache_system_status(status):
+    """
+    Cache a SystemStatus row in the /api/system-status response shape
+    """
+    return latest_state.put(status.device_id, 'system_status', status.to_dict(), status.last_update or EPOCH)
+
+
+def conditional_response(entry):
+    """
+    JSON response for a cached entry, or 304 Not Modified if the client already has it
+    """
+    response = jsonify(entry["data"])
+    response.set_etag(entry["etag"])
+    response.last_modified = datetime.utcfromtimestamp(entry["modified"])
+    # Clients may keep the body but must revalidate on every poll
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
+
+# Shared cache for the application process
+latest_state = LatestState(RedisBackend(LATEST_STATE_REDIS_URL) if LATEST_STATE_REDIS_URL else None)
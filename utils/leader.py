@@ -0,0 +1,189 @@
+import os
+import time
+import signal
+import atexit
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+# "file" (a lock file on this host), "db" (an advisory lock on PostgreSQL or MySQL) or "auto"
+LEADER_LOCK = os.getenv('LEADER_LOCK', 'auto').lower()
+LEADER_LOCK_PATH = os.getenv('LEADER_LOCK_PATH', 'data/leader.lock')
+# Advisory lock key, shared by every process of one deployment
+LEADER_LOCK_KEY = int(os.getenv('LEADER_LOCK_KEY', 7454311))
+# Seconds between election attempts by standby workers, and health checks by the leader
+LEADER_RETRY_SECONDS = float(os.getenv('LEADER_RETRY_SECONDS', 5))
+
+# Set for every worker by gunicorn.conf.py when it starts more than one
+MULTI_WORKER = os.getenv('MULTI_WORKER', 'False').lower() in ('true', '1', 't')
+
+
+class FileLock:
+    """
+    Exclusive flock() on a local file. The kernel releases it when the holder exits, however it exits.
+    """
+    def __init__(self, path=LEADER_LOCK_PATH):
+        self.path = path
+        self._fd = None
+
+    def try_acquire(self):
+        import fcntl
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            os.close(fd)
+            return False
+        os.ftruncate(fd, 0)
+        os.write(fd, f'{os.getpid()}\n'.encode())
+        self._fd = fd
+        return True
+
+    def is_held(self):
+        return self._fd is not None
+
+    def release(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+
+class AdvisoryLock:
+    """
+    Session-level advisory lock on a dedicated database connection.
+
+    PostgreSQL (pg_try_advisory_lock) and MySQL (GET_LOCK) release it when
+    the connection closes, so a leader that dies or loses its connection
+    frees it for the standbys.
+    """
+    def __init__(self, engine, key=LEADER_LOCK_KEY):
+        self.engine = engine
+        self.key = key
+        self._connection = None
+
+    def _statements(self):
+        from sqlalchemy import text
+        if self.engine.dialect.name == 'postgresql':
+            return text('SELECT pg_try_advisory_lock(:key)'), text('SELECT pg_advisory_unlock(:key)')
+        if self.engine.dialect.name == 'mysql':
+            return text("SELECT GET_LOCK(CONCAT('gas-monitor-', :key), 0)"), \
+                text("SELECT RELEASE_LOCK(CONCAT('gas-monitor-', :key))")
+        raise ValueError(f"Advisory locks are not supported on {self.engine.dialect.name}")
+
+    def try_acquire(self):
+        acquire, _ = self._statements()
+        connection = self.engine.connect()
+        try:
+            acquired = bool(connection.execute(acquire, {"key": self.key}).scalar())
+        except Exception:
+            connection.close()
+            raise
+        if not acquired:
+            connection.close()
+            return False
+        self._connection = connection
+        return True
+
+    def is_held(self):
+        if self._connection is None:
+            return False
+        try:
+            from sqlalchemy import text
+            self._connection.execute(text('SELECT 1'))
+            return True
+        except Exception as e:
+            logger.error(f"Lost the leader lock connection: {e}")
+            self._connection = None
+            return False
+
+    def release(self):
+        if self._connection is not None:
+            _, release = self._statements()
+            try:
+                self._connection.execute(release, {"key": self.key})
+            finally:
+                self._connection.close()
+                self._connection = None
+
+
+def leader_lock(engine, kind=LEADER_LOCK):
+    """
+    The lock for this deployment: an advisory lock on server databases, else a lock file
+    """
+    if kind == 'db' or (kind == 'auto' and engine.dialect.name in ('postgresql', 'mysql')):
+        return AdvisoryLock(engine)
+    return FileLock()
+
+
+class LeaderElection:
+    """
+    Elects one process of a deployment to run its singleton background work.
+
+    Every worker calls start(); the one that takes the lock runs on_elected()
+    and the others retry every retry_seconds, so a standby takes over within
+    that time if the leader dies. A leader that finds its lock gone (e.g. the
+    database connection dropped) stops serving by sending itself SIGTERM, so
+    the server replaces it with a fresh standby. Two collectors never run at once.
+    """
+    def __init__(self, lock, on_elected, retry_seconds=LEADER_RETRY_SECONDS):
+        self.lock = lock
+        self.on_elected = on_elected
+        self.retry_seconds = retry_seconds
+        self.is_leader = False
+        self.elected_at = None
+        self._stopping = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """
+        Try to become leader now, then keep trying (or checking the lock) in the background
+        """
+        if self._thread is None:
+            self._attempt()
+            self._thread = threading.Thread(target=self._run, name='leader-election', daemon=True)
+            self._thread.start()
+            atexit.register(self.stop)
+        return self
+
+    def stop(self):
+        self._stopping.set()
+        if self.is_leader:
+            self.lock.release()
+            self.is_leader = False
+
+    def stats(self):
+        return {
+            "is_leader": self.is_leader,
+            "pid": os.getpid(),
+            "leader_seconds": round(time.monotonic() - self.elected_at, 1) if self.is_leader else 0.0
+        }
+
+    def _attempt(self):
+        try:
+            acquired = self.lock.try_acquire()
+        except Exception as e:
+            logger.error(f"Leader election failed: {e}")
+            return
+        if not acquired:
+            return
+        self.is_leader = True
+        self.elected_at = time.monotonic()
+        logger.info(f"Process {os.getpid()} elected leader; starting background services")
+        try:
+            self.on_elected()
+        except Exception as e:
+            logger.error(f"Failed to start background services: {e}", exc_info=True)
+
+    def _run(self):
+        while not self._stopping.wait(self.retry_seconds):
+            if not self.is_leader:
+                self._attempt()
+            elif not self.lock.is_held():
+                logger.error(f"Process {os.getpid()} lost leadership; exiting so it can be replaced")
+                self.is_leader = False
+                os.kill(os.getpid(), signal.SIGTERM)
+                return
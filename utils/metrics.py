@@ -0,0 +1,465 @@
+import os
+import json
+import time
+import queue
+import atexit
+import logging
+import threading
+import logging.handlers
+from bisect import bisect_left
+from contextlib import contextmanager
+
+# Every Nth routine per-reading log line is written (1 logs all of them)
+LOG_SAMPLE_EVERY = max(int(os.getenv('LOG_SAMPLE_EVERY', 100)), 1)
+# Log records waiting for the writer thread; further records are dropped while it is full
+LOG_QUEUE_SIZE = int(os.getenv('LOG_QUEUE_SIZE', 10000))
+
+# Latency buckets in seconds, from sub-millisecond commits to slow cloud calls
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+# Directory where every worker process publishes its metrics so /metrics reports all of them (set by
+# gunicorn.conf.py when it starts several workers); unset, /metrics reports the scraped process only
+METRICS_DIR = os.getenv('METRICS_DIR')
+# Seconds between a worker's published snapshots; other workers' values are at most this old
+METRICS_PUBLISH_SECONDS = float(os.getenv('METRICS_PUBLISH_SECONDS', 5))
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', ' ').replace('"', '\\"')
+
+
+def _label_text(names, values):
+    if not names:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in zip(names, values)) + '}'
+
+
+class Counter:
+    """
+    Monotonically increasing count, one series per combination of label values
+    """
+    kind = 'counter'
+
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels.get(name, '') for name in self.labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self._values)
+
+    @staticmethod
+    def merge(total, values):
+        for key, value in values.items():
+            total[key] = total.get(key, 0) + value
+
+    def samples(self, values=None):
+        values = self.snapshot() if values is None else values
+        for key, value in sorted(values.items()):
+            yield f'{self.name}{_label_text(self.labels, key)} {value}'
+
+
+class Histogram:
+    """
+    Distribution of observed values over fixed cumulative buckets, per label combination
+    """
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+        self.buckets = tuple(sorted(buckets))
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(labels.get(name, '') for name in self.labels)
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                # Per-bucket counts plus the +Inf bucket, then sum and count
+                series = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """
+        Observe the wall time of a block in seconds
+        """
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def snapshot(self):
+        with self._lock:
+            return {key: (list(counts), total, count) for key, (counts, total, count) in self._series.items()}
+
+    @staticmethod
+    def merge(total, series):
+        for key, (counts, value_sum, count) in series.items():
+            merged = total.get(key)
+            if merged is None:
+                total[key] = (list(counts), value_sum, count)
+            else:
+                total[key] = ([a + b for a, b in zip(merged[0], counts)], merged[1] + value_sum, merged[2] + count)
+
+    def samples(self, series=None):
+        series = self.snapshot() if series is None else series
+        for key, (counts, total, count) in sorted(series.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += bucket_count
+                le = bound if bound == '+Inf' else repr(float(bound))
+                yield f'{self.name}_bucket{_label_text(self.labels + ("le",), key + (le,))} {cumulative}'
+            yield f'{self.name}_sum{_label_text(self.labels, key)} {total}'
+            yield f'{self.name}_count{_label_text(self.labels, key)} {count}'
+
+
+class MetricsRegistry:
+    """
+    Process-wide counters and histograms rendered in the Prometheus text format.
+
+    Counters and histograms are updated on the hot paths under a short lock.
+    Components that already keep a stats() dict (queues, collector, dispatcher)
+    are registered as sources instead and only read when /metrics is scraped.
+
+    With a directory, every process writes a snapshot of its values there
+    (see publish) and render() reports them all: counters and histograms are
+    summed over the processes, including ones that exited, so they never go
+    backwards, and source gauges get a worker label for each live process.
+    """
+    def __init__(self, directory=None, publish_seconds=METRICS_PUBLISH_SECONDS):
+        self.directory = directory
+        self.publish_seconds = publish_seconds
+        self._metrics = {}
+        self._sources = []
+        self._lock = threading.Lock()
+        self._publisher = None
+
+    def _get_or_create(self, cls, name, help_text, labels, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, help_text, labels, **kwargs)
+            elif not isinstance(metric, cls):
+                raise ValueError(f"Metric {name} is already registered as a {metric.kind}")
+            return metric
+
+    def counter(self, name, help_text, labels=()):
+        return self._get_or_create(Counter, name, help_text, labels)
+
+    def histogram(self, name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+        return self._get_or_create(Histogram, name, help_text, labels, buckets=buckets)
+
+    def register_stats(self, prefix, stats_fn, counters=(), help_text=''):
+        """
+        Expose the numeric values of stats_fn() as {prefix}_{key} gauges, or
+        {prefix}_{key}_total counters for the keys listed in counters.
+        Booleans are exported as 0/1; nested dicts and other values are skipped.
+        """
+        with self._lock:
+            self._sources.append((prefix, stats_fn, frozenset(counters), help_text))
+
+    def _source_values(self, prefix, stats_fn, counters, help_text):
+        try:
+            stats = stats_fn()
+        except Exception as e:
+            logging.getLogger(__name__).error(f"Failed to read {prefix} stats: {e}")
+            return
+        for key, value in sorted(stats.items()):
+            if isinstance(value, bool):
+                value = int(value)
+            elif not isinstance(value, (int, float)):
+                continue
+            kind = 'counter' if key in counters else 'gauge'
+            name = f'{prefix}_{key}_total' if kind == 'counter' else f'{prefix}_{key}'
+            yield name, kind, f'{help_text}: {key}' if help_text else '', value
+
+    def _collect(self):
+        with self._lock:
+            metrics = list(self._metrics.values())
+            sources = list(self._sources)
+        values = []
+        for source in sources:
+            values.extend(self._source_values(*source))
+        return metrics, values
+
+    def publish(self):
+        """
+        Write this process's values to {directory}/{pid}.json for the other processes to render
+        """
+        metrics, sources = self._collect()
+        snapshot = {
+            "metrics": {
+                metric.name: [[list(key), value] for key, value in metric.snapshot().items()] for metric in metrics
+            },
+            "sources": sources
+        }
+        path = os.path.join(self.directory, f'{os.getpid()}.json')
+        os.makedirs(self.directory, exist_ok=True)
+        with open(f'{path}.tmp', 'w', encoding='utf-8') as f:
+            json.dump(snapshot, f)
+        os.replace(f'{path}.tmp', path)
+
+    def start_publishing(self):
+        """
+        Publish every publish_seconds from a daemon thread, and once more at exit; no-op without a directory
+        """
+        if self.directory is None or self._publisher is not None:
+            return
+        stop = threading.Event()
+
+        def run():
+            while not stop.wait(self.publish_seconds):
+                try:
+                    self.publish()
+                except OSError as e:
+                    logging.getLogger(__name__).error(f"Failed to publish metrics: {e}")
+
+        def final():
+            stop.set()
+            self.publish()
+
+        self._publisher = threading.Thread(target=run, name='metrics-publisher', daemon=True)
+        self._publisher.start()
+        atexit.register(final)
+
+    def _snapshots(self):
+        snapshots = {}
+        for filename in os.listdir(self.directory):
+            if not filename.endswith('.json'):
+                continue
+            try:
+                with open(os.path.join(self.directory, filename), encoding='utf-8') as f:
+                    snapshots[int(filename[:-5])] = json.load(f)
+            except (OSError, ValueError) as e:
+                logging.getLogger(__name__).warning(f"Skipping metrics snapshot {filename}: {e}")
+        return snapshots
+
+    def render(self):
+        """
+        All metrics in the Prometheus text exposition format, over all processes when there is a directory
+        """
+        metrics, sources = self._collect()
+        if self.directory is None:
+            merged = {metric.name: None for metric in metrics}
+            snapshots = {os.getpid(): {"sources": sources}}
+        else:
+            self.publish()
+            snapshots = self._snapshots()
+            merged = {}
+            for metric in metrics:
+                total = merged[metric.name] = {}
+                for snapshot in snapshots.values():
+                    values = snapshot["metrics"].get(metric.name, [])
+                    metric.merge(total, {tuple(key): value for key, value in values})
+
+        lines = []
+        for metric in metrics:
+            lines.append(f'# HELP {metric.name} {metric.help}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            lines.extend(metric.samples(merged[metric.name]))
+        lines.extend(self._source_lines(snapshots))
+        return '\n'.join(lines) + '\n'
+
+    def _source_lines(self, snapshots):
+        # Counters are summed over all snapshots; gauges describe a live process and are labelled with it
+        series = {}
+        for pid, snapshot in sorted(snapshots.items()):
+            alive = self.directory is None or _is_alive(pid)
+            for name, kind, help_text, value in snapshot["sources"]:
+                entry = series.setdefault(name, {"kind": kind, "help": help_text, "values": {}})
+                if kind == 'counter':
+                    entry["values"][None] = entry["values"].get(None, 0) + value
+                elif alive:
+                    entry["values"][pid] = value
+        for name, entry in series.items():
+            if not entry["values"]:
+                continue
+            if entry["help"]:
+                yield f'# HELP {name} {entry["help"]}'
+            yield f'# TYPE {name} {entry["kind"]}'
+            for pid, value in entry["values"].items():
+                if pid is None or self.directory is None:
+                    yield f'{name} {value}'
+                else:
+                    yield f'{name}{_label_text(("worker",), (pid,))} {value}'
+
+
+def _is_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+# Shared registry for the application process
+metrics = MetricsRegistry(METRICS_DIR)
+
+INGEST_SECONDS = metrics.histogram(
+    'gas_ingest_seconds', 'Time to accept a reading or batch, by ingest route', labels=('route',)
+)
+DB_COMMIT_SECONDS = metrics.histogram(
+    'gas_db_commit_seconds', 'Time spent flushing and committing a database transaction'
+)
+DB_ROLLBACKS = metrics.counter('gas_db_rollbacks_total', 'Database transactions rolled back')
+ARDUINO_REQUEST_SECONDS = metrics.histogram(
+    'gas_arduino_request_seconds', 'Arduino Cloud HTTP request latency, by call and status code',
+    labels=('call', 'code')
+)
+ARDUINO_RETRIES = metrics.counter(
+    'gas_arduino_retries_total', 'Failed Arduino Cloud attempts made under a retry policy, by call', labels=('call',)
+)
+COLLECTOR_LAG_SECONDS = metrics.histogram(
+    'gas_collector_lag_seconds', 'How late each collector poll started relative to its schedule',
+    buckets=(0.01, 0.05, 0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+)
+ALERTS_CREATED = metrics.counter('gas_alerts_created_total', 'Alerts opened, by level', labels=('level',))
+LOG_RECORDS_DROPPED = metrics.counter(
+    'gas_log_records_dropped_total', 'Log records dropped because the log queue was full'
+)
+
+
+def count_retry(call):
+    """
+    tenacity `after` callback that counts every failed attempt of a call
+    """
+    def after(retry_state):
+        ARDUINO_RETRIES.inc(call=call)
+    return after
+
+
+def arduino_call(url):
+    """
+    Low-cardinality name of an Arduino Cloud endpoint, without thing or property IDs
+    """
+    path = url.split('?', 1)[0].rstrip('/')
+    if path.endswith('/token'):
+        return 'token'
+    if path.endswith('/timeseries'):
+        return 'timeseries'
+    if path.endswith('/properties'):
+        return 'properties'
+    if '/properties/' in path:
+        return 'property'
+    return 'other'
+
+
+def observe_response(response, *args, **kwargs):
+    """
+    requests response hook recording the latency of every Arduino Cloud call
+    """
+    ARDUINO_REQUEST_SECONDS.observe(
+        response.elapsed.total_seconds(), call=arduino_call(response.request.url), code=response.status_code
+    )
+    return response
+
+
+def observe_commits(session):
+    """
+    Time every flush and commit of a (scoped) SQLAlchemy session, and count rollbacks
+    """
+    from sqlalchemy import event
+
+    def before_commit(session):
+        session.info.setdefault('commit_started', time.perf_counter())
+
+    def after_commit(session):
+        started = session.info.pop('commit_started', None)
+        if started is not None:
+            DB_COMMIT_SECONDS.observe(time.perf_counter() - started)
+
+    def after_rollback(session):
+        session.info.pop('commit_started', None)
+        DB_ROLLBACKS.inc()
+
+    event.listen(session, 'before_commit', before_commit)
+    event.listen(session, 'after_commit', after_commit)
+    event.listen(session, 'after_rollback', after_rollback)
+
+
+class SampleFilter(logging.Filter):
+    """
+    Pass one in `every` records logged with extra={'sample': key}, per key.
+    Records without a sample key always pass.
+    """
+    def __init__(self, every=LOG_SAMPLE_EVERY):
+        super().__init__()
+        self.every = every
+        self._seen = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        key = getattr(record, 'sample', None)
+        if key is None or self.every <= 1:
+            return True
+        with self._lock:
+            seen = self._seen.get(key, 0)
+            self._seen[key] = seen + 1
+        if seen % self.every:
+            return False
+        if seen:
+            record.msg = f'{record.msg} (1 of {self.every} logged)'
+        return True
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler that drops and counts records instead of blocking when the queue is full
+    """
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            LOG_RECORDS_DROPPED.inc()
+
+
+def configure_logging(filename, fmt, level=logging.INFO):
+    """
+    Log to stdout and a file from a background thread.
+
+    Request threads only put records on a bounded queue; formatting and the
+    file and console writes happen on the listener thread, which is drained
+    at exit. Routine per-reading records are sampled (see SampleFilter).
+    """
+    root = logging.getLogger()
+    if root.handlers:
+        # Already configured, e.g. by main when imported from the sync script
+        return None
+
+    formatter = logging.Formatter(fmt)
+    handlers = [logging.FileHandler(filename, encoding='utf-8'), logging.StreamHandler()]
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    log_queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+    queue_handler = DroppingQueueHandler(log_queue)
+    # Only merges the arguments (and traceback) into the message; the listener's handlers apply fmt
+    queue_handler.setFormatter(logging.Formatter('%(message)s'))
+    queue_handler.addFilter(SampleFilter())
+    logging.basicConfig(level=level, handlers=[queue_handler])
+
+    listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    metrics.register_stats('gas_log_queue', lambda: {"depth": log_queue.qsize()})
+    return listener
@@ -1,31 +1,354 @@
+import os
+import json
+import atexit
 import logging
-from datetime import datetime
+import smtplib
+import threading
+from datetime import datetime, timedelta
+from email.message import EmailMessage
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlalchemy import func
+
+from utils.arduino_cloud import get_session
+from utils.database import begin_write
+from utils.scheduler import TokenBucket
+
+# Recipients per channel, comma-separated
+SMS_RECIPIENTS = os.getenv('SMS_RECIPIENTS', '+1234567890')
+WEBHOOK_URLS = os.getenv('WEBHOOK_URLS', '')
+EMAIL_RECIPIENTS = os.getenv('EMAIL_RECIPIENTS', '')
+SMTP_HOST = os.getenv('SMTP_HOST')
+SMTP_PORT = int(os.getenv('SMTP_PORT', 587))
+SMTP_USER = os.getenv('SMTP_USER')
+SMTP_PASSWORD = os.getenv('SMTP_PASSWORD')
+SMTP_SENDER = os.getenv('SMTP_SENDER', 'gas-monitor@localhost')
+
+# Dispatcher settings
+NOTIFY_WORKERS = int(os.getenv('NOTIFY_WORKERS', 4))
+NOTIFY_POLL_SECONDS = float(os.getenv('NOTIFY_POLL_SECONDS', 2))
+# Alerts for the same recipient within this window are sent as one message
+NOTIFY_COALESCE_SECONDS = float(os.getenv('NOTIFY_COALESCE_SECONDS', 60))
+# Messages per recipient per hour, and how many may be sent back to back
+NOTIFY_RATE_PER_HOUR = float(os.getenv('NOTIFY_RATE_PER_HOUR', 20))
+NOTIFY_RATE_BURST = float(os.getenv('NOTIFY_RATE_BURST', 3))
+NOTIFY_MAX_ATTEMPTS = int(os.getenv('NOTIFY_MAX_ATTEMPTS', 5))
+NOTIFY_RETRY_BASE_SECONDS = float(os.getenv('NOTIFY_RETRY_BASE_SECONDS', 5))
+NOTIFY_RETRY_MAX_SECONDS = float(os.getenv('NOTIFY_RETRY_MAX_SECONDS', 600))
+# Outbox rows claimed per dispatcher pass
+NOTIFY_BATCH_SIZE = 100
+
+PENDING, SENDING, SENT, COALESCED, FAILED = 'pending', 'sending', 'sent', 'coalesced', 'failed'
+
+
+def split_list(value):
+    return [item.strip() for item in value.split(',') if item.strip()]
+
 
 def send_notification(message, level, data=None):
     """
     Send notifications when gas levels are at warning or danger levels.
-    
+
     This is a backend notification system. The hardware will handle the actual
     SMS sending through the GSM module, but we log it here and mark it in the database.
-    
+
     Returns True to indicate notification was logged (actual SMS sending is handled by hardware)
     """
     logging.info(f"[{datetime.now().isoformat()}] ALERT {level.upper()}: {message}")
-    
+
     # Log that a notification should be sent via GSM
     # The actual SMS sending will be handled by the ESP8266 with GSM module
     logging.info(f"Notification marked for GSM delivery: {message}")
-    
+
     return True
 
+
+# SMS configuration for the GSM module, built once from the environment
+SMS_CONFIG = {
+    "recipient_numbers": split_list(SMS_RECIPIENTS),
+    "alert_threshold": os.getenv('SMS_ALERT_THRESHOLD', 'warning'),  # Send SMS for both warning and danger levels
+    "include_ppm": True,
+    "include_timestamp": True
+}
+
+
 def get_sms_config():
     """
     Return SMS configuration for the GSM module
     This would be sent to the ESP8266 to configure the GSM module
     """
-    return {
-        "recipient_numbers": ["+1234567890"],  # Replace with actual numbers
-        "alert_threshold": "warning",  # Send SMS for both warning and danger levels
-        "include_ppm": True,
-        "include_timestamp": True
-    }
\ No newline at end of file
+    return SMS_CONFIG
+
+
+class GsmHandler:
+    """
+    Marks SMS for delivery by the device's GSM module; the hardware sends the actual message
+    """
+    def send(self, recipient, level, message, payload):
+        send_notification(f"{message} -> {recipient}", level, payload)
+
+
+class WebhookHandler:
+    """
+    POSTs the alert as JSON to the recipient URL
+    """
+    def send(self, recipient, level, message, payload):
+        response = get_session().post(
+            recipient, json={"level": level, "message": message, **payload}, timeout=10
+        )
+        response.raise_for_status()
+
+
+class EmailHandler:
+    """
+    Sends the alert through the configured SMTP server
+    """
+    def send(self, recipient, level, message, payload):
+        email = EmailMessage()
+        email['Subject'] = f"Gas alert: {level}"
+        email['From'] = SMTP_SENDER
+        email['To'] = recipient
+        email.set_content(message)
+        with smtplib.SMTP(SMTP_HOST, SMTP_PORT, timeout=10) as smtp:
+            if SMTP_USER:
+                smtp.starttls()
+                smtp.login(SMTP_USER, SMTP_PASSWORD)
+            smtp.send_message(email)
+
+
+class RecordingHandler:
+    """
+    Local stand-in that records messages instead of delivering them
+    """
+    def __init__(self, fail_times=0):
+        self.sent = []
+        self.fail_times = fail_times
+        self._lock = threading.Lock()
+
+    def send(self, recipient, level, message, payload):
+        with self._lock:
+            if self.fail_times > 0:
+                self.fail_times -= 1
+                raise ConnectionError("Simulated delivery failure")
+            self.sent.append((recipient, level, message, payload))
+
+
+def default_channels():
+    """
+    Handlers and recipients for each configured channel
+    """
+    channels = {"sms": (GsmHandler(), split_list(SMS_RECIPIENTS))}
+    if WEBHOOK_URLS:
+        channels["webhook"] = (WebhookHandler(), split_list(WEBHOOK_URLS))
+    if EMAIL_RECIPIENTS and SMTP_HOST:
+        channels["email"] = (EmailHandler(), split_list(EMAIL_RECIPIENTS))
+    return channels
+
+
+class NotificationDispatcher:
+    """
+    Delivers alert notifications from a persistent outbox on a worker pool.
+
+    enqueue() only adds outbox rows to the caller's transaction, so ingest
+    commits and responds before any delivery starts. A dispatcher thread
+    claims due rows and hands each recipient's batch to the pool:
+    - The first alert for a recipient goes out immediately. Later alerts
+      within coalesce_seconds are held and sent together as one message.
+    - Each recipient has a token bucket of rate_per_hour messages.
+    - Failed deliveries are retried with exponential backoff up to
+      max_attempts, then marked failed.
+    Handlers are pluggable per channel; pass RecordingHandler to test without
+    delivery.
+    """
+    def __init__(self, app, model, channels=None, workers=NOTIFY_WORKERS, poll_seconds=NOTIFY_POLL_SECONDS,
+                 coalesce_seconds=NOTIFY_COALESCE_SECONDS, rate_per_hour=NOTIFY_RATE_PER_HOUR,
+                 burst=NOTIFY_RATE_BURST, max_attempts=NOTIFY_MAX_ATTEMPTS):
+        self.app = app
+        self.model = model
+        self.channels = channels if channels is not None else default_channels()
+        self.poll_seconds = poll_seconds
+        self.coalesce_seconds = coalesce_seconds
+        self.rate_per_hour = rate_per_hour
+        self.burst = burst
+        self.max_attempts = max_attempts
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='notify')
+        self._last_sent = {}
+        self._buckets = {}
+        self._in_flight = set()
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopping = threading.Event()
+        self._thread = None
+        self._stats = {"enqueued": 0, "delivered": 0, "messages": 0, "coalesced": 0, "retried": 0, "failed": 0}
+
+    def register_handler(self, channel, handler, recipients):
+        self.channels[channel] = (handler, list(recipients))
+
+    def enqueue(self, session, alert_id, level, message, payload=None):
+        """
+        Add one outbox row per channel recipient to the caller's transaction
+        """
+        now = datetime.utcnow()
+        body = json.dumps(payload or {}, default=str)
+        for channel, (_, recipients) in self.channels.items():
+            for recipient in recipients:
+                session.add(self.model(
+                    alert_id=alert_id, channel=channel, recipient=recipient, level=level, message=message,
+                    payload=body, status=PENDING, attempts=0, created_at=now, next_attempt_at=now
+                ))
+                self._stats["enqueued"] += 1
+
+    def wake(self):
+        """
+        Start a dispatcher pass now instead of at the next poll
+        """
+        self._wake.set()
+
+    def start(self):
+        if self._thread is None:
+            with self.app.app_context():
+                model = self.model
+                # Rows claimed by a process that died mid-delivery are retried
+                model.query.filter_by(status=SENDING).update({"status": PENDING}, synchronize_session=False)
+                model.query.session.commit()
+                # Keep coalescing windows across restarts
+                for channel, recipient, sent_at in model.query.session.query(
+                    model.channel, model.recipient, func.max(model.sent_at)
+                ).filter(model.status == SENT).group_by(model.channel, model.recipient):
+                    self._last_sent[(channel, recipient)] = sent_at
+            self._thread = threading.Thread(target=self._run, name='notification-dispatcher', daemon=True)
+            self._thread.start()
+            atexit.register(self.stop)
+        return self
+
+    def stop(self, timeout=10):
+        self._stopping.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+        self._pool.shutdown(wait=True)
+
+    def stats(self):
+        return dict(self._stats)
+
+    def _bucket(self, key):
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = TokenBucket(self.rate_per_hour / 3600, self.burst)
+        return bucket
+
+    def _run(self):
+        while not self._stopping.is_set():
+            try:
+                with self.app.app_context():
+                    self._dispatch()
+            except Exception as e:
+                logging.error(f"Notification dispatch failed: {e}", exc_info=True)
+            self._wake.wait(self.poll_seconds)
+            self._wake.clear()
+
+    def _dispatch(self):
+        """
+        Claim due outbox rows and submit one delivery per recipient
+        """
+        model = self.model
+        session = model.query.session
+        now = datetime.utcnow()
+        due = (model.status == PENDING, model.next_attempt_at <= now)
+        # Most passes find nothing due; only a pass with rows to claim takes the write lock
+        found = session.query(model.id).filter(*due).limit(1).scalar()
+        session.close()
+        if found is None:
+            return
+        begin_write(session)
+        rows = model.query.filter(*due).order_by(model.next_attempt_at, model.id).limit(NOTIFY_BATCH_SIZE).all()
+
+        by_recipient = {}
+        for row in rows:
+            by_recipient.setdefault((row.channel, row.recipient), []).append(row)
+
+        claimed = []
+        for key, group in by_recipient.items():
+            with self._lock:
+                if key in self._in_flight:
+                    continue
+                # Hold alerts that arrive within the coalescing window of the last message
+                last_sent = self._last_sent.get(key)
+                held_until = (last_sent - now).total_seconds() + self.coalesce_seconds if last_sent else 0
+                if held_until <= 0:
+                    held_until = self._bucket(key).acquire()
+                if held_until > 0:
+                    for row in group:
+                        row.next_attempt_at = now + timedelta(seconds=held_until)
+                    continue
+                self._in_flight.add(key)
+            for row in group:
+                row.status = SENDING
+            claimed.append((key, [row.id for row in group]))
+        session.commit()
+
+        for key, row_ids in claimed:
+            self._pool.submit(self._deliver, key, row_ids)
+
+    def _deliver(self, key, row_ids):
+        channel, recipient = key
+        try:
+            with self.app.app_context():
+                model = self.model
+                session = model.query.session
+                rows = model.query.filter(model.id.in_(row_ids)).order_by(model.created_at).all()
+                if not rows:
+                    return
+                handler = self.channels[channel][0]
+                level = next((row.level for row in rows if row.level.lower() == 'danger'), rows[-1].level)
+                if len(rows) == 1:
+                    message = rows[0].message
+                else:
+                    message = f"{len(rows)} gas alerts:\n" + "\n".join(row.message for row in rows)
+                payload = json.loads(rows[-1].payload or '{}')
+                # No transaction stays open during delivery; the outcome is recorded in a write transaction
+                session.close()
+
+                try:
+                    handler.send(recipient, level, message, payload)
+                except Exception as e:
+                    begin_write(session)
+                    rows = model.query.filter(model.id.in_(row_ids)).order_by(model.created_at).all()
+                    if rows:
+                        self._retry(rows, e)
+                    session.commit()
+                    return
+
+                begin_write(session)
+                rows = model.query.filter(model.id.in_(row_ids)).order_by(model.created_at).all()
+                sent_at = datetime.utcnow()
+                for i, row in enumerate(rows):
+                    row.status = SENT if i == len(rows) - 1 else COALESCED
+                    row.sent_at = sent_at
+                    row.attempts += 1
+                with self._lock:
+                    self._last_sent[key] = sent_at
+                self._stats["messages"] += 1
+                self._stats["delivered"] += len(rows)
+                self._stats["coalesced"] += len(rows) - 1
+                session.commit()
+        except Exception as e:
+            logging.error(f"Failed to record notification delivery to {recipient}: {e}", exc_info=True)
+        finally:
+            with self._lock:
+                self._in_flight.discard(key)
+
+    def _retry(self, rows, error):
+        now = datetime.utcnow()
+        for row in rows:
+            row.attempts += 1
+            row.last_error = str(error)[:255]
+            if row.attempts >= self.max_attempts:
+                row.status = FAILED
+                self._stats["failed"] += 1
+                continue
+            delay = min(NOTIFY_RETRY_BASE_SECONDS * 2 ** (row.attempts - 1), NOTIFY_RETRY_MAX_SECONDS)
+            row.status = PENDING
+            row.next_attempt_at = now + timedelta(seconds=delay)
+            self._stats["retried"] += 1
+        logging.warning(f"Notification to {rows[0].recipient} failed ({error}); {len(rows)} queued for retry")
@@ -0,0 +1,78 @@
+import base64
+from datetime import datetime
+
+from sqlalchemy import and_, or_
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+
+def encode_cursor(timestamp, row_id):
+    """
+    Encode the sort key of the last row on a page as an opaque cursor
+    """
+    raw = f"{timestamp.isoformat()}|{row_id}".encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """
+    Decode a cursor back into (timestamp, id). Raises ValueError if it is malformed.
+    """
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        timestamp, row_id = base64.urlsafe_b64decode(padded.encode()).decode().split('|')
+        return datetime.fromisoformat(timestamp), int(row_id)
+    except Exception:
+        raise ValueError("Invalid cursor")
+
+
+def page_size(limit):
+    """
+    Clamp a requested page size to [1, MAX_PAGE_SIZE]
+    """
+    if limit is None:
+        return DEFAULT_PAGE_SIZE
+    return max(1, min(limit, MAX_PAGE_SIZE))
+
+
+def keyset_page(query, time_column, id_column, cursor=None, limit=DEFAULT_PAGE_SIZE, descending=True, extra=()):
+    """
+    Fetch one page ordered by (time, id) starting after the cursor.
+
+    Seeks directly to the cursor position through the timestamp index instead
+    of skipping rows with OFFSET. extra holds rows from outside the query
+    (e.g. archived readings) with the same attributes, merged into the pages
+    in order. Returns (rows, next_cursor); next_cursor is None on the last page.
+    """
+    def sort_key(row):
+        return getattr(row, time_column.key), getattr(row, id_column.key)
+
+    if cursor:
+        timestamp, row_id = decode_cursor(cursor)
+        if descending:
+            query = query.filter(or_(
+                time_column < timestamp,
+                and_(time_column == timestamp, id_column < row_id)
+            ))
+            extra = [row for row in extra if sort_key(row) < (timestamp, row_id)]
+        else:
+            query = query.filter(or_(
+                time_column > timestamp,
+                and_(time_column == timestamp, id_column > row_id)
+            ))
+            extra = [row for row in extra if sort_key(row) > (timestamp, row_id)]
+
+    if descending:
+        query = query.order_by(time_column.desc(), id_column.desc())
+    else:
+        query = query.order_by(time_column.asc(), id_column.asc())
+
+    rows = query.limit(limit + 1).all()
+    if extra:
+        rows = sorted(rows + list(extra), key=sort_key, reverse=descending)[:limit + 1]
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(*sort_key(rows[-1]))
+    return rows, next_cursor
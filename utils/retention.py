@@ -0,0 +1,188 @@
+import os
+import re
+import time
+import logging
+from datetime import datetime, timedelta
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Retention settings
+RAW_RETENTION_DAYS = int(os.getenv('RAW_RETENTION_DAYS', 30))
+# Per-device overrides, e.g. "kitchen=7,warehouse=90"
+RAW_RETENTION_OVERRIDES = os.getenv('RAW_RETENTION_OVERRIDES', '')
+ALERT_RETENTION_DAYS = int(os.getenv('ALERT_RETENTION_DAYS', 90))
+# Delivered, coalesced and failed notifications are kept this long; pending ones are never pruned
+OUTBOX_RETENTION_DAYS = int(os.getenv('OUTBOX_RETENTION_DAYS', 30))
+ARCHIVE_DIR = os.getenv('ARCHIVE_DIR', 'data/archive')
+# Rows moved per transaction, and pause between transactions so ingest can take the write lock
+ARCHIVE_CHUNK_SIZE = int(os.getenv('ARCHIVE_CHUNK_SIZE', 2000))
+ARCHIVE_PAUSE_SECONDS = float(os.getenv('ARCHIVE_PAUSE_SECONDS', 0.05))
+
+
+def parse_retention_overrides(value):
+    """
+    Parse "device=days,device=days" into a dict
+    """
+    overrides = {}
+    for part in filter(None, (item.strip() for item in value.split(','))):
+        device_id, days = part.rsplit('=', 1)
+        overrides[device_id.strip()] = int(days)
+    return overrides
+
+
+_retention_overrides = parse_retention_overrides(RAW_RETENTION_OVERRIDES)
+
+
+def retention_days(device_id):
+    """
+    Number of days raw readings are kept in the database for a device
+    """
+    return _retention_overrides.get(device_id, RAW_RETENTION_DAYS)
+
+
+def retention_cutoff(device_id, now=None):
+    """
+    Readings older than this naive UTC datetime belong in the archive
+    """
+    return (now or datetime.utcnow()) - timedelta(days=retention_days(device_id))
+
+
+class ReadingArchive:
+    """
+    Compressed, date-partitioned columnar archive of raw readings.
+
+    Each partition directory <root>/<device>/<YYYY-MM-DD>/ holds .npz files
+    with parallel id, timestamp (epoch microseconds) and value arrays.
+    """
+    def __init__(self, root=ARCHIVE_DIR):
+        self.root = root
+
+    def _device_dir(self, device_id):
+        return os.path.join(self.root, re.sub(r'[^A-Za-z0-9_.-]', '_', device_id))
+
+    def write(self, device_id, ids, timestamps, values):
+        """
+        Write readings to their date partitions. Re-writing the same rows is idempotent.
+        """
+        ids = np.asarray(ids, dtype=np.int64)
+        micros = np.array(timestamps, dtype='datetime64[us]')
+        values = np.asarray(values, dtype=np.float64)
+        days = micros.astype('datetime64[D]')
+
+        for day in np.unique(days):
+            mask = days == day
+            partition = os.path.join(self._device_dir(device_id), str(day))
+            os.makedirs(partition, exist_ok=True)
+
+            part_ids = ids[mask]
+            path = os.path.join(partition, f"part-{part_ids.min()}-{part_ids.max()}.npz")
+            tmp_path = path + '.tmp.npz'
+            np.savez_compressed(
+                tmp_path, id=part_ids, timestamp=micros[mask].astype(np.int64), value=values[mask]
+            )
+            os.replace(tmp_path, path)
+
+    def read(self, device_id, start, end):
+        """
+        Return (ids, timestamps, values) arrays for archived readings in [start, end), oldest first
+        """
+        device_dir = self._device_dir(device_id)
+        ids, micros, values = [], [], []
+
+        day = start.date()
+        while day <= end.date():
+            partition = os.path.join(device_dir, day.isoformat())
+            if os.path.isdir(partition):
+                for name in sorted(os.listdir(partition)):
+                    if not name.endswith('.npz') or name.endswith('.tmp.npz'):
+                        continue
+                    with np.load(os.path.join(partition, name)) as part:
+                        ids.append(part['id'])
+                        micros.append(part['timestamp'])
+                        values.append(part['value'])
+            day += timedelta(days=1)
+
+        if not ids:
+            return np.array([], dtype=np.int64), np.array([], dtype='datetime64[us]'), np.array([])
+
+        ids = np.concatenate(ids)
+        micros = np.concatenate(micros).astype('datetime64[us]')
+        values = np.concatenate(values)
+
+        # Drop rows re-archived after an interrupted run
+        ids, first = np.unique(ids, return_index=True)
+        micros, values = micros[first], values[first]
+
+        mask = (micros >= np.datetime64(start, 'us')) & (micros < np.datetime64(end, 'us'))
+        ids, micros, values = ids[mask], micros[mask], values[mask]
+        order = np.argsort(micros, kind='stable')
+        return ids[order], micros[order], values[order]
+
+
+# Shared archive for the application process
+reading_archive = ReadingArchive()
+
+
+def archive_expired_readings(session, model, value_column, device_id, filters, cutoff,
+                             archive=reading_archive, chunk_size=ARCHIVE_CHUNK_SIZE,
+                             pause=ARCHIVE_PAUSE_SECONDS):
+    """
+    Move a device's readings older than cutoff into the archive, one small transaction per chunk.
+
+    Each chunk is written to the archive before it is deleted, so an
+    interruption never loses data; at worst the chunk is archived twice and
+    de-duplicated on read. Returns the number of rows moved.
+    """
+    moved = 0
+    while True:
+        rows = session.query(model.id, model.timestamp, value_column).filter(
+            *filters, model.timestamp < cutoff
+        ).order_by(model.timestamp, model.id).limit(chunk_size).all()
+        # End the read: the delete below then starts a transaction of its own, which waits for the write lock
+        session.close()
+        if not rows:
+            break
+
+        ids, timestamps, values = zip(*rows)
+        archive.write(device_id, ids, timestamps, values)
+
+        session.query(model).filter(model.id.in_(ids)).delete(synchronize_session=False)
+        session.commit()
+        moved += len(rows)
+
+        if len(rows) < chunk_size:
+            break
+        time.sleep(pause)
+
+    if moved:
+        logger.info(f"Archived {moved} readings for device {device_id} older than {cutoff:%Y-%m-%d %H:%M}")
+    return moved
+
+
+def delete_in_batches(session, model, filters, chunk_size=ARCHIVE_CHUNK_SIZE, pause=ARCHIVE_PAUSE_SECONDS,
+                      detach=()):
+    """
+    Delete matching rows in small transactions. Returns the number of rows deleted.
+
+    detach lists foreign key columns of other tables referencing the rows;
+    they are set to NULL in the same transaction before the rows are deleted.
+    """
+    deleted = 0
+    while True:
+        ids = [row_id for (row_id,) in session.query(model.id).filter(*filters).limit(chunk_size).all()]
+        # End the read: the delete below then starts a transaction of its own, which waits for the write lock
+        session.close()
+        if not ids:
+            break
+        for column in detach:
+            session.query(column.class_).filter(column.in_(ids)).update({column: None}, synchronize_session=False)
+        session.query(model).filter(model.id.in_(ids)).delete(synchronize_session=False)
+        session.commit()
+        deleted += len(ids)
+
+        if len(ids) < chunk_size:
+            break
+        time.sleep(pause)
+    return deleted
@@ -0,0 +1,360 @@
+import os
+import threading
+from datetime import datetime, timedelta
+
+import numpy as np
+from sqlalchemy import case, func
+
+from utils.database import begin_write
+from utils.leader import MULTI_WORKER
+
+# Rollup bucket sizes in seconds: 1 minute, 1 hour, 1 day
+ROLLUP_GRANULARITIES = (60, 3600, 86400)
+# Gaps between readings longer than this are not credited to time-above-threshold
+ROLLUP_MAX_GAP_SECONDS = int(os.getenv('ROLLUP_MAX_GAP_SECONDS', 300))
+
+# Rows per multi-row upsert statement
+UPSERT_CHUNK_ROWS = 500
+# Days of readings rebuilt per committed transaction; whole days keep every bucket in one chunk
+REBUILD_CHUNK_DAYS = 1
+
+EPOCH = datetime(1970, 1, 1)
+_LEVELS = {"warning": 1, "danger": 2}
+_STATUS_LEVELS = {"Safe": 0, "safe": 0, "Warning": 1, "warning": 1, "Danger": 2, "danger": 2}
+
+
+def status_levels(statuses):
+    """
+    Map status labels ("Safe"/"warning"/"Danger", any case) to 0/1/2
+    """
+    levels = _STATUS_LEVELS
+    return np.fromiter(
+        (levels.get(status, 0) if status in levels else _LEVELS.get(str(status).lower(), 0) for status in statuses),
+        dtype=np.int8
+    )
+
+
+def to_epochs(timestamps):
+    """
+    Convert naive UTC datetimes to float epoch seconds
+    """
+    # Plain timedelta arithmetic is several times faster than numpy's datetime64 object conversion
+    return np.array([(timestamp - EPOCH).total_seconds() for timestamp in timestamps], dtype=float)
+
+
+def summarize(epochs, values, levels, previous=None, max_gap=ROLLUP_MAX_GAP_SECONDS):
+    """
+    Aggregate one device's readings, sorted by time, into rollup buckets.
+
+    previous is the (epoch, level) of the reading just before this run, if
+    known. The interval since the previous reading is credited to that
+    reading's level. Returns a list of row dicts, one per (granularity, bucket),
+    each carrying its last reading's value, level and timestamp.
+    """
+    epochs = np.asarray(epochs, dtype=float)
+    values = np.asarray(values, dtype=float)
+    levels = np.asarray(levels, dtype=np.int8)
+    n = len(epochs)
+    if n == 0:
+        return []
+
+    if previous is not None:
+        prev_epochs = np.concatenate(([previous[0]], epochs[:-1]))
+        prev_levels = np.concatenate(([previous[1]], levels[:-1]))
+    else:
+        prev_epochs = np.concatenate(([epochs[0]], epochs[:-1]))
+        prev_levels = np.concatenate(([0], levels[:-1]))
+
+    gaps = np.clip(epochs - prev_epochs, 0, None)
+    gaps[gaps > max_gap] = 0
+    warning = np.where(prev_levels == 1, gaps, 0.0)
+    danger = np.where(prev_levels == 2, gaps, 0.0)
+
+    rows = []
+    for granularity in ROLLUP_GRANULARITIES:
+        buckets = (epochs // granularity).astype(np.int64) * granularity
+        starts = np.flatnonzero(np.concatenate(([True], buckets[1:] != buckets[:-1])))
+        lasts = np.append(starts[1:], n) - 1
+
+        counts = np.diff(np.append(starts, n))
+        mins = np.minimum.reduceat(values, starts)
+        maxs = np.maximum.reduceat(values, starts)
+        sums = np.add.reduceat(values, starts)
+        warnings = np.add.reduceat(warning, starts)
+        dangers = np.add.reduceat(danger, starts)
+
+        for i, start in enumerate(starts):
+            rows.append({
+                "granularity": granularity,
+                "bucket_start": EPOCH + timedelta(seconds=int(buckets[start])),
+                "count": int(counts[i]),
+                "min_value": float(mins[i]),
+                "max_value": float(maxs[i]),
+                "sum_value": float(sums[i]),
+                "warning_seconds": float(warnings[i]),
+                "danger_seconds": float(dangers[i]),
+                "last_value": float(values[lasts[i]]),
+                "last_level": int(levels[lasts[i]]),
+                "last_timestamp": EPOCH + timedelta(microseconds=int(round(epochs[lasts[i]] * 1e6)))
+            })
+    return rows
+
+
+def _upsert_statement(table, dialect_name, rows):
+    if dialect_name == 'sqlite':
+        from sqlalchemy.dialects.sqlite import insert
+        least, greatest = func.min, func.max
+    else:
+        from sqlalchemy.dialects.postgresql import insert
+        least, greatest = func.least, func.greatest
+
+    stmt = insert(table).values(rows)
+    excluded = stmt.excluded
+    newer = excluded.last_timestamp >= table.c.last_timestamp
+    return stmt.on_conflict_do_update(
+        index_elements=['device_id', 'granularity', 'bucket_start'],
+        set_={
+            "count": table.c.count + excluded.count,
+            "min_value": least(table.c.min_value, excluded.min_value),
+            "max_value": greatest(table.c.max_value, excluded.max_value),
+            "sum_value": table.c.sum_value + excluded.sum_value,
+            "warning_seconds": table.c.warning_seconds + excluded.warning_seconds,
+            "danger_seconds": table.c.danger_seconds + excluded.danger_seconds,
+            "last_value": case((newer, excluded.last_value), else_=table.c.last_value),
+            "last_level": case((newer, excluded.last_level), else_=table.c.last_level),
+            "last_timestamp": greatest(table.c.last_timestamp, excluded.last_timestamp)
+        }
+    )
+
+
+def upsert_rollups(session, model, device_id, rows):
+    """
+    Merge aggregated rows into the rollup table with native upserts where the backend allows it
+    """
+    if not rows:
+        return
+    rows = [{"device_id": device_id, **row} for row in rows]
+    dialect_name = session.bind.dialect.name
+
+    if dialect_name in ('sqlite', 'postgresql'):
+        # Chunked to stay under the backend's bound-parameter limit
+        for i in range(0, len(rows), UPSERT_CHUNK_ROWS):
+            session.execute(_upsert_statement(model.__table__, dialect_name, rows[i:i + UPSERT_CHUNK_ROWS]))
+        return
+
+    # Generic read-modify-write fallback for other backends
+    for row in rows:
+        existing = session.query(model).filter_by(
+            device_id=device_id, granularity=row["granularity"], bucket_start=row["bucket_start"]
+        ).first()
+        if existing is None:
+            session.add(model(**row))
+            continue
+        existing.count += row["count"]
+        existing.min_value = min(existing.min_value, row["min_value"])
+        existing.max_value = max(existing.max_value, row["max_value"])
+        existing.sum_value += row["sum_value"]
+        existing.warning_seconds += row["warning_seconds"]
+        existing.danger_seconds += row["danger_seconds"]
+        if row["last_timestamp"] >= existing.last_timestamp:
+            existing.last_value = row["last_value"]
+            existing.last_level = row["last_level"]
+            existing.last_timestamp = row["last_timestamp"]
+
+
+class RollupTracker:
+    """
+    Keeps the last reading per device so incremental updates can credit time above thresholds.
+
+    With shared=True, other processes may ingest readings for the same
+    devices, so the last reading is looked up in the device's latest
+    1-minute rollup instead of this process's memory.
+    """
+    def __init__(self, max_gap=ROLLUP_MAX_GAP_SECONDS, shared=MULTI_WORKER):
+        self.max_gap = max_gap
+        self.shared = shared
+        self._last = {}
+        self._lock = threading.Lock()
+
+    def _stored_previous(self, session, model, device_id, first_epoch):
+        # Take the write lock before reading so the upsert that follows cannot hit a stale snapshot
+        begin_write(session)
+        granularity = ROLLUP_GRANULARITIES[0]
+        bucket_start = EPOCH + timedelta(seconds=int(first_epoch // granularity * granularity))
+        row = session.query(model.last_timestamp, model.last_level).filter(
+            model.device_id == device_id,
+            model.granularity == granularity,
+            model.bucket_start <= bucket_start
+        ).order_by(model.bucket_start.desc()).first()
+        if row is None:
+            return None
+        return ((row.last_timestamp - EPOCH).total_seconds(), row.last_level)
+
+    def record(self, session, model, device_id, timestamps, values, statuses):
+        """
+        Fold new readings for one device into the rollup table within the caller's transaction
+        """
+        if not len(timestamps):
+            return
+        epochs = to_epochs(timestamps)
+        values = np.asarray(values, dtype=float)
+        levels = status_levels(statuses)
+        order = np.argsort(epochs, kind='stable')
+        epochs, values, levels = epochs[order], values[order], levels[order]
+
+        if self.shared:
+            previous = self._stored_previous(session, model, device_id, epochs[0])
+        else:
+            with self._lock:
+                previous = self._last.get(device_id)
+                self._last[device_id] = max(
+                    (epochs[-1], int(levels[-1])), self._last.get(device_id, (float('-inf'), 0))
+                )
+        if previous is not None and epochs[0] < previous[0]:
+            # Late data: aggregate it but do not credit durations across the gap
+            previous = None
+
+        upsert_rollups(session, model, device_id, summarize(epochs, values, levels, previous, self.max_gap))
+
+
+# Shared tracker for the ingest paths in this process
+rollup_tracker = RollupTracker()
+
+
+def rebuild_rollups(session, model, device_id, read_rows, start, end, chunk_days=REBUILD_CHUNK_DAYS):
+    """
+    Recompute a device's rollups for [start, end) from its raw readings.
+
+    read_rows(lo, hi) returns the device's (timestamp, value, status) rows with
+    lo <= timestamp < hi ordered by time. The range is rebuilt in whole-day
+    chunks, each deleting and re-aggregating its buckets in its own committed
+    transaction, so the write lock is never held for the whole history and
+    readers see either the old or the new rollups of a day. Rollups outside
+    the range are left alone. The session must not be in a transaction.
+    """
+    day = ROLLUP_GRANULARITIES[-1]
+    start_epoch = int((start - EPOCH).total_seconds())
+    chunk_start = EPOCH + timedelta(seconds=start_epoch - start_epoch % day)
+    step = timedelta(days=chunk_days)
+
+    previous = None
+    total = 0
+    while chunk_start < end:
+        chunk_end = chunk_start + step
+        begin_write(session)
+        session.query(model).filter(
+            model.device_id == device_id,
+            model.bucket_start >= chunk_start,
+            model.bucket_start < chunk_end
+        ).delete(synchronize_session=False)
+
+        rows = read_rows(chunk_start, chunk_end)
+        if rows:
+            timestamps, values, statuses = zip(*rows)
+            epochs = to_epochs(timestamps)
+            levels = status_levels(statuses)
+            upsert_rollups(session, model, device_id, summarize(epochs, values, levels, previous))
+            previous = (epochs[-1], int(levels[-1]))
+            total += len(rows)
+        session.commit()
+        chunk_start = chunk_end
+    return total
+
+
+def pick_granularity(resolution):
+    """
+    Coarsest rollup granularity that evenly divides the requested resolution, if any
+    """
+    for granularity in reversed(ROLLUP_GRANULARITIES):
+        if resolution >= granularity and resolution % granularity == 0:
+            return granularity
+    return None
+
+
+def _merge_buckets(buckets, start_time, count, min_value, max_value, sum_value, warning_seconds, danger_seconds, last):
+    """
+    Fold one sub-bucket into the list of buckets; sub-buckets must arrive oldest first
+    """
+    if not buckets or buckets[-1]["start"] != start_time:
+        buckets.append({
+            "start": start_time, "count": 0, "min": min_value, "max": max_value, "sum": 0.0,
+            "warning_seconds": 0.0, "danger_seconds": 0.0, "last": last
+        })
+    bucket = buckets[-1]
+    bucket["count"] += count
+    bucket["min"] = min(bucket["min"], min_value)
+    bucket["max"] = max(bucket["max"], max_value)
+    bucket["sum"] += sum_value
+    bucket["warning_seconds"] += warning_seconds
+    bucket["danger_seconds"] += danger_seconds
+    bucket["last"] = last
+
+
+def query_rollup_buckets(session, model, device_id, start, end, resolution, raw_buckets=None):
+    """
+    Serve a bucketed history query from the coarsest suitable rollup.
+
+    Rollups cover the window from the device's first 1-minute rollup in it to
+    the newest reading rolled up. Readings outside that (stored before the
+    rollups existed, or not yet rolled up) are aggregated by
+    raw_buckets(lo, hi), which returns downsample.query_buckets() output for
+    readings with lo <= timestamp < hi at the same resolution, and merged in.
+    Gaps inside the covered span are not detected.
+
+    Returns buckets in the same shape as downsample.query_buckets() plus
+    warning_seconds/danger_seconds (0 for raw-only parts), or None if no
+    rollup fits or covers the window.
+    """
+    granularity = pick_granularity(resolution)
+    if granularity is None:
+        return None
+
+    start_epoch = int((start - EPOCH).total_seconds())
+    aligned_start = EPOCH + timedelta(seconds=start_epoch - start_epoch % resolution)
+    rows = session.query(
+        model.bucket_start, model.count, model.min_value, model.max_value, model.sum_value,
+        model.warning_seconds, model.danger_seconds, model.last_value, model.last_timestamp
+    ).filter(
+        model.device_id == device_id,
+        model.granularity == granularity,
+        model.bucket_start >= aligned_start,
+        model.bucket_start < end
+    ).order_by(model.bucket_start).all()
+    if not rows:
+        return None
+
+    head, tail = [], []
+    if raw_buckets is not None:
+        covered_from = session.query(func.min(model.bucket_start)).filter(
+            model.device_id == device_id,
+            model.granularity == ROLLUP_GRANULARITIES[0],
+            model.bucket_start >= aligned_start,
+            model.bucket_start < end
+        ).scalar() or rows[0].bucket_start
+        covered_until = max(row.last_timestamp for row in rows)
+        if covered_from > start:
+            head = raw_buckets(start, covered_from)
+        if covered_until < end:
+            tail = raw_buckets(covered_until + timedelta(microseconds=1), end)
+
+    buckets = []
+    for raw in head:
+        _merge_buckets(
+            buckets, raw["start"], raw["count"], raw["min"], raw["max"], raw["avg"] * raw["count"], 0.0, 0.0,
+            raw["last"]
+        )
+    for bucket_start, count, min_value, max_value, sum_value, warning_seconds, danger_seconds, last_value, _ in rows:
+        epoch = int((bucket_start - EPOCH).total_seconds())
+        _merge_buckets(
+            buckets, EPOCH + timedelta(seconds=epoch - epoch % resolution), count, min_value, max_value, sum_value,
+            warning_seconds, danger_seconds, last_value
+        )
+    for raw in tail:
+        _merge_buckets(
+            buckets, raw["start"], raw["count"], raw["min"], raw["max"], raw["avg"] * raw["count"], 0.0, 0.0,
+            raw["last"]
+        )
+
+    for bucket in buckets:
+        bucket["avg"] = bucket.pop("sum") / bucket["count"] if bucket["count"] else None
+    return buckets
@@ -0,0 +1,189 @@
+import os
+import time
+import threading
+from collections import deque
+
+import numpy as np
+
+# Poll interval bounds in seconds
+SCHEDULER_MIN_INTERVAL = float(os.getenv('SCHEDULER_MIN_INTERVAL', 5))
+SCHEDULER_WARNING_INTERVAL = float(os.getenv('SCHEDULER_WARNING_INTERVAL', 10))
+SCHEDULER_BASE_INTERVAL = float(os.getenv('SCHEDULER_BASE_INTERVAL', 60))
+SCHEDULER_MAX_INTERVAL = float(os.getenv('SCHEDULER_MAX_INTERVAL', 300))
+# Factor the interval grows by after each flat, safe reading
+SCHEDULER_BACKOFF = float(os.getenv('SCHEDULER_BACKOFF', 1.5))
+# Rate of change in PPM per minute treated as flat, and as fast enough to poll at the minimum interval
+SCHEDULER_FLAT_SLOPE = float(os.getenv('SCHEDULER_FLAT_SLOPE', 0.5))
+SCHEDULER_STEEP_SLOPE = float(os.getenv('SCHEDULER_STEEP_SLOPE', 5))
+# Recent readings per thing used to estimate the slope
+SCHEDULER_WINDOW = int(os.getenv('SCHEDULER_WINDOW', 5))
+# Arduino Cloud request budget shared by all things
+ARDUINO_RATE_LIMIT = float(os.getenv('ARDUINO_RATE_LIMIT', 10))
+ARDUINO_RATE_BURST = float(os.getenv('ARDUINO_RATE_BURST', 20))
+
+DECISIONS = ("danger", "warning", "steep", "flat", "normal")
+
+
+class TokenBucket:
+    """
+    Reservation-based rate limiter: each request reserves a token and learns how long to wait for it
+    """
+    def __init__(self, rate=ARDUINO_RATE_LIMIT, burst=ARDUINO_RATE_BURST, clock=time.monotonic):
+        self.rate = rate
+        self.burst = burst
+        self.clock = clock
+        self._tokens = burst
+        self._updated = clock()
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        """
+        Take one token and return the seconds to wait before using it
+        """
+        with self._lock:
+            now = self.clock()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= 1
+            return 0.0 if self._tokens >= 0 else -self._tokens / self.rate
+
+    def acquire(self):
+        """
+        Take one token if available and return 0; otherwise return the seconds until one is, taking nothing
+        """
+        with self._lock:
+            now = self.clock()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0.0
+            return (1 - self._tokens) / self.rate
+
+
+def slope_per_minute(epochs, values):
+    """
+    Least-squares slope of values over time in units per minute
+    """
+    epochs = np.asarray(epochs, dtype=float)
+    values = np.asarray(values, dtype=float)
+    if len(epochs) < 2:
+        return 0.0
+    t = epochs - epochs.mean()
+    denominator = (t * t).sum()
+    if denominator == 0:
+        return 0.0
+    return float((t * (values - values.mean())).sum() / denominator * 60)
+
+
+class AdaptiveScheduler:
+    """
+    Chooses each thing's next poll interval from its status and recent rate of change.
+
+    Danger and Warning readings, or readings changing faster than
+    steep_slope PPM/min, are polled every few seconds. Flat Safe readings
+    back off geometrically toward max_interval; anything else is polled at
+    base_interval. All polls share one token bucket so the total request
+    rate stays within the API limit. clock is injectable so schedules can be
+    replayed with a simulated clock.
+    """
+    def __init__(self, min_interval=SCHEDULER_MIN_INTERVAL, warning_interval=SCHEDULER_WARNING_INTERVAL,
+                 base_interval=SCHEDULER_BASE_INTERVAL, max_interval=SCHEDULER_MAX_INTERVAL,
+                 backoff=SCHEDULER_BACKOFF, flat_slope=SCHEDULER_FLAT_SLOPE, steep_slope=SCHEDULER_STEEP_SLOPE,
+                 window=SCHEDULER_WINDOW, rate_limit=ARDUINO_RATE_LIMIT, burst=ARDUINO_RATE_BURST,
+                 clock=time.monotonic):
+        self.min_interval = min_interval
+        self.warning_interval = warning_interval
+        self.base_interval = base_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.flat_slope = flat_slope
+        self.steep_slope = steep_slope
+        self.window = window
+        self.clock = clock
+        self.limiter = TokenBucket(rate_limit, burst, clock)
+        self._history = {}
+        self._intervals = {}
+        self._reasons = {}
+        self._decisions = dict.fromkeys(DECISIONS, 0)
+        self._rate_limited = 0
+        self._rate_limit_wait = 0.0
+        self._rate_limit_refused = 0
+        self._lock = threading.Lock()
+
+    def interval(self, thing_id):
+        """
+        Current poll interval for a thing
+        """
+        return self._intervals.get(thing_id, self.base_interval)
+
+    def decide(self, previous, status, slope):
+        """
+        Return (interval, reason) for a thing given its previous interval, status label and slope
+        """
+        status = str(status).lower()
+        if status == "danger":
+            return self.min_interval, "danger"
+        if abs(slope) >= self.steep_slope:
+            return self.min_interval, "steep"
+        if status == "warning":
+            return self.warning_interval, "warning"
+        if abs(slope) <= self.flat_slope:
+            # Back off from wherever we are, but never faster than the base interval
+            return min(max(previous, self.base_interval / self.backoff) * self.backoff, self.max_interval), "flat"
+        return self.base_interval, "normal"
+
+    def observe(self, thing_id, value, status, at=None):
+        """
+        Record a thing's new reading and return the delay until its next poll
+        """
+        at = self.clock() if at is None else at
+        with self._lock:
+            history = self._history.setdefault(thing_id, deque(maxlen=self.window))
+            history.append((at, float(value)))
+            epochs, values = zip(*history)
+            # The latest step catches a sudden jump that the fit over sparse, flat history would average away
+            slope = max(slope_per_minute(epochs, values), slope_per_minute(epochs[-2:], values[-2:]), key=abs)
+            interval, reason = self.decide(self.interval(thing_id), status, slope)
+            self._intervals[thing_id] = interval
+            self._reasons[thing_id] = reason
+            self._decisions[reason] += 1
+        return interval
+
+    def reserve(self):
+        """
+        Reserve one API request and return the seconds to wait before sending it
+        """
+        wait = self.limiter.reserve()
+        if wait > 0:
+            with self._lock:
+                self._rate_limited += 1
+                self._rate_limit_wait += wait
+        return wait
+
+    def acquire(self):
+        """
+        Take one API request if the budget allows it now and return 0; otherwise return the seconds until it does
+        """
+        wait = self.limiter.acquire()
+        if wait > 0:
+            with self._lock:
+                self._rate_limit_refused += 1
+        return wait
+
+    def stats(self):
+        with self._lock:
+            intervals = np.array(list(self._intervals.values()) or [self.base_interval])
+            current = dict.fromkeys(DECISIONS, 0)
+            for reason in self._reasons.values():
+                current[reason] += 1
+            return {
+                "decisions": dict(self._decisions),
+                "things_by_reason": current,
+                "interval_min_seconds": float(intervals.min()),
+                "interval_median_seconds": float(np.median(intervals)),
+                "interval_max_seconds": float(intervals.max()),
+                "rate_limited": self._rate_limited,
+                "rate_limit_wait_seconds": round(self._rate_limit_wait, 3),
+                "rate_limit_refused": self._rate_limit_refused
+            }
@@ -0,0 +1,108 @@
+import os
+import json
+import zlib
+from datetime import datetime
+
+import numpy as np
+from flask import Response, request
+
+try:
+    import brotli  # Optional, enables Content-Encoding: br
+except ImportError:
+    brotli = None
+
+# Values per JSON chunk when streaming a column
+COLUMNAR_CHUNK_SIZE = int(os.getenv('COLUMNAR_CHUNK_SIZE', 8192))
+# zlib/brotli compression level; lower is faster
+RESPONSE_COMPRESSION_LEVEL = int(os.getenv('RESPONSE_COMPRESSION_LEVEL', 5))
+
+LIST_FORMATS = ('rows', 'columns')
+
+
+def utc_offset(tz):
+    """
+    Current UTC offset of a timezone without daylight saving time.
+
+    Adding it to naive UTC datetimes replaces per-row localize()/astimezone() calls.
+    """
+    return tz.utcoffset(datetime.utcnow())
+
+
+def list_format():
+    """
+    Output format requested with format= (rows by default); raises ValueError for unknown formats
+    """
+    value = request.args.get('format', 'rows')
+    if value not in LIST_FORMATS:
+        raise ValueError(f"Unknown format '{value}', expected one of: {', '.join(LIST_FORMATS)}")
+    return value
+
+
+def _json_values(values):
+    if isinstance(values, np.ndarray):
+        values = values.tolist()
+    return values
+
+
+def stream_columns(columns, meta=None, chunk_size=COLUMNAR_CHUNK_SIZE):
+    """
+    Yield a JSON object of parallel arrays, one chunk of values at a time
+    """
+    head = json.dumps(meta or {}, separators=(',', ':'))[:-1]
+    yield head + (',' if len(head) > 1 else '')
+    for i, (name, values) in enumerate(columns.items()):
+        values = _json_values(values)
+        yield ('' if i == 0 else ',') + json.dumps(name) + ':['
+        for start in range(0, len(values), chunk_size):
+            chunk = json.dumps(values[start:start + chunk_size], separators=(',', ':'))[1:-1]
+            yield ('' if start == 0 else ',') + chunk
+        yield ']'
+    yield '}\n'
+
+
+def negotiate_encoding(accept_encoding):
+    """
+    Pick br or gzip from an Accept-Encoding header, or None for identity
+    """
+    accepted = {part.split(';')[0].strip().lower() for part in accept_encoding.split(',')}
+    if brotli is not None and 'br' in accepted:
+        return 'br'
+    if 'gzip' in accepted:
+        return 'gzip'
+    return None
+
+
+def compress_stream(chunks, encoding, level=RESPONSE_COMPRESSION_LEVEL):
+    """
+    Compress a stream of text chunks incrementally
+    """
+    if encoding == 'br':
+        compressor = brotli.Compressor(quality=level)
+        for chunk in chunks:
+            data = compressor.process(chunk.encode())
+            if data:
+                yield data
+        yield compressor.finish()
+        return
+
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)  # wbits 31 writes a gzip header
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode())
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def columnar_response(columns, meta=None):
+    """
+    Streamed JSON response of parallel arrays, compressed when the client accepts it
+    """
+    body = stream_columns(columns, meta)
+    encoding = negotiate_encoding(request.headers.get('Accept-Encoding', ''))
+    if encoding:
+        body = compress_stream(body, encoding)
+    response = Response(body, mimetype='application/json')
+    response.vary.add('Accept-Encoding')
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    return response
@@ -2,109 +2,172 @@ import os
 import logging
 import time
 import argparse
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime, timedelta
-from dotenv import load_dotenv
-from config import load_config
-from main import app
-from models.gas_readings import db, GasReading, SystemStatus
-from utils.arduino_cloud import ArduinoCloudAPI
-
-# Load environment variables
-load_dotenv()
-
-
-# Set up logging
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
-    handlers=[
-        logging.FileHandler("arduino_sync.log"),
-        logging.StreamHandler(),
-    ],
-)
+# Loads .env; imported before the modules that read their settings from the environment
+from config import ARDUINO_CLIENT_ID, ARDUINO_CLIENT_SECRET, ARDUINO_THING_ID
+from models.gas_readings import db, SystemStatus
+from utils.arduino_cloud import ArduinoCloudAPI, get_cached_property_map
+from utils.latest_state import cache_system_status
+from utils.metrics import configure_logging
+from utils.thresholds import threshold_engine
+
+
+# Set up logging before the app is imported, so syncs log to their own file; records are written by a background thread
+configure_logging("arduino_sync.log", "%(asctime)s - %(name)s - %(levelname)s - %(message)s")
 
 logger = logging.getLogger("arduino-sync")
 
 
-def sync_data_from_arduino_cloud():
+# Properties read on every sync
+GAS_LEVEL_PROPERTY = "gas_level"
+BATTERY_PROPERTY = "battery_level"
+STATUS_PROPERTIES = ("device_status", "connectivity", "online_status")
+SYNC_PROPERTIES = (GAS_LEVEL_PROPERTY, BATTERY_PROPERTY) + STATUS_PROPERTIES
+
+# Parallel single-property requests when the properties list lacks a value
+SYNC_FETCH_WORKERS = 4
+
+# Milliseconds spent in each phase of the most recent sync
+last_sync_timings = {}
+
+
+def get_app():
+    """Return the configured application, importing it on the first sync."""
+    from main import create_app
+    return create_app(serve=False)
+
+
+def get_reading_store():
+    """Return the collector's store path, which also runs anomaly detection and alerting."""
+    from main import store_collected_readings
+    return store_collected_readings
+
+
+@contextmanager
+def timed(timings, phase):
+    """Record the wall time of a block in milliseconds under timings[phase]."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[phase] = round((time.perf_counter() - start) * 1000, 1)
+
+
+def read_last_values(arduino_api, thing_id, properties):
+    """Return {property name: last value} for the synced properties.
+
+    Values come from the single properties response. Properties it does not
+    carry a value for are fetched concurrently by ID from the cached
+    property map, which also covers a failed properties request.
+    """
+    values = {}
+    for prop in properties:
+        name = prop.get("name", "").lower()
+        if name in SYNC_PROPERTIES and "last_value" in prop:
+            values[name] = prop["last_value"]
+
+    property_map = get_cached_property_map(thing_id) or {}
+    missing = [name for name in SYNC_PROPERTIES if name not in values and name in property_map]
+    if missing:
+        with ThreadPoolExecutor(max_workers=min(len(missing), SYNC_FETCH_WORKERS)) as executor:
+            results = executor.map(lambda name: arduino_api.get_last_value(thing_id, property_map[name]), missing)
+            for name, result in zip(missing, results):
+                if result and "last_value" in result:
+                    values[name] = result["last_value"]
+    return values
+
+
+def parse_online(values, default=True):
+    """Derive the online flag from whichever status properties are present."""
+    is_online = default
+    for status_prop in STATUS_PROPERTIES:
+        value = values.get(status_prop)
+        if isinstance(value, bool):
+            is_online = value
+        elif isinstance(value, str) and value.lower() in ["online", "connected", "true"]:
+            is_online = True
+        elif isinstance(value, str) and value.lower() in ["offline", "disconnected", "false"]:
+            is_online = False
+    return is_online
+
+
+def update_system_status(device_id, values):
+    """Update or create the device's system status row in the current transaction and return it."""
+    status = SystemStatus.query.filter_by(device_id=device_id).first()
+    if not status:
+        status = SystemStatus(device_id=device_id)
+        db.session.add(status)
+
+    status.is_online = parse_online(values)  # Assume online if we can fetch data
+    status.last_update = datetime.utcnow()
+    if values.get(BATTERY_PROPERTY) is not None:
+        status.battery_level = int(float(values[BATTERY_PROPERTY]))
+    return status
+
+
+def sync_data_from_arduino_cloud(thing_id=None):
     """Pull data from Arduino Cloud and store it in the local database."""
+    timings = {}
+    sync_start = time.perf_counter()
     try:
-        client_id = os.environ.get("ARDUINO_CLIENT_ID")
-        client_secret = os.environ.get("ARDUINO_CLIENT_SECRET")
-        thing_id = os.environ.get("ARDUINO_THING_ID")
+        client_id = ARDUINO_CLIENT_ID
+        client_secret = ARDUINO_CLIENT_SECRET
+        thing_id = thing_id or ARDUINO_THING_ID
 
         if not all([client_id, client_secret, thing_id]):
             logger.error("Arduino Cloud credentials or Thing ID not found")
             return False
 
-        # Initialize Arduino Cloud API client
-        arduino_api = ArduinoCloudAPI(client_id, client_secret)
-
-        if not arduino_api.authenticate():
+        # Initialize Arduino Cloud API client; the token is cached across syncs
+        with timed(timings, "auth"):
+            arduino_api = ArduinoCloudAPI(client_id, client_secret, thing_id)
+            authenticated = arduino_api.authenticate()
+        if not authenticated:
             logger.error("Authentication with Arduino Cloud failed")
             return False
 
-        logger.info("Successfully authenticated with Arduino Cloud")
-
-        # Fetch Thing properties
-        properties = arduino_api.get_thing_properties(thing_id)
-        if not properties:
+        # One request returns every property with its last value
+        with timed(timings, "properties"):
+            properties = arduino_api.get_thing_properties(thing_id)
+        if not properties and get_cached_property_map(thing_id) is None:
             logger.error(f"Failed to retrieve properties for Thing ID: {thing_id}")
             return False
 
-        # Map property names to IDs
-        property_map = {prop["name"].lower(): prop["id"] for prop in properties}
-        logger.info(f"Properties found: {', '.join(property_map.keys())}")
-
-        with app.app_context():
-            # Sync gas readings
-            if "gas_level" in property_map:
-                property_id = property_map["gas_level"]
-                last_value = arduino_api.get_last_value(thing_id, property_id)
-
-                if last_value and "last_value" in last_value:
-                    ppm_value = float(last_value["last_value"])
-                    gas_reading = GasReading(
-                        ppm=ppm_value,
-                        device_id=f"arduino_cloud_{thing_id[:8]}",
-                    )
-                    db.session.add(gas_reading)
-                    logger.info(f"Added gas reading: {ppm_value} PPM")
-
-            # Sync system status
-            battery_level = None
-            if "battery_level" in property_map:
-                battery_data = arduino_api.get_last_value(thing_id, property_map["battery_level"])
-                if battery_data and "last_value" in battery_data:
-                    battery_level = int(float(battery_data["last_value"]))
-
-            is_online = True  # Assume online if we can fetch data
-            for status_prop in ["device_status", "connectivity", "online_status"]:
-                if status_prop in property_map:
-                    status_data = arduino_api.get_last_value(thing_id, property_map[status_prop])
-                    if status_data and "last_value" in status_data:
-                        value = status_data["last_value"]
-                        if isinstance(value, bool):
-                            is_online = value
-                        elif isinstance(value, str) and value.lower() in ["online", "connected", "true"]:
-                            is_online = True
-                        elif isinstance(value, str) and value.lower() in ["offline", "disconnected", "false"]:
-                            is_online = False
-
-            # Update or create system status
-            status = SystemStatus.query.filter_by(device_id=f"arduino_cloud_{thing_id[:8]}").first()
-            if not status:
-                status = SystemStatus(device_id=f"arduino_cloud_{thing_id[:8]}")
-                db.session.add(status)
-
-            status.is_online = is_online
-            status.last_update = datetime.now(datetime.UTC)
-            if battery_level is not None:
-                status.battery_level = battery_level
-
-            # Commit all changes atomically
-            db.session.commit()
-            logger.info(f"Updated system status: online={is_online}, battery={battery_level}%")
+        with timed(timings, "values"):
+            values = read_last_values(arduino_api, thing_id, properties)
+        logger.info(f"Properties found: {', '.join(values.keys())}")
+
+        device_id = f"arduino_cloud_{thing_id[:8]}"
+        # Importing the app on the first sync is not database time
+        with timed(timings, "app"):
+            app = get_app()
+
+        with timed(timings, "database"), app.app_context():
+            status = None
+
+            def add_system_status():
+                nonlocal status
+                status = update_system_status(device_id, values)
+
+            # Sync gas readings through the same path as the collector: reading, rollups, threshold and
+            # anomaly alerts and the system status in one commit, then the cache and dashboard updates
+            if values.get(GAS_LEVEL_PROPERTY) is not None:
+                ppm_value = float(values[GAS_LEVEL_PROPERTY])
+                get_reading_store()([{
+                    "device_id": device_id,
+                    "gas_level": ppm_value,
+                    # Hysteresis and dwell across syncs, as for the collector's polls
+                    "status": threshold_engine.classify_reading(device_id, ppm_value, time.time())
+                }], before_commit=add_system_status)
+                logger.info(f"Added gas reading: {ppm_value} PPM", extra={"sample": "reading"})
+            else:
+                add_system_status()
+                db.session.commit()
+
+            logger.info(f"Updated system status: online={status.is_online}, battery={status.battery_level}%")
+            cache_system_status(status)
 
         return True
 
@@ -112,6 +175,12 @@ def sync_data_from_arduino_cloud():
         logger.error(f"Error syncing data from Arduino Cloud: {str(e)}", exc_info=True)
         return False
 
+    finally:
+        timings["total"] = round((time.perf_counter() - sync_start) * 1000, 1)
+        last_sync_timings.clear()
+        last_sync_timings.update(timings)
+        logger.info("Sync timings (ms): " + ", ".join(f"{phase}={ms}" for phase, ms in timings.items()))
+
 
 def run_periodic_sync(interval_minutes=5):
     """Run the sync process periodically."""
@@ -0,0 +1,231 @@
+import os
+import json
+import logging
+import threading
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Default MQ-6 thresholds in PPM, used when no profile file overrides them
+DEFAULT_WARNING_PPM = float(os.getenv('WARNING_PPM', 30))
+DEFAULT_DANGER_PPM = float(os.getenv('DANGER_PPM', 50))
+# PPM a reading must fall below a threshold before the status steps down
+DEFAULT_HYSTERESIS = float(os.getenv('THRESHOLD_HYSTERESIS', 0))
+# Seconds a lower status must persist before the status steps down
+DEFAULT_MIN_DWELL = float(os.getenv('THRESHOLD_MIN_DWELL', 0))
+# Optional JSON file with per-device and per-gas profiles
+THRESHOLD_PROFILES_FILE = os.getenv('THRESHOLD_PROFILES_FILE')
+
+SAFE, WARNING, DANGER = 0, 1, 2
+STATUS_LABELS = ("Safe", "Warning", "Danger")
+
+
+class ThresholdProfile:
+    """
+    Warning/danger thresholds with hysteresis and a minimum dwell time
+    """
+    def __init__(self, warning=DEFAULT_WARNING_PPM, danger=DEFAULT_DANGER_PPM,
+                 hysteresis=DEFAULT_HYSTERESIS, min_dwell=DEFAULT_MIN_DWELL):
+        if danger < warning:
+            raise ValueError("Danger threshold must not be below the warning threshold")
+        self.warning = float(warning)
+        self.danger = float(danger)
+        self.hysteresis = float(hysteresis)
+        self.min_dwell = float(min_dwell)
+        self._up = np.array([self.warning, self.danger])
+        self._down = self._up - self.hysteresis
+
+    def level(self, value):
+        """
+        Stateless level for a single reading
+        """
+        if value >= self.danger:
+            return DANGER
+        if value >= self.warning:
+            return WARNING
+        return SAFE
+
+    def levels(self, values):
+        """
+        Stateless levels for an array of readings
+        """
+        return np.searchsorted(self._up, np.asarray(values, dtype=float), side='right').astype(np.int8)
+
+    def to_dict(self):
+        return {
+            "warning": self.warning,
+            "danger": self.danger,
+            "hysteresis": self.hysteresis,
+            "min_dwell": self.min_dwell
+        }
+
+
+class ClassifierState:
+    """
+    Streaming state for one device: current level and when a step down became pending
+    """
+    __slots__ = ('level', 'pending_since')
+
+    def __init__(self, level=SAFE, pending_since=None):
+        self.level = level
+        self.pending_since = pending_since
+
+
+class ThresholdEngine:
+    """
+    Classifies readings against threshold profiles per device and gas type.
+
+    Profiles are looked up by (device, gas), then device, then gas, then the
+    default. Escalation is immediate. Stepping down requires the reading to
+    drop hysteresis PPM below the threshold and stay there for min_dwell
+    seconds. Arrays are classified run by run, so the Python loop only visits
+    points where the stateless classification changes.
+    """
+    def __init__(self, default=None, devices=None, gases=None):
+        self.default = default or ThresholdProfile()
+        self.devices = devices or {}
+        self.gases = gases or {}
+        self._states = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_dict(cls, config):
+        """
+        Build an engine from {"default": {...}, "devices": {...}, "gases": {...}}.
+        Device keys may be "device" or "device:gas".
+        """
+        default = ThresholdProfile(**config.get('default', {}))
+
+        def profile(values):
+            return ThresholdProfile(**{**default.to_dict(), **values})
+
+        return cls(
+            default=default,
+            devices={key: profile(values) for key, values in config.get('devices', {}).items()},
+            gases={key: profile(values) for key, values in config.get('gases', {}).items()}
+        )
+
+    @classmethod
+    def from_file(cls, path):
+        with open(path, encoding='utf-8') as f:
+            return cls.from_dict(json.load(f))
+
+    def profile_for(self, device_id=None, gas_type=None):
+        if device_id is not None and gas_type is not None:
+            profile = self.devices.get(f"{device_id}:{gas_type}")
+            if profile is not None:
+                return profile
+        if device_id is not None and device_id in self.devices:
+            return self.devices[device_id]
+        if gas_type is not None and gas_type in self.gases:
+            return self.gases[gas_type]
+        return self.default
+
+    def status(self, value, device_id=None, gas_type=None):
+        """
+        Stateless status label for a single reading
+        """
+        return STATUS_LABELS[self.profile_for(device_id, gas_type).level(value)]
+
+    def statuses(self, values, device_id=None, gas_type=None):
+        """
+        Stateless status labels for an array of readings
+        """
+        return np.array(STATUS_LABELS, dtype=object)[self.profile_for(device_id, gas_type).levels(values)]
+
+    def classify(self, values, epochs, device_id=None, gas_type=None, state=None):
+        """
+        Classify a time-ordered array of readings with hysteresis and dwell.
+
+        state carries the device's ClassifierState in and out, so consecutive
+        calls (streaming ingest, chunked reprocessing) behave like one long
+        series. Returns an int8 array of levels.
+        """
+        profile = self.profile_for(device_id, gas_type)
+        values = np.asarray(values, dtype=float)
+        epochs = np.asarray(epochs, dtype=float)
+        n = len(values)
+        state = state if state is not None else ClassifierState()
+        if n == 0:
+            return np.empty(0, dtype=np.int8)
+
+        up = np.searchsorted(profile._up, values, side='right')
+        down = np.searchsorted(profile._down, values, side='right')
+
+        # Runs of consecutive readings with the same (up, down) classification
+        changes = np.flatnonzero((up[1:] != up[:-1]) | (down[1:] != down[:-1])) + 1
+        run_starts = np.concatenate(([0], changes))
+        run_ends = np.append(changes, n)
+
+        result = np.empty(n, dtype=np.int8)
+        level, pending_since = state.level, state.pending_since
+        for start, end in zip(run_starts.tolist(), run_ends.tolist()):
+            run_up, run_down = int(up[start]), int(down[start])
+
+            if run_up > level:
+                level, pending_since = run_up, None
+                result[start:end] = level
+            elif run_down < level:
+                if pending_since is None:
+                    pending_since = epochs[start]
+                # First reading in this run that completes the dwell time
+                switch = start + int(np.searchsorted(
+                    epochs[start:end], pending_since + profile.min_dwell, side='left'
+                ))
+                result[start:switch] = level
+                if switch < end:
+                    level, pending_since = run_down, None
+                    result[switch:end] = level
+            else:
+                pending_since = None
+                result[start:end] = level
+
+        state.level, state.pending_since = level, pending_since
+        return result
+
+    def classify_reading(self, device_id, value, epoch, gas_type=None):
+        """
+        Classify one live reading using the device's streaming state. Returns a status label.
+        """
+        profile = self.profile_for(device_id, gas_type)
+        with self._lock:
+            state = self._states.setdefault((device_id, gas_type), ClassifierState())
+            up = profile.level(value)
+            down = profile.level(value + profile.hysteresis)
+
+            if up > state.level:
+                state.level, state.pending_since = up, None
+            elif down < state.level:
+                if state.pending_since is None:
+                    state.pending_since = epoch
+                if epoch - state.pending_since >= profile.min_dwell:
+                    state.level, state.pending_since = down, None
+            else:
+                state.pending_since = None
+            return STATUS_LABELS[state.level]
+
+    def classify_readings(self, device_id, values, epochs, gas_type=None):
+        """
+        Classify time-ordered live readings using the device's streaming state. Returns labels.
+        """
+        with self._lock:
+            state = self._states.setdefault((device_id, gas_type), ClassifierState())
+            levels = self.classify(values, epochs, device_id, gas_type, state)
+        return np.array(STATUS_LABELS, dtype=object)[levels]
+
+
+def load_engine():
+    """
+    Build the engine from THRESHOLD_PROFILES_FILE if set, else from the default thresholds
+    """
+    if THRESHOLD_PROFILES_FILE:
+        try:
+            return ThresholdEngine.from_file(THRESHOLD_PROFILES_FILE)
+        except (OSError, ValueError, TypeError) as e:
+            logger.error(f"Failed to load threshold profiles from {THRESHOLD_PROFILES_FILE}: {e}")
+    return ThresholdEngine()
+
+
+# Shared engine for the application process
+threshold_engine = load_engine()
@@ -0,0 +1,202 @@
+import os
+import json
+import time
+import queue
+import atexit
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Write-behind ingest settings
+WRITE_BEHIND_ENABLED = os.getenv('WRITE_BEHIND', 'False').lower() in ('true', '1', 't')
+WRITE_BEHIND_BATCH_SIZE = int(os.getenv('WRITE_BEHIND_BATCH_SIZE', 200))
+WRITE_BEHIND_INTERVAL_MS = int(os.getenv('WRITE_BEHIND_INTERVAL_MS', 500))
+WRITE_BEHIND_MAX_QUEUE = int(os.getenv('WRITE_BEHIND_MAX_QUEUE', 10000))
+# Failed flushes are retried this many times, waiting WRITE_BEHIND_RETRY_BACKOFF_MS, doubled after each attempt
+WRITE_BEHIND_RETRIES = int(os.getenv('WRITE_BEHIND_RETRIES', 3))
+WRITE_BEHIND_RETRY_BACKOFF_MS = int(os.getenv('WRITE_BEHIND_RETRY_BACKOFF_MS', 200))
+# Batches still failing after the retries are appended here as JSON lines instead of being dropped
+WRITE_BEHIND_DEAD_LETTER_PATH = os.getenv('WRITE_BEHIND_DEAD_LETTER_PATH', 'data/write_behind_dead_letter.jsonl')
+
+
+class WriteBehindQueue:
+    """
+    Bounded in-memory queue drained by a single writer thread in group commits.
+
+    Items are flushed when max_batch items are waiting or max_delay_ms has
+    passed since the first item of the batch arrived, whichever is first.
+    flush_fn receives the list of items and is expected to commit them in a
+    single transaction; put() can name another flush function for its item, so
+    several ingest paths share one queue and writer. When an app is given,
+    flushes run inside its app context. A failed flush is retried with
+    exponential backoff, then its items are appended to the dead-letter file.
+    """
+    def __init__(self, flush_fn, app=None, max_batch=WRITE_BEHIND_BATCH_SIZE,
+                 max_delay_ms=WRITE_BEHIND_INTERVAL_MS, maxsize=WRITE_BEHIND_MAX_QUEUE,
+                 retries=WRITE_BEHIND_RETRIES, backoff_ms=WRITE_BEHIND_RETRY_BACKOFF_MS,
+                 dead_letter_path=WRITE_BEHIND_DEAD_LETTER_PATH):
+        self.flush_fn = flush_fn
+        self.app = app
+        self.max_batch = max_batch
+        self.max_delay = max_delay_ms / 1000
+        self.retries = retries
+        self.backoff = backoff_ms / 1000
+        self.dead_letter_path = dead_letter_path
+        self._queue = queue.Queue(maxsize=maxsize)
+        self._stopping = threading.Event()
+        self._thread = None
+        self._stats_lock = threading.Lock()
+        self._stats = {
+            "enqueued": 0,
+            "rejected": 0,
+            "flushed": 0,
+            "retried": 0,
+            "failed": 0,
+            "dead_lettered": 0,
+            "dropped": 0,
+            "batches": 0,
+            "last_batch_size": 0,
+            "last_flush_ms": 0.0,
+            "max_depth": 0
+        }
+
+    def start(self):
+        """
+        Start the writer thread and drain the queue when the interpreter exits
+        """
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='write-behind', daemon=True)
+            self._thread.start()
+            atexit.register(self.stop)
+        return self
+
+    def put(self, item, flush_fn=None):
+        """
+        Queue an item for writing by flush_fn (the queue's own by default).
+        Returns False if the queue is full or stopping, in which case the
+        caller should write synchronously.
+        """
+        if self._stopping.is_set():
+            return False
+        try:
+            self._queue.put_nowait((flush_fn or self.flush_fn, item))
+        except queue.Full:
+            with self._stats_lock:
+                self._stats["rejected"] += 1
+            return False
+
+        depth = self._queue.qsize()
+        with self._stats_lock:
+            self._stats["enqueued"] += 1
+            self._stats["max_depth"] = max(self._stats["max_depth"], depth)
+        return True
+
+    def stop(self, timeout=10):
+        """
+        Stop accepting items and wait for everything queued to be written
+        """
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            if self._thread.is_alive():
+                logger.error(f"Write-behind queue did not drain within {timeout}s; "
+                             f"{self._queue.qsize()} readings not written")
+
+    def stats(self):
+        with self._stats_lock:
+            stats = dict(self._stats)
+        stats["depth"] = self._queue.qsize()
+        stats["capacity"] = self._queue.maxsize
+        return stats
+
+    def _next_batch(self):
+        try:
+            batch = [self._queue.get(timeout=self.max_delay)]
+        except queue.Empty:
+            return []
+
+        deadline = time.monotonic() + self.max_delay
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            try:
+                if remaining <= 0:
+                    batch.append(self._queue.get_nowait())
+                else:
+                    batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _call(self, flush_fn, items):
+        if self.app is not None:
+            with self.app.app_context():
+                flush_fn(items)
+        else:
+            flush_fn(items)
+
+    def _flush(self, batch):
+        started = time.perf_counter()
+        # One flush per flush function, in order of first appearance
+        groups = {}
+        for flush_fn, item in batch:
+            groups.setdefault(flush_fn, []).append(item)
+
+        for flush_fn, items in groups.items():
+            if self._write(flush_fn, items):
+                with self._stats_lock:
+                    self._stats["flushed"] += len(items)
+            else:
+                self._dead_letter(flush_fn, items)
+
+        with self._stats_lock:
+            self._stats["batches"] += 1
+            self._stats["last_batch_size"] = len(batch)
+            self._stats["last_flush_ms"] = (time.perf_counter() - started) * 1000
+
+    def _write(self, flush_fn, items):
+        """
+        Flush items, retrying with exponential backoff. Returns False once every attempt has failed.
+        """
+        for attempt in range(self.retries + 1):
+            try:
+                self._call(flush_fn, items)
+                return True
+            except Exception as e:
+                if attempt == self.retries:
+                    logger.error(f"Write-behind flush of {len(items)} readings failed: {e}", exc_info=True)
+                    return False
+                delay = self.backoff * 2 ** attempt
+                logger.warning(f"Write-behind flush of {len(items)} readings failed, retrying in {delay:g}s: {e}")
+                with self._stats_lock:
+                    self._stats["retried"] += 1
+                time.sleep(delay)
+
+    def _dead_letter(self, flush_fn, items):
+        """
+        Append items that could not be written to the dead-letter file, one JSON line each
+        """
+        with self._stats_lock:
+            self._stats["failed"] += len(items)
+        name = getattr(flush_fn, '__name__', type(flush_fn).__name__)
+        try:
+            directory = os.path.dirname(self.dead_letter_path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            with open(self.dead_letter_path, 'a') as f:
+                for item in items:
+                    f.write(json.dumps({"flush": name, "item": item}, default=str) + '\n')
+        except Exception as e:
+            logger.error(f"Could not write {len(items)} readings to {self.dead_letter_path}; dropped: {e}")
+            with self._stats_lock:
+                self._stats["dropped"] += len(items)
+            return
+        logger.error(f"Wrote {len(items)} unwritten readings to {self.dead_letter_path}")
+        with self._stats_lock:
+            self._stats["dead_lettered"] += len(items)
+
+    def _run(self):
+        while not (self._stopping.is_set() and self._queue.empty()):
+            batch = self._next_batch()
+            if batch:
+                self._flush(batch)